@@ -0,0 +1,328 @@
+import socket
+import os
+import sys
+import argparse
+import json
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import platform
+
+# End-to-end benchmark of the whole stack on this machine.  We start a fleet
+# of servers and two balancers over them, one proxying and one redirecting,
+# each with a config.txt of their own, then drive a standard set of workloads
+# through them with the load generator and record throughput and latency
+# percentiles.  The results go to a JSON file, and a run can be compared with
+# an earlier one to catch performance regressions before they are deployed.
+#
+# A server can be made to look slow or far away by putting a stand-in in
+# front of it, which passes the traffic through with a delay on every request
+# and a cap on how fast responses come back.
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.join(BENCHMARK_DIR, '..')
+sys.path.append(os.path.join(REPO_DIR, 'client'))
+import loadgen
+
+# How long we give a program to start listening before giving up on it.  The
+# balancer tests every server before it starts, so it gets longer.
+
+STARTUP_TIMEOUT = 30
+
+# Size of the blocks the stand-in backend relays.  Smaller blocks make its
+# bandwidth cap smoother.
+
+RELAY_BUFFER_SIZE = 16384
+
+# The standard workloads: the name each is recorded under, which front end
+# it goes through, the files it asks for, and any extra load generator
+# options.  Direct workloads go straight to the first server, proxy ones
+# through the proxying balancer and redirect ones through the redirecting
+# balancer.  Mixed traffic favours the small page, the way real traffic
+# favours a few popular files, and includes requests for a missing file.
+
+WORKLOADS = [
+    ('small-direct', 'direct', ['index.html'], []),
+    ('small-proxy', 'proxy', ['index.html'], []),
+    ('small-redirect', 'redirect', ['index.html'], ['--follow-redirects']),
+    ('large-direct', 'direct', ['down.gif'], []),
+    ('large-proxy', 'proxy', ['down.gif'], []),
+    ('mixed-proxy', 'proxy', ['index.html', 'down.gif', 'missing.html'], ['--skew', '1']),
+]
+
+# The figures compared against a baseline, and whether a rise is good.
+
+COMPARED = [('throughput', True), ('p50', False), ('p99', False)]
+
+# Find a free port on this machine.
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+# Wait for a program we started to accept connections on its port.  If it
+# dies or takes too long, show the end of its log and give up.
+
+def wait_until_listening(process, port, log_name):
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while (time.monotonic() < deadline):
+        if (process.poll() != None):
+            break
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    with open(log_name) as log:
+        print(''.join(log.readlines()[-20:]))
+    raise RuntimeError('Program logging to ' + log_name + ' did not start listening on port ' + str(port))
+
+# Start one of the programs in the given directory, logging its output to a
+# file there, and wait for it to be ready.
+
+def start_program(processes, script, arguments, directory, port, log_name):
+    log_name = os.path.join(directory, log_name)
+    with open(log_name, 'w') as log:
+        process = subprocess.Popen([sys.executable, script] + arguments, cwd=directory, stdout=log, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL)
+    processes.append(process)
+    wait_until_listening(process, port, log_name)
+
+# A stand-in for a slow server.  It listens on a port of its own and passes
+# every connection through to the real server, holding each piece of a
+# request back for the given latency and pacing the response so it arrives
+# no faster than the given bandwidth in bytes per second.
+
+class throttled_backend:
+    def __init__(self, target, latency, bandwidth):
+        self.target = target
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.listener = socket.create_server(('127.0.0.1', 0))
+        self.port = self.listener.getsockname()[1]
+        threading.Thread(target=self.accept_loop, daemon=True).start()
+
+    def accept_loop(self):
+        while True:
+            client, addr = self.listener.accept()
+            threading.Thread(target=self.serve, args=(client,), daemon=True).start()
+
+    def serve(self, client):
+        try:
+            upstream = socket.create_connection(self.target)
+        except OSError:
+            client.close()
+            return
+        threading.Thread(target=self.relay, args=(client, upstream, self.latency, 0), daemon=True).start()
+        self.relay(upstream, client, 0, self.bandwidth)
+
+    # Copy one direction of a connection until it closes, then close both.
+
+    def relay(self, source, destination, delay, bandwidth):
+        try:
+            while True:
+                data = source.recv(RELAY_BUFFER_SIZE)
+                if (data == b''):
+                    break
+                if (delay > 0):
+                    time.sleep(delay)
+                destination.sendall(data)
+                if (bandwidth > 0):
+                    time.sleep(len(data) / bandwidth)
+        except OSError:
+            pass
+        finally:
+            source.close()
+            destination.close()
+
+# Set up the directories the programs run in and start them all: the
+# servers, any stand-ins in front of them, and the two balancers.  Returns
+# the address of each front end the workloads use.
+
+def start_fleet(work_dir, processes, args):
+
+    # The servers share one directory with the repository's pages and
+    # images in it.  The balancer times a download of testing.jpg, so we
+    # make one from down.gif.
+
+    server_dir = os.path.join(work_dir, 'server')
+    shutil.copytree(os.path.join(REPO_DIR, 'server'), server_dir, ignore=shutil.ignore_patterns('*.py', '__pycache__'))
+    shutil.copy(os.path.join(server_dir, 'down.gif'), os.path.join(server_dir, 'testing.jpg'))
+    servers = []
+    for i in range(args.servers):
+        port = free_port()
+        start_program(processes, os.path.join(REPO_DIR, 'server', 'server.py'), ['--port', str(port)], server_dir, port, 'server' + str(i) + '.log')
+        servers.append(('127.0.0.1', port))
+
+    # The last few servers are put behind stand-ins when asked to slow them.
+
+    backends = list(servers)
+    if (args.slow_latency > 0) or (args.slow_bandwidth > 0):
+        for i in range(max(len(backends) - args.slow_servers, 0), len(backends)):
+            stand_in = throttled_backend(backends[i], args.slow_latency / 1000, args.slow_bandwidth * 1000)
+            backends[i] = ('127.0.0.1', stand_in.port)
+            print('Server ' + str(i) + ' is slowed by a stand-in on port ' + str(stand_in.port))
+
+    # Each balancer gets its own directory with its pages and a config.txt
+    # listing the servers.
+
+    fronts = {'direct': servers[0]}
+    for mode in ('proxy', 'redirect'):
+        balancer_dir = os.path.join(work_dir, mode)
+        shutil.copytree(os.path.join(REPO_DIR, 'load_balancer'), balancer_dir, ignore=shutil.ignore_patterns('*.py', '*.txt', '__pycache__'))
+        with open(os.path.join(balancer_dir, 'config.txt'), 'w') as config:
+            for host, port in backends:
+                config.write(host + ':' + str(port) + '\n')
+        port = free_port()
+        arguments = ['config.txt', '--port', str(port), '--state-file', '', '--algorithm', args.algorithm]
+        if (mode == 'redirect'):
+            arguments.append('--redirect')
+        start_program(processes, os.path.join(REPO_DIR, 'load_balancer', 'balancer.py'), arguments, balancer_dir, port, 'balancer.log')
+        fronts[mode] = ('127.0.0.1', port)
+    return fronts
+
+# Run one workload against its front end and return the figures we keep.  A
+# short warm up first fills the servers' caches and the balancers' pools.
+
+def run_workload(front, files, extra, args):
+    host, port = front
+    urls = ['http://' + host + ':' + str(port) + '/' + name for name in files]
+    options = urls + extra + ['--users', str(args.users), '--seed', str(args.seed)]
+    if (args.rate != None):
+        options = options + ['--rate', str(args.rate)]
+    if (args.warmup > 0):
+        loadgen.run_load(loadgen.build_parser().parse_args(options + ['--requests', str(args.warmup)]))
+    summary = loadgen.run_load(loadgen.build_parser().parse_args(options + ['--requests', str(args.requests)]))
+    total = summary['phases']['total']
+    result = {
+        'throughput': summary['throughput'],
+        'bytes_per_second': summary['bytes_per_second'],
+        'sent': summary['sent'],
+        'errors': summary['errors'],
+        'statuses': summary['statuses'],
+        'mean': total.get('mean'),
+        'p50': total.get('p50'),
+        'p90': total.get('p90'),
+        'p99': total.get('p99'),
+        'p999': total.get('p999'),
+        'max': total.get('max'),
+        'phases': {phase: {name: figures.get(name) for name in ('mean', 'p50', 'p99')} for phase, figures in summary['phases'].items()},
+    }
+    return result
+
+# Print one workload's results, with latencies in milliseconds.
+
+def print_result(name, result):
+    if (result['p50'] == None):
+        print(f'{name:<16}{"no requests answered":>30}{result["errors"]:>10}')
+        return
+    print(f'{name:<16}{result["throughput"]:>10.1f}' + ''.join(f'{result[x]:>10.2f}' for x in ('p50', 'p90', 'p99', 'p999')) + f'{result["errors"]:>10}')
+
+# Compare a run with a baseline, workload by workload.  A figure counts as a
+# regression when it is worse than the baseline's by more than the tolerance,
+# as is any workload that now has errors when it had none.  Returns the list
+# of regressions.
+
+def compare_with_baseline(results, baseline, tolerance):
+    regressions = []
+    print('\nCompared with the baseline from ' + baseline.get('started', 'an earlier run') + ':')
+    print(f'{"workload":<16}' + ''.join(f'{name:>14}' for name, higher_is_better in COMPARED))
+    for name, result in results['workloads'].items():
+        old = baseline.get('workloads', {}).get(name)
+        if (old == None):
+            print(f'{name:<16}  not in the baseline')
+            continue
+        line = f'{name:<16}'
+        for figure, higher_is_better in COMPARED:
+            if (result.get(figure) == None) or (not old.get(figure)):
+                line = line + f'{"-":>14}'
+                continue
+            change = (result[figure] - old[figure]) / old[figure]
+            worse = (change < -tolerance) if (higher_is_better) else (change > tolerance)
+            line = line + f'{100 * change:>+12.1f}%' + ('!' if (worse) else ' ')
+            if (worse):
+                regressions.append(name + ' ' + figure + ' went from ' + f'{old[figure]:.2f}' + ' to ' + f'{result[figure]:.2f}')
+        if (result['errors'] > 0) and (old.get('errors', 0) == 0):
+            regressions.append(name + ' now has ' + str(result['errors']) + ' errors')
+        print(line)
+    return regressions
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Benchmark servers and balancers started on this machine")
+    parser.add_argument("--servers", type=int, default=3, help="Number of servers to start")
+    parser.add_argument("--requests", type=int, default=2000, help="Requests in each workload")
+    parser.add_argument("--warmup", type=int, default=100, help="Requests sent before each workload and not counted")
+    parser.add_argument("--users", type=int, default=16, help="Closed-loop users sending requests at once")
+    parser.add_argument("--rate", type=float, help="Run open-loop at this many requests a second instead")
+    parser.add_argument("--workloads", type=lambda s: s.split(','), default=[name for name, front, files, extra in WORKLOADS], help="Workloads to run, separated by commas")
+    parser.add_argument("--algorithm", default='weighted', help="Algorithm the balancers spread requests with")
+    parser.add_argument("--slow-servers", type=int, default=1, help="Number of servers to slow down when a slow latency or bandwidth is given")
+    parser.add_argument("--slow-latency", type=float, default=0, help="Milliseconds added to every request to a slowed server")
+    parser.add_argument("--slow-bandwidth", type=float, default=0, help="Kilobytes per second a slowed server's responses are held to")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed, so runs can be repeated")
+    parser.add_argument("--output", default='benchmark_results.json', help="File to write the results to")
+    parser.add_argument("--baseline", help="Results file from an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=10, help="Percent a figure may be worse than the baseline before it counts as a regression")
+    parser.add_argument("--keep", action="store_true", help="Keep the working directory with the programs' logs")
+    args = parser.parse_args()
+
+    known = {name: (front, files, extra) for name, front, files, extra in WORKLOADS}
+    unknown = [name for name in args.workloads if (name not in known)]
+    if (len(unknown) > 0):
+        parser.error('unknown workloads ' + ', '.join(unknown) + '; choose from ' + ', '.join(known))
+    baseline = None
+    if (args.baseline != None):
+        try:
+            with open(args.baseline) as store:
+                baseline = json.load(store)
+        except (OSError, ValueError) as e:
+            parser.error('could not read the baseline: ' + str(e))
+
+    results = {
+        'started': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'machine': {'python': platform.python_version(), 'platform': platform.platform(), 'cpus': os.cpu_count()},
+        'options': vars(args),
+        'workloads': {},
+    }
+    work_dir = tempfile.mkdtemp(prefix='benchmark-')
+    processes = []
+    try:
+        print('Starting ' + str(args.servers) + ' servers and 2 balancers in ' + work_dir + ' ...')
+        fronts = start_fleet(work_dir, processes, args)
+        print(f'\n{"workload":<16}{"req/s":>10}{"p50 ms":>10}{"p90 ms":>10}{"p99 ms":>10}{"p99.9 ms":>10}{"errors":>10}')
+        for name in args.workloads:
+            front, files, extra = known[name]
+            result = run_workload(fronts[front], files, extra, args)
+            results['workloads'][name] = result
+            print_result(name, result)
+    except (RuntimeError, OSError) as e:
+        print('Error:  ' + str(e))
+        sys.exit(1)
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+        if (args.keep):
+            print('\nLogs kept in ' + work_dir)
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    with open(args.output, 'w') as output:
+        json.dump(results, output, indent=1)
+    print('\nResults written to ' + args.output)
+
+    if (baseline != None):
+        regressions = compare_with_baseline(results, baseline, args.tolerance / 100)
+        if (len(regressions) > 0):
+            print('\nRegressions beyond ' + str(args.tolerance) + '%:')
+            for regression in regressions:
+                print('  ' + regression)
+            sys.exit(1)
+        print('\nNo regressions beyond ' + str(args.tolerance) + '%.')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+import socket
+import os
+import sys
+import argparse
+import threading
+import time
+
+# Microbenchmark comparing the shared buffered HTTP parser against the old
+# per-byte line reader that the client, server and balancer used to carry.
+# A writer thread pushes a stream of pipelined requests through a local
+# socket pair and the reader on the other end parses them as fast as it can.
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from httputil import socket_reader, http_parser
+
+# A typical small request, with the sort of headers a browser would send.
+
+SAMPLE_REQUEST = (
+    'GET /index.html HTTP/1.1\r\n'
+    'Host: localhost:8080\r\n'
+    'User-Agent: Mozilla/5.0 (X11; Linux x86_64; rv:82.0) Gecko/20100101 Firefox/82.0\r\n'
+    'Accept: text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8\r\n'
+    'Accept-Language: en-CA,en-US;q=0.7,en;q=0.3\r\n'
+    'Accept-Encoding: gzip, deflate\r\n'
+    'Connection: keep-alive\r\n'
+    '\r\n'
+).encode()
+
+# The per-byte reader this benchmark measures against, kept here exactly as
+# it used to appear in the programs.
+
+def get_line_from_socket(sock):
+
+    done = False
+    line = ''
+    while (not done):
+        char = sock.recv(1).decode()
+        if (char == '\r'):
+            pass
+        elif (char == '\n'):
+            done = True
+        else:
+            line = line + char
+    return line
+
+# Parse count requests using the old reader: one line at a time until the
+# blank line that ends each request.
+
+def parse_with_line_reader(sock, count):
+    for i in range(count):
+        get_line_from_socket(sock)
+        while (get_line_from_socket(sock) != ''):
+            pass
+
+# Parse count requests using the buffered socket reader.
+
+def parse_with_socket_reader(sock, count):
+    reader = socket_reader(sock)
+    for i in range(count):
+        if (reader.read_head() == None):
+            raise RuntimeError('Stream ended early')
+
+# Write count copies of the sample request into the socket.  We send them in
+# large batches so that the writer is never the bottleneck.
+
+def write_requests(sock, count):
+    batch = SAMPLE_REQUEST * 64
+    while (count >= 64):
+        sock.sendall(batch)
+        count -= 64
+    sock.sendall(SAMPLE_REQUEST * count)
+
+# Time one parser over a fresh socket pair and return the elapsed seconds.
+
+def time_socket_parser(parse, count):
+    reading, writing = socket.socketpair()
+    writer = threading.Thread(target=write_requests, args=(writing, count))
+    start_time = time.perf_counter()
+    writer.start()
+    parse(reading, count)
+    end_time = time.perf_counter()
+    writer.join()
+    reading.close()
+    writing.close()
+    return end_time - start_time
+
+# Time the incremental parser on its own, without any socket at all, with
+# the input fed in small uneven pieces to mimic packets being split up.
+
+def time_pure_parser(count):
+    stream = SAMPLE_REQUEST * count
+    parser = http_parser()
+    parsed = 0
+    start_time = time.perf_counter()
+    for offset in range(0, len(stream), 1400):
+        parser.feed(stream[offset:offset + 1400])
+        while (parser.next_head() != None):
+            parsed += 1
+    end_time = time.perf_counter()
+    if (parsed != count):
+        raise RuntimeError('Parsed ' + str(parsed) + ' of ' + str(count) + ' requests')
+    return end_time - start_time
+
+# Print one line of results.
+
+def report(name, count, elapsed):
+    rate = count / elapsed
+    megabytes = count * len(SAMPLE_REQUEST) / elapsed / 1e6
+    print(f'{name:<28} {count:>8} requests  {elapsed:8.3f} s  {rate:12.0f} req/s  {megabytes:8.2f} MB/s')
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=100000, help="Number of requests for the buffered parser")
+    parser.add_argument("--line-requests", type=int, default=5000, help="Number of requests for the per-byte reader, which is much slower")
+    args = parser.parse_args()
+
+    line_time = time_socket_parser(parse_with_line_reader, args.line_requests)
+    reader_time = time_socket_parser(parse_with_socket_reader, args.requests)
+    pure_time = time_pure_parser(args.requests)
+
+    report('per-byte line reader', args.line_requests, line_time)
+    report('buffered socket reader', args.requests, reader_time)
+    report('incremental parser only', args.requests, pure_time)
+    speedup = (args.requests / reader_time) / (args.line_requests / line_time)
+    print(f'\nBuffered socket reader is {speedup:.1f}x faster per request.')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+import os
+import sys
+import argparse
+import heapq
+import random
+import collections
+
+# Simulation comparing the balancer's backend selection algorithms.  Requests
+# arrive at random and are spread over a set of synthetic backends, each of
+# which works through its requests a few at a time at its own speed.  Part
+# way through, one backend slows down without the health checker noticing,
+# the way a real server does when something else on its machine gets busy.
+# We report the latency percentiles each algorithm ends up with, since the
+# slowest requests are what users notice.
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'load_balancer'))
+from selection import SELECTORS, build_selector
+
+# A synthetic backend.  It has the attributes the selectors look at, with its
+# response time set as if the health checker had measured it before the run.
+
+class simulated_backend:
+    def __init__(self, name, service_time, slots):
+        self.host = name
+        self.port = 0
+        self.service_time = service_time
+        self.response_time = service_time
+        self.latency = service_time
+        self.active = 0
+        self.slots = slots
+        self.busy = 0
+        self.waiting = collections.deque()
+        self.served = 0
+
+# Run one simulation with the given algorithm.  Returns the latency of every
+# request, and how many requests each backend served.
+
+def simulate(algorithm, args):
+
+    rng = random.Random(args.seed)
+    random.seed(args.seed)
+    backends = [simulated_backend('backend' + str(i), args.service_time / speed, args.slots) for i, speed in enumerate(args.speeds)]
+    selector = build_selector(algorithm, backends)
+
+    # Requests arrive at whatever rate keeps the backends args.load busy.
+
+    capacity = sum(x.slots / x.service_time for x in backends)
+    arrival_rate = args.load * capacity
+    slow_from = args.requests // 2
+
+    latencies = []
+    completions = []
+    now = 0.0
+    arrived = 0
+
+    def start(backend, arrival_time, service_time):
+        backend.busy += 1
+        heapq.heappush(completions, (now + service_time, id(backend), backend, arrival_time))
+
+    while (arrived < args.requests) or (len(completions) > 0):
+        next_arrival = now + rng.expovariate(arrival_rate) if (arrived < args.requests) else None
+
+        # Finish every request due before the next one arrives.
+
+        while (len(completions) > 0) and ((next_arrival == None) or (completions[0][0] <= next_arrival)):
+            now, ignored, backend, arrival_time = heapq.heappop(completions)
+            backend.busy -= 1
+            backend.served += 1
+            latencies.append(now - arrival_time)
+            selector.release(backend, now - arrival_time)
+            if (len(backend.waiting) > 0):
+                start(backend, *backend.waiting.popleft())
+
+        if (next_arrival == None):
+            break
+
+        # Hand the new request to whichever backend the selector picks.
+
+        now = next_arrival
+        backend = selector.acquire('/file' + str(rng.randrange(1000)))
+        service_time = rng.expovariate(1 / backend.service_time)
+        if (arrived >= slow_from) and (backend is backends[0]):
+            service_time = service_time * args.slowdown
+        if (backend.busy < backend.slots):
+            start(backend, now, service_time)
+        else:
+            backend.waiting.append((now, service_time))
+        arrived += 1
+
+    return latencies, [x.served for x in backends]
+
+# Return the given percentile of a sorted list.
+
+def percentile(values, fraction):
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+# Print one line of results, with latencies in milliseconds.
+
+def report(name, latencies, served):
+    latencies.sort()
+    columns = [sum(latencies) / len(latencies)] + [percentile(latencies, p) for p in (0.5, 0.9, 0.99, 0.999)]
+    shares = '/'.join(str(round(100 * x / sum(served))) for x in served)
+    print(f'{name:<20}' + ''.join(f'{1000 * x:10.2f}' for x in columns) + f'  {shares}')
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=200000, help="Number of requests to simulate")
+    parser.add_argument("--speeds", type=lambda s: [float(x) for x in s.split(',')], default=[1, 1, 2, 4], help="Relative speed of each backend, separated by commas")
+    parser.add_argument("--service-time", type=float, default=0.01, help="Mean seconds a speed 1 backend takes per request")
+    parser.add_argument("--slots", type=int, default=4, help="Requests each backend works on at once")
+    parser.add_argument("--load", type=float, default=0.8, help="Fraction of the backends' total capacity the requests use")
+    parser.add_argument("--slowdown", type=float, default=3, help="How much slower the first backend gets half way through")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed, so runs can be repeated")
+    parser.add_argument("--algorithms", type=lambda s: s.split(','), default=sorted(SELECTORS), help="Algorithms to compare, separated by commas")
+    args = parser.parse_args()
+
+    print(f'{"algorithm":<20}{"mean ms":>10}{"p50 ms":>10}{"p90 ms":>10}{"p99 ms":>10}{"p99.9 ms":>10}  share %')
+    for algorithm in args.algorithms:
+        latencies, served = simulate(algorithm, args)
+        report(algorithm, latencies, served)
+
+if __name__ == '__main__':
+    main()
@@ -2,80 +2,762 @@ import socket
 import os
 import sys
 import argparse
+import json
+import zlib
+import threading
+import queue
+import time
 from urllib.parse import urlparse
 
-# Define a constant for our buffer size
+# Our shared HTTP helpers live alongside this program or one directory up.
 
-BUFFER_SIZE = 1024
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from httputil import socket_reader, http_error
 
-# A function for creating HTTP GET messages.
+# The file, kept next to our downloads, where we remember the ETag and
+# Last-Modified validators of every file we have downloaded.
 
-def prepare_get_message(host, port, file_name):
-    request = f'GET {file_name} HTTP/1.1\r\nHost: {host}:{port}\r\n\r\n' 
-    return request
+VALIDATOR_FILE = '.validators.json'
 
-# Read a single line (ending with \n) from a socket and return it.
-# We will strip out the \r and the \n in the process.
+# The content codings we can decode, advertised with every request.
 
-def get_line_from_socket(sock):
+ACCEPT_ENCODING = 'Accept-Encoding: gzip, deflate\r\n'
 
-    done = False
-    line = ''
-    while (not done):
-        char = sock.recv(1).decode()
-        if (char == '\r'):
-            pass
-        elif (char == '\n'):
-            done = True
-        else:
-            line = line + char
-    return line
+# Defaults for batch mode: how many files are downloaded at once, how many
+# requests are sent down a connection before waiting for the responses, how
+# long we wait on a server, and how many redirects we follow for one file.
+
+DEFAULT_CONCURRENCY = 4
+DEFAULT_PIPELINE = 4
+BATCH_TIMEOUT = 30
+MAX_REDIRECTS = 5
+
+# For segmented downloads: the smallest piece of a file worth fetching on its
+# own, how many pieces each connection should get on average so that faster
+# servers can take on more of them, and how many times a piece is tried
+# before the download is given up on.
+
+MIN_SEGMENT_SIZE = 1048576
+PIECES_PER_SEGMENT = 4
+SEGMENT_ATTEMPTS = 3
+
+# Raised when a file can't be downloaded, with a message saying why.
+
+class download_error(Exception):
+    pass
+
+# The validators for our downloads, read from VALIDATOR_FILE the first time
+# they are needed and kept in memory after that.  Batch mode downloads from
+# several threads at once, so the store is only changed by one of them at a
+# time, and it holds off writing the store back until the whole batch is
+# done rather than rewriting it after every file.
+
+validators = None
+validators_held = False
+validators_lock = threading.RLock()
+
+# A function for creating HTTP GET messages.
+
+def prepare_get_message(host, port, file_name, extra_headers=''):
+    request = f'GET {file_name} HTTP/1.1\r\nHost: {host}:{port}\r\n{extra_headers}\r\n' 
+    return request
 
 # Read a file from the socket and print it out.  (For errors primarily.)
 
-def print_file_from_socket(sock, bytes_to_read):
+def print_file_from_socket(reader, bytes_to_read):
 
-    bytes_read = 0
-    while (bytes_read < bytes_to_read):
-        chunk = sock.recv(BUFFER_SIZE)
-        bytes_read += len(chunk)
-        print(chunk.decode())
+    print(reader.read_body(bytes_to_read).decode())
 
 # Read a file from the socket and save it out.
 
-def save_file_from_socket(sock, bytes_to_read, file_name):
+def save_file_from_socket(reader, bytes_to_read, file_name, mode='wb', encoding=None):
 
-    with open(file_name, 'wb') as file_to_write:
-        bytes_read = 0
-        while (bytes_read < bytes_to_read):
-            chunk = sock.recv(BUFFER_SIZE)
-            bytes_read += len(chunk)
+    decoder = get_decoder(encoding)
+    with open(file_name, mode) as file_to_write:
+        for chunk in reader.read_body_chunks(bytes_to_read):
+            if (decoder != None):
+                chunk = decoder.decompress(chunk)
             file_to_write.write(chunk)
+        if (decoder != None):
+            file_to_write.write(decoder.flush())
+
+# Get a decoder for a response's content coding, or None if it wasn't
+# encoded at all.
+
+def get_decoder(encoding):
+    if (encoding == None) or (encoding == 'identity'):
+        return None
+    if (encoding == 'gzip'):
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if (encoding == 'deflate'):
+        return zlib.decompressobj()
+    raise download_error('The server sent the file with an unsupported encoding:  ' + encoding)
+
+# Print out a response's status line and headers.  (For errors primarily.)
+
+def print_head(response_line, headers):
+    print(response_line)
+    for name, value in headers.items():
+        print(name + ': ' + value)
+    print()
+
+# Load the validators we have stored for our downloads.  A missing or
+# damaged store just means we have nothing to revalidate with.
+
+def load_validators():
+    global validators
+    with validators_lock:
+        if (validators == None):
+            try:
+                with open(VALIDATOR_FILE) as store:
+                    validators = json.load(store)
+            except (OSError, ValueError):
+                validators = {}
+            if (not isinstance(validators, dict)):
+                validators = {}
+        return validators
+
+# Remember the validators a server sent along with a file, and the full
+# size of the file they belong to.  The store is written out straight away
+# unless it is being held for the end of a batch.
+
+def save_validators(file_name, headers, size):
+    with validators_lock:
+        load_validators()[file_name] = {'etag': headers.get('etag'), 'last_modified': headers.get('last-modified'), 'size': size}
+        if (not validators_held):
+            write_validators()
+
+# Write the validators we have in memory out to the store.
+
+def write_validators():
+    with validators_lock:
+        if (validators == None):
+            return
+        try:
+            with open(VALIDATOR_FILE, 'w') as store:
+                json.dump(validators, store, indent=1)
+        except OSError as e:
+            print('Error:  Could not save the validators:  ' + str(e))
+
+# Work out the conditional headers to send for a file we may already have.
+# If we have a complete copy we ask the server to send the file only if it
+# has changed since.  If we have part of a copy and are resuming, we ask for
+# the rest, but only if it still belongs to the same version of the file.
+# Returns the headers and the byte we expect the body to start at.
+
+def prepare_conditional_headers(file_name, resume):
+
+    if (not os.path.isfile(file_name)):
+        return '', 0
+    local_size = os.path.getsize(file_name)
+    validators = load_validators().get(file_name, {})
+
+    if (validators.get('size') == local_size):
+        extra_headers = ''
+        if (validators.get('etag') != None):
+            extra_headers = extra_headers + 'If-None-Match: ' + validators['etag'] + '\r\n'
+        if (validators.get('last_modified') != None):
+            extra_headers = extra_headers + 'If-Modified-Since: ' + validators['last_modified'] + '\r\n'
+        return extra_headers, 0
+
+    if (resume) and (local_size > 0):
+        extra_headers = 'Range: bytes=' + str(local_size) + '-\r\n'
+        if (validators.get('etag') != None):
+            extra_headers = extra_headers + 'If-Range: ' + validators['etag'] + '\r\n'
+        return extra_headers, local_size
+
+    return '', 0
+
+# Save the file carried by a successful response.  A 200 brings the whole
+# file, while a 206 brings the rest of a file we already have the start of,
+# so we add it onto the end.  A 416 tells us there was nothing left to get,
+# and a 304 tells us the copy we have is still current.  Returns a word
+# describing what happened, or raises a download_error if it went wrong.
+
+def receive_file(reader, code, headers, file_name, resume_from):
+
+    bytes_to_read = int(headers.get('content-length', '0'))
+
+    if (code == '304'):
+        print('Success:  The file has not changed since it was downloaded, so the local copy is up to date.')
+        return 'unchanged'
+
+    # The range we asked for starts past the end of the file.  That is fine
+    # if we already have all of it, but not if the file has since shrunk.
+
+    if (code == '416'):
+        reader.skip_body(bytes_to_read)
+        total = headers.get('content-range', '').rpartition('/')[2]
+        if (total == str(resume_from)):
+            print('Success:  The file has already been downloaded in full.')
+            return 'complete'
+        raise download_error('The local copy of the file no longer matches the server.  Download it again without --resume.')
+
+    # Make sure the server is carrying on from exactly where we left off.
+
+    if (code == '206'):
+        content_range = headers.get('content-range', '')
+        first = content_range.partition(' ')[2].partition('-')[0]
+        if (first != str(resume_from)):
+            raise download_error('The server sent an unexpected range:  ' + content_range)
+        print('Success:  Server is sending the rest of the file.  Resuming the download at byte ' + first + '.')
+        save_file_from_socket(reader, bytes_to_read, file_name, 'ab')
+        return 'resumed'
+
+    # We remember the validators up front so that an interrupted download
+    # can be resumed.  A compressed file can only be resumed from scratch,
+    # and we only know its real size once we have decoded it.
+
+    print('Success:  Server is sending file.  Downloading it now.')
+    encoding = headers.get('content-encoding')
+    if (encoding == None):
+        save_validators(file_name, headers, bytes_to_read)
+    save_file_from_socket(reader, bytes_to_read, file_name, 'wb', encoding)
+    if (encoding != None):
+        print('The file was sent with ' + encoding + ' encoding and has been decoded.')
+        save_validators(file_name, headers, os.path.getsize(file_name))
+    return 'downloaded'
+
+# Save the file carried by a successful response, and give up if that goes
+# wrong.
+
+def receive_file_or_exit(reader, code, headers, file_name, resume_from):
+    try:
+        receive_file(reader, code, headers, file_name, resume_from)
+    except download_error as e:
+        print('Error:  ' + str(e))
+        sys.exit(1)
+
+# Check a URL and make sure it's valid.  Returns the host, port and file
+# name, or raises a ValueError if it isn't of the form http://host:port/file.
+
+def parse_url(url):
+    parsed_url = urlparse(url)
+    if ((parsed_url.scheme != 'http') or (parsed_url.port == None) or (parsed_url.path == '') or (parsed_url.path == '/') or (parsed_url.hostname == None)):
+        raise ValueError
+    return parsed_url.hostname, parsed_url.port, parsed_url.path
+
+# Work out the name a file is saved under: the requested file name without
+# any leading /.
+
+def get_local_name(file_name):
+    local_name = file_name
+    while (local_name[0] == '/'):
+        local_name = local_name[1:]
+    return local_name
+
+# Work out where a redirect from the balancer points, which it gives as
+# host:port.  Returns the host and port, or None if they can't be made out.
+
+def parse_location(headers):
+    redirected_host, sep, redirected_port = headers.get('location', '').rpartition(':')
+    if ((sep == '') or (not redirected_port.isdigit())):
+        return None
+    return redirected_host, int(redirected_port)
+
+# Read the list of URLs for batch mode from a file, or standard input if the
+# name is -.  Each line is either a URL on its own or a JSON object with the
+# URL under "url".  Blank lines are skipped.
+
+def read_batch_urls(source):
+    stream = sys.stdin if (source == '-') else open(source)
+    urls = []
+    try:
+        for line in stream:
+            line = line.strip()
+            if (line == ''):
+                continue
+            if (line.startswith('{')):
+                line = json.loads(line).get('url', '')
+            urls.append(line)
+    finally:
+        if (stream is not sys.stdin):
+            stream.close()
+    return urls
+
+# One file to download in batch mode.  The host and port are where we are
+# getting it from now, which a redirect can change, while the Host header
+# always names the server from the URL.
+
+class batch_item:
+    def __init__(self, url, host, port, file_name):
+        self.url = url
+        self.origin = (host, port)
+        self.host = host
+        self.port = port
+        self.file_name = file_name
+        self.local_name = get_local_name(file_name)
+        self.redirects = 0
+        self.status = None
+        self.result = None
+
+# Handle one response in batch mode, which has just been read off a
+# connection for the given item.  The file is saved, the item is sent off to
+# where it has been redirected, or the error is noted.
+
+def receive_batch_response(reader, head, item, resume_from, work_queue):
+
+    response_line, headers = head
+    response_list = response_line.split(' ')
+    code = response_list[1] if (len(response_list) > 1) else ''
+    bytes_to_read = int(headers.get('content-length', '0'))
+    item.status = code
+
+    # A redirect is queued up to be fetched from its new home, on whichever
+    # connection to that server a worker has going.
+
+    if (code == '301'):
+        reader.skip_body(bytes_to_read)
+        target = parse_location(headers)
+        item.redirects = item.redirects + 1
+        if (target == None):
+            item.result = 'bad redirect to ' + headers.get('location', '')
+        elif (item.redirects > MAX_REDIRECTS):
+            item.result = 'too many redirects'
+        else:
+            item.host, item.port = target
+            work_queue.put([item])
+        return
+
+    if (code not in ('200', '206', '304', '416')):
+        reader.skip_body(bytes_to_read)
+        item.result = response_line
+        return
+
+    item.result = receive_file(reader, code, headers, item.local_name, resume_from)
+
+# Download a run of files from one server.  A new connection carries just
+# one request until the server has shown it will keep the connection open,
+# and after that all of the requests go down it together and the responses
+# are read back in order.  If the server closes or resets the connection
+# before answering them all, whatever is left is sent again on a new one.
+# Connections are kept in the worker's own dictionary, by server, for the
+# next run of files.
+
+def fetch_batch(items, connections, args, work_queue):
+
+    pending = list(items)
+    while (len(pending) > 0):
+        address = (pending[0].host, pending[0].port)
+        connection = connections.pop(address, None)
+        fresh = (connection == None)
+        try:
+            if (fresh):
+                sock = socket.create_connection(address, BATCH_TIMEOUT)
+                connection = (sock, socket_reader(sock))
+            sock, reader = connection
+            resume_from = []
+            message = ''
+            for item in (pending[:1] if fresh else pending):
+                extra_headers, start = prepare_conditional_headers(item.local_name, args.resume)
+                message = message + prepare_get_message(item.origin[0], item.origin[1], item.file_name, extra_headers + ACCEPT_ENCODING)
+                resume_from.append(start)
+            sock.sendall(message.encode())
+        except OSError as e:
+            if (connection != None):
+                connection[0].close()
+            if (not fresh):
+                continue
+            for item in pending:
+                item.result = 'could not connect: ' + str(e)
+            return
+
+        # Read the responses back in the order the requests went out.  A
+        # connection reset before a response has started is the server
+        # closing up on requests it never read, so those are tried again,
+        # but anything else that goes wrong is down to the file being read.
+
+        answered = 0
+        closed = False
+        receiving = False
+        try:
+            for item, start in zip(pending, resume_from):
+                receiving = False
+                head = reader.read_head()
+                if (head == None):
+                    closed = True
+                    break
+                receiving = True
+                receive_batch_response(reader, head, item, start, work_queue)
+                answered = answered + 1
+                if ('close' in head[1].get('connection', '').lower()):
+                    closed = True
+                    break
+        except (OSError, http_error, download_error, ValueError) as e:
+            if (receiving) or (not isinstance(e, ConnectionError)):
+                pending[answered].result = 'failed: ' + str(e)
+                answered = answered + 1
+            closed = True
+
+        # A connection that has just been opened and answered nothing is
+        # no use to the first file, so we give up on it rather than retry
+        # for ever.
+
+        if (fresh) and (answered == 0):
+            pending[0].result = 'server closed the connection without responding'
+            answered = 1
+        if (closed):
+            sock.close()
+        else:
+            connections[address] = connection
+        pending = pending[answered:]
+
+# Worker thread body for batch mode.  Each worker takes runs of files off the
+# shared queue until it is told to stop, then closes its connections.
+
+def batch_worker(work_queue, args):
+    connections = {}
+    while True:
+        items = work_queue.get()
+        if (items == None):
+            break
+        fetch_batch(items, connections, args, work_queue)
+        work_queue.task_done()
+    for sock, reader in connections.values():
+        sock.close()
+
+# Download every file in the list with several workers at once.  The files
+# are grouped by server into runs of up to the pipeline depth, so that each
+# run can share one connection.  Finishes with a summary of how each file
+# went, and exits with an error if any of them failed.
+
+def run_batch(args):
+
+    global validators_held
+    try:
+        urls = read_batch_urls(args.batch)
+    except (OSError, ValueError, AttributeError) as e:
+        print('Error:  Could not read the list of URLs:  ' + str(e))
+        sys.exit(1)
+
+    items = []
+    bad_urls = []
+    for url in urls:
+        try:
+            host, port, file_name = parse_url(url)
+            items.append(batch_item(url, host, port, file_name))
+        except ValueError:
+            bad_urls.append(url)
+
+    by_server = {}
+    for item in items:
+        by_server.setdefault((item.host, item.port), []).append(item)
+    work_queue = queue.Queue()
+    depth = max(args.pipeline, 1)
+    for server_items in by_server.values():
+        for i in range(0, len(server_items), depth):
+            work_queue.put(server_items[i:i + depth])
+
+    # The validators are written out once, when the batch is over, however
+    # it ends.
+
+    validators_held = True
+    start_time = time.perf_counter()
+    try:
+        workers = [threading.Thread(target=batch_worker, args=(work_queue, args), daemon=True) for i in range(max(args.concurrency, 1))]
+        for worker in workers:
+            worker.start()
+        work_queue.join()
+        for worker in workers:
+            work_queue.put(None)
+        for worker in workers:
+            worker.join()
+    finally:
+        write_validators()
+    elapsed = time.perf_counter() - start_time
+
+    # Summarise how every file went.
+
+    print('\nBatch summary:')
+    failures = len(bad_urls)
+    for url in bad_urls:
+        print('  ' + f'{"-":<4} {"invalid URL":<40} ' + url)
+    for item in items:
+        ok = item.result in ('downloaded', 'resumed', 'unchanged', 'complete')
+        if (not ok):
+            failures = failures + 1
+        print('  ' + f'{item.status or "-":<4} {item.result or "not fetched":<40} ' + item.url)
+    print(str(len(urls) - failures) + ' of ' + str(len(urls)) + ' files fetched successfully in ' + f'{elapsed:.2f}' + ' seconds.')
+    if (failures > 0):
+        sys.exit(1)
+
+# Ask for the first byte of a file, to learn how big it is and whether the
+# server will send it in parts.  Redirects are not followed.  Returns the
+# status code and headers of the response.
+
+def probe_file(address, origin, file_name, extra_headers):
+    sock = socket.create_connection(address, BATCH_TIMEOUT)
+    try:
+        reader = socket_reader(sock)
+        message = prepare_get_message(origin[0], origin[1], file_name, extra_headers + 'Range: bytes=0-0\r\nConnection: close\r\n')
+        sock.sendall(message.encode())
+        head = reader.read_head()
+        if (head == None):
+            raise download_error('The server closed the connection without responding.')
+        response_line, headers = head
+        reader.skip_body(int(headers.get('content-length', '0')))
+    finally:
+        sock.close()
+    response_list = response_line.split(' ')
+    return (response_list[1] if (len(response_list) > 1) else ''), headers
+
+# Find the servers to download a file from.  A server answers the probe
+# itself, but the balancer in redirect mode names a server instead, so we
+# ask it several times to collect as many different servers as it will give
+# us, and then probe each of those.  Every server keeps its own copy of the
+# file, and pieces of different versions must never be put together, so only
+# servers whose validator is the same as the first one's are used.  Without a
+# validator to compare, we stick to the first server.  Returns the servers
+# with their validators, and the code and headers of the first one's answer.
+
+def find_sources(host, port, file_name, count, extra_headers):
+    code, headers = probe_file((host, port), (host, port), file_name, extra_headers)
+    if (code != '301'):
+        return [((host, port), headers.get('etag'))], code, headers
+    targets = []
+    for i in range(count):
+        if (i > 0):
+            code, headers = probe_file((host, port), (host, port), file_name, extra_headers)
+        target = parse_location(headers) if (code == '301') else None
+        if (target == None):
+            break
+        if (target not in targets):
+            targets.append(target)
+    if (len(targets) == 0):
+        raise download_error('The balancer sent a bad redirect to ' + headers.get('location', ''))
+    code, headers = probe_file(targets[0], (host, port), file_name, extra_headers)
+    validator = headers.get('etag')
+    sources = [(targets[0], validator)]
+    size = headers.get('content-range', '').rpartition('/')[2]
+    for target in (targets[1:] if (code == '206') and (validator != None) else []):
+        try:
+            other_code, other_headers = probe_file(target, (host, port), file_name, '')
+        except (OSError, http_error, download_error, ValueError) as e:
+            print('Leaving out server ' + target[0] + ':' + str(target[1]) + ', which could not be probed:  ' + str(e))
+            continue
+        if (other_code != '206') or (other_headers.get('content-range', '').rpartition('/')[2] != size) or (other_headers.get('etag') != validator):
+            print('Leaving out server ' + target[0] + ':' + str(target[1]) + ', which has a different version of the file.')
+            continue
+        sources.append((target, validator))
+    print('The load balancer is redirecting this request to ' + str(len(sources)) + ' server(s):  ' + ', '.join(h + ':' + str(p) for (h, p), validator in sources))
+    return sources, code, headers
+
+# A piece of the file still to be fetched: the next byte we need and the last
+# byte of the piece.  start moves along as bytes arrive, so a piece that is
+# tried again only asks for what it is still missing.
+
+class segment:
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+        self.attempts = 0
+
+# How a segmented download is going, shared by the threads doing it: the
+# bytes received from each server, and why the download failed, if it has.
+
+class segment_progress:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.received = {}
+        self.failure = None
+
+    def add(self, source, count):
+        with self.lock:
+            self.received[source] = self.received.get(source, 0) + count
+
+# Fetch one piece of the file down an open connection, writing it straight
+# into its place in the output file.  The If-Range header, with the server's
+# own validator, makes sure every piece from it comes from the version of the
+# file we probed.  Returns whether the server
+# will keep the connection open.
+
+def fetch_segment(connection, source, piece, origin, file_name, validator, output, progress):
+    sock, reader = connection
+    extra_headers = 'Range: bytes=' + str(piece.start) + '-' + str(piece.end) + '\r\n'
+    if (validator != None):
+        extra_headers = extra_headers + 'If-Range: ' + validator + '\r\n'
+    sock.sendall(prepare_get_message(origin[0], origin[1], file_name, extra_headers).encode())
+    head = reader.read_head()
+    if (head == None):
+        raise ConnectionError('The server closed the connection without responding')
+    response_line, headers = head
+    content_range = headers.get('content-range', '')
+    expected = 'bytes ' + str(piece.start) + '-' + str(piece.end) + '/'
+    if (response_line.split(' ')[1:2] != ['206']) or (not content_range.startswith(expected)):
+        raise download_error('Expected ' + expected + '... but the server answered ' + response_line + ' ' + content_range)
+    output.seek(piece.start)
+    for chunk in reader.read_body_chunks(int(headers.get('content-length', '0'))):
+        output.write(chunk)
+        piece.start += len(chunk)
+        progress.add(source, len(chunk))
+    return 'close' not in headers.get('connection', '').lower()
+
+# Thread body for a segmented download.  Each thread keeps one connection to
+# a server open and works through pieces from the shared queue.  When a piece
+# fails, the rest of it goes back on the queue and this thread moves on to the
+# next server, so a broken server only costs a retry.  A piece that fails too
+# often fails the whole download, and so does anything we didn't expect, but
+# every piece taken off the queue is always marked done so that the download
+# never waits for ever.
+
+def segment_worker(work_queue, sources, first_source, origin, file_name, part_name, progress):
+    source_index = first_source
+    connection = None
+    output = None
+    try:
+        output = open(part_name, 'r+b')
+    except OSError as e:
+        progress.failure = 'Could not open ' + part_name + ':  ' + str(e)
+    while True:
+        piece = work_queue.get()
+        if (piece == None):
+            break
+        if (progress.failure == None):
+            source, validator = sources[source_index % len(sources)]
+            try:
+                if (connection == None):
+                    sock = socket.create_connection(source, BATCH_TIMEOUT)
+                    connection = (sock, socket_reader(sock))
+                if (not fetch_segment(connection, source, piece, origin, file_name, validator, output, progress)):
+                    connection[0].close()
+                    connection = None
+            except (OSError, http_error, download_error) as e:
+                if (connection != None):
+                    connection[0].close()
+                    connection = None
+                source_index += 1
+                piece.attempts += 1
+                if (piece.attempts < SEGMENT_ATTEMPTS):
+                    work_queue.put(piece)
+                else:
+                    progress.failure = 'Bytes ' + str(piece.start) + '-' + str(piece.end) + ' could not be fetched:  ' + str(e)
+            except Exception as e:
+                if (connection != None):
+                    connection[0].close()
+                    connection = None
+                progress.failure = 'Bytes ' + str(piece.start) + '-' + str(piece.end) + ' could not be fetched:  ' + repr(e)
+        work_queue.task_done()
+    if (connection != None):
+        connection[0].close()
+    if (output != None):
+        output.close()
+
+# Download a file in pieces over several connections at once, possibly from
+# several servers, to make use of more bandwidth than one connection gets.
+# The pieces are written straight into a file of the right size, which is
+# only put in place of the local copy once every piece has arrived.  Returns
+# False if the server won't send the file in parts, in which case the caller
+# should download it the usual way.
+
+def download_segmented(host, port, file_name, local_name, segments):
+
+    extra_headers, resume_from = prepare_conditional_headers(local_name, False)
+    sources, code, headers = find_sources(host, port, file_name, segments, extra_headers)
+    if (code == '304'):
+        print('Success:  The file has not changed since it was downloaded, so the local copy is up to date.')
+        return True
+    size = headers.get('content-range', '').rpartition('/')[2]
+    if (code != '206') or (not size.isdigit()):
+        return False
+
+    # Split the file into more pieces than we have connections, so that a
+    # faster server ends up sending more of it.
+
+    size = int(size)
+    segments = max(1, min(segments, size // MIN_SEGMENT_SIZE))
+    piece_size = max(MIN_SEGMENT_SIZE, -(-size // (segments * PIECES_PER_SEGMENT)))
+    work_queue = queue.Queue()
+    for start in range(0, size, piece_size):
+        work_queue.put(segment(start, min(start + piece_size, size) - 1))
+    print('Success:  Server is sending file.  Downloading ' + str(size) + ' bytes over ' + str(segments) + ' connection(s) now.')
+
+    # Set aside room for the whole file up front, so the pieces can be
+    # written wherever they belong as they arrive.
+
+    part_name = local_name + '.part'
+    with open(part_name, 'wb') as output:
+        output.truncate(size)
+        if (hasattr(os, 'posix_fallocate')):
+            try:
+                os.posix_fallocate(output.fileno(), 0, size)
+            except OSError:
+                pass
+
+    progress = segment_progress()
+    start_time = time.perf_counter()
+    workers = [threading.Thread(target=segment_worker, args=(work_queue, sources, i, (host, port), file_name, part_name, progress), daemon=True) for i in range(segments)]
+    for worker in workers:
+        worker.start()
+    work_queue.join()
+    for worker in workers:
+        work_queue.put(None)
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start_time
+
+    if (progress.failure != None):
+        os.remove(part_name)
+        raise download_error(progress.failure)
+    os.replace(part_name, local_name)
+    save_validators(local_name, headers, size)
+    print('Downloaded ' + str(size) + ' bytes in ' + f'{elapsed:.2f}' + ' seconds (' + f'{size / max(elapsed, 0.000001) / 1000000:.1f}' + ' MB/s).')
+    for (source_host, source_port), count in progress.received.items():
+        print('  ' + source_host + ':' + str(source_port) + ' sent ' + str(count) + ' bytes')
+    return True
 
 # Our main function.
 
 def main():
 
-    # Check command line arguments to retrieve a URL.
+    # Check command line arguments to retrieve a URL, or a list of them.
 
     parser = argparse.ArgumentParser()
-    parser.add_argument("url", help="URL to fetch with an HTTP GET request")
+    parser.add_argument("url", nargs='?', help="URL to fetch with an HTTP GET request")
+    parser.add_argument("--resume", action="store_true", help="Continue a partial download of the file from where it stopped")
+    parser.add_argument("--batch", metavar="FILE", help="Fetch every URL listed in FILE, or on standard input if FILE is -")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY, help="Number of files fetched at once in batch mode")
+    parser.add_argument("--pipeline", type=int, default=DEFAULT_PIPELINE, help="Number of requests sent down a connection at once in batch mode")
+    parser.add_argument("--segments", type=int, default=1, help="Download the file in parts over this many connections at once")
     args = parser.parse_args()
 
+    if (args.batch != None):
+        run_batch(args)
+        return
+    if (args.url == None):
+        parser.error('a URL or --batch is required')
+
     # Check the URL passed in and make sure it's valid.  If so, keep track of
     # things for later.
 
     try:
-        parsed_url = urlparse(args.url)
-        if ((parsed_url.scheme != 'http') or (parsed_url.port == None) or (parsed_url.path == '') or (parsed_url.path == '/') or (parsed_url.hostname == None)):
-            raise ValueError
-        host = parsed_url.hostname
-        port = parsed_url.port
-        file_name = parsed_url.path
+        host, port, file_name = parse_url(args.url)
     except ValueError:
         print('Error:  Invalid URL.  Enter a URL of the form:  http://host:port/file')
         sys.exit(1)
 
+    # If requested file begins with a / we strip it off to get the name we
+    # save it under.
+
+    local_name = get_local_name(file_name)
+
+    # A segmented download fetches the whole file in parts.  If the server
+    # won't send parts we carry on and download it in one go.
+
+    if (args.segments > 1):
+        try:
+            if (download_segmented(host, port, file_name, local_name, args.segments)):
+                return
+        except (download_error, http_error, OSError, ValueError) as e:
+            print('Error:  ' + str(e))
+            sys.exit(1)
+        print('The server will not send the file in parts, so downloading it in one piece.')
+
+    # If we already have the file, or part of it, we only ask for what we
+    # don't have yet.
+
+    extra_headers, resume_from = prepare_conditional_headers(local_name, args.resume)
+    extra_headers = extra_headers + ACCEPT_ENCODING
+
     # Now we try to make a connection to the server.
 
     print('Connecting to server ...')
@@ -89,31 +771,27 @@ def main():
     # The connection was successful, so we can prep and send our message.
     
     print('Connection to server established. Sending message...\n')
-    message = prepare_get_message(host, port, file_name)
+    message = prepare_get_message(host, port, file_name, extra_headers)
     client_socket.send(message.encode())
    
     # Receive the response from the server and start taking a look at it
 
-    response_line = get_line_from_socket(client_socket)
+    reader = socket_reader(client_socket)
+    head = reader.read_head()
+    if (head == None):
+        print('Error:  The server closed the connection without responding.')
+        sys.exit(1)
+    response_line, headers = head
     response_list = response_line.split(' ')
-    headers_done = False
+    bytes_to_read = int(headers.get('content-length', '0'))
         
     # If an error is returned from the server, we dump everything sent and
     # exit right away.  
     
-    if response_list[1] != '200' and response_list[1] != '301':
+    if response_list[1] not in ('200', '206', '301', '304', '416'):
         print('Error:  An error response was received from the server.  Details:\n')
-        print(response_line);
-        bytes_to_read = 0
-        while (not headers_done):
-            header_line = get_line_from_socket(client_socket)
-            print(header_line)
-            header_list = header_line.split(' ')
-            if (header_line == ''):
-                headers_done = True
-            elif (header_list[0] == 'Content-Length:'):
-                bytes_to_read = int(header_list[1])
-        print_file_from_socket(client_socket, bytes_to_read)
+        print_head(response_line, headers)
+        print_file_from_socket(reader, bytes_to_read)
         sys.exit(1)
            
     # If it's Moved Permanentely, we retrieve the request and excract the address from the Location header
@@ -121,21 +799,9 @@ def main():
     if response_list[1] == '301':
 
         print('Redirected: server is sending redirection information. Downloading it now.')
-        print(response_line);
-        bytes_to_read = 0
-        string_address = ''
-        while (not headers_done):
-            header_line = get_line_from_socket(client_socket)
-            print(header_line)
-            header_list = header_line.split(' ')
-            if (header_line == ''):
-                headers_done = True
-            elif (header_list[0] == 'Content-Length:'):
-                bytes_to_read = int(header_list[1])
-            elif (header_list[0] == 'Location:'):
-                string_address = string_address + header_list[1]
-            
-        print_file_from_socket(client_socket, bytes_to_read)
+        print_head(response_line, headers)
+        string_address = headers.get('location', '')
+        print_file_from_socket(reader, bytes_to_read)
         print("The Load balancer is redirecting this request to server " + string_address)
 
         # First we will extract the host string and port integer from string_address
@@ -157,31 +823,27 @@ def main():
         # The connection was successful, so we can prep and send our message.
     
         print('Connection to server established. Sending message...\n')
-        message = prepare_get_message(host, port, file_name)
+        message = prepare_get_message(host, port, file_name, extra_headers)
         client_socket.send(message.encode())
     
         # Receive the response from the server and start taking a look at it
 
-        response_line = get_line_from_socket(client_socket)
+        reader = socket_reader(client_socket)
+        head = reader.read_head()
+        if (head == None):
+            print('Error:  The server closed the connection without responding.')
+            sys.exit(1)
+        response_line, headers = head
         response_list = response_line.split(' ')
-        headers_done = False
+        bytes_to_read = int(headers.get('content-length', '0'))
 
         # If an error is returned from the server, we dump everything sent and
         # exit right away.  
         
-        if response_list[1] != '200':
+        if response_list[1] not in ('200', '206', '304', '416'):
             print('Error:  An error response was received from the server.  Details:\n')
-            print(response_line);
-            bytes_to_read = 0
-            while (not headers_done):
-                header_line = get_line_from_socket(client_socket)
-                print(header_line)
-                header_list = header_line.split(' ')
-                if (header_line == ''):
-                    headers_done = True
-                elif (header_list[0] == 'Content-Length:'):
-                    bytes_to_read = int(header_list[1])
-            print_file_from_socket(client_socket, bytes_to_read)
+            print_head(response_line, headers)
+            print_file_from_socket(reader, bytes_to_read)
             sys.exit(1)
             
         
@@ -189,24 +851,7 @@ def main():
 
         else:
 
-            print('Success:  Server is sending file.  Downloading it now.')
-
-            # If requested file begins with a / we strip it off.
-
-            while (file_name[0] == '/'):
-                file_name = file_name[1:]
-
-            # Go through headers and find the size of the file, then save it.
-    
-            bytes_to_read = 0
-            while (not headers_done):
-                header_line = get_line_from_socket(client_socket)
-                header_list = header_line.split(' ')
-                if (header_line == ''):
-                    headers_done = True
-                elif (header_list[0] == 'Content-Length:'):
-                    bytes_to_read = int(header_list[1])
-            save_file_from_socket(client_socket, bytes_to_read, file_name)
+            receive_file_or_exit(reader, response_list[1], headers, local_name, resume_from)
 
         sys.exit(1)
     
@@ -214,24 +859,7 @@ def main():
 
     else:
 
-        print('Success:  Server is sending file.  Downloading it now.')
-
-        # If requested file begins with a / we strip it off.
-
-        while (file_name[0] == '/'):
-            file_name = file_name[1:]
-
-        # Go through headers and find the size of the file, then save it.
-   
-        bytes_to_read = 0
-        while (not headers_done):
-            header_line = get_line_from_socket(client_socket)
-            header_list = header_line.split(' ')
-            if (header_line == ''):
-                headers_done = True
-            elif (header_list[0] == 'Content-Length:'):
-                bytes_to_read = int(header_list[1])
-        save_file_from_socket(client_socket, bytes_to_read, file_name)
+        receive_file_or_exit(reader, response_list[1], headers, local_name, resume_from)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,464 @@
+import socket
+import os
+import sys
+import argparse
+import json
+import random
+import threading
+import queue
+import time
+import itertools
+import collections
+
+# Load generator for the server and balancer.  It sends requests the same way
+# the client does, but throws the bodies away and times each one instead,
+# split into the time to connect, the time until the first byte of the
+# response arrives, and the time to transfer the rest.
+#
+# Requests are either replayed from a trace, a file of URLs like the one the
+# client's batch mode takes, or made up from a list of URLs picked at random.
+# Traffic can be closed-loop, a fixed number of users who each send a request,
+# wait for the answer and go again, or open-loop, requests sent at a set rate
+# whether or not earlier ones have been answered.  Closed-loop traffic slows
+# down along with the servers, which hides how long a real user would wait
+# once they fall behind, so in open-loop mode a request's total time is
+# counted from when it was due to be sent rather than when it actually was.
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from client import parse_url, prepare_get_message, ACCEPT_ENCODING, MAX_REDIRECTS
+from httputil import socket_reader, http_error
+
+# Defaults: how many requests to send, how many users send them in closed-loop
+# mode, and how many threads are on hand to send them in open-loop mode.
+
+DEFAULT_REQUESTS = 1000
+DEFAULT_USERS = 10
+DEFAULT_OPEN_LOOP_WORKERS = 100
+
+# Seconds we wait on a server before counting the request as failed.
+
+REQUEST_TIMEOUT = 30
+
+# The phases of a request we time, in the order they happen.  In open-loop
+# mode we also time how long each request waited to be sent.
+
+PHASES = ('connect', 'first_byte', 'transfer', 'total')
+OPEN_LOOP_PHASES = ('wait',) + PHASES
+
+# Latency histogram buckets, in seconds: each one twice as wide as the one
+# before, from a tenth of a millisecond up to about a minute.
+
+HISTOGRAM_BOUNDS = [0.0001 * 2 ** i for i in range(20)]
+
+# Read a request trace from a file, or standard input if the name is -.  Each
+# line is a URL, or a JSON object with the URL under "url" and, optionally,
+# the time in seconds from the start of the trace it was sent at under
+# "time".  Returns a list of (url, time) pairs, with None where there is no
+# time, in which case a replay sends it along with the request before.
+
+def read_trace(source):
+    stream = sys.stdin if (source == '-') else open(source)
+    trace = []
+    try:
+        for line in stream:
+            line = line.strip()
+            if (line == ''):
+                continue
+            if (line.startswith('{')):
+                entry = json.loads(line)
+                trace.append((entry.get('url', ''), entry.get('time')))
+            else:
+                trace.append((line, None))
+    finally:
+        if (stream is not sys.stdin):
+            stream.close()
+    return trace
+
+# Where requests come from.  URLs are checked up front, so a typo shows up
+# before the run rather than as a run full of errors.  A trace is worked
+# through in order, starting over at the top if it runs out, while made up
+# traffic picks from its URLs at random.  With a skew above 0 the picks
+# follow a Zipf distribution, so the first URLs are much more popular than
+# the last, the way real traffic tends to be.
+
+class request_source:
+    def __init__(self, urls, trace=False, skew=0, seed=None):
+        self.targets = [parse_url(url) for url in urls]
+        self.trace = trace
+        self.lock = threading.Lock()
+        self.position = itertools.count()
+        self.rng = random.Random(seed)
+        self.weights = [1 / (rank + 1) ** skew for rank in range(len(self.targets))]
+
+    # Return the host, port and file name for the next request.
+
+    def next_target(self):
+        with self.lock:
+            if (self.trace):
+                return self.targets[next(self.position) % len(self.targets)]
+            return self.rng.choices(self.targets, self.weights)[0]
+
+# Everything we measure during a run.  Worker threads record each request as
+# it finishes, and summary() turns the lot into the figures we report.
+
+class load_results:
+    def __init__(self, phases):
+        self.lock = threading.Lock()
+        self.phases = phases
+        self.samples = {phase: [] for phase in phases}
+        self.statuses = collections.Counter()
+        self.errors = collections.Counter()
+        self.bytes = 0
+        self.sent = 0
+        self.redirects = 0
+
+    # Record a request that was answered.
+
+    def record(self, timings, status, size, redirects):
+        with self.lock:
+            self.sent += 1
+            for phase in self.phases:
+                self.samples[phase].append(timings.get(phase, 0.0))
+            self.statuses[status] += 1
+            self.bytes += size
+            self.redirects += redirects
+
+    # Record a request that failed, by the kind of thing that went wrong.
+
+    def record_error(self, kind):
+        with self.lock:
+            self.sent += 1
+            self.errors[kind] += 1
+
+    # Work out throughput, percentiles and histograms for a run that took
+    # elapsed seconds.  Times are reported in milliseconds.
+
+    def summary(self, elapsed):
+        with self.lock:
+            completed = sum(self.statuses.values())
+            result = {
+                'elapsed': elapsed,
+                'sent': self.sent,
+                'completed': completed,
+                'errors': sum(self.errors.values()),
+                'error_kinds': dict(self.errors),
+                'statuses': {str(code): count for code, count in sorted(self.statuses.items())},
+                'redirects': self.redirects,
+                'bytes': self.bytes,
+                'throughput': completed / elapsed if (elapsed > 0) else 0.0,
+                'bytes_per_second': self.bytes / elapsed if (elapsed > 0) else 0.0,
+                'phases': {},
+            }
+            for phase in self.phases:
+                values = sorted(self.samples[phase])
+                result['phases'][phase] = summarise_latencies(values)
+        return result
+
+# Return the given percentile of a sorted list.
+
+def percentile(values, fraction):
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+# Summarise a sorted list of times in seconds: the mean, percentiles and
+# largest in milliseconds, and how many fell into each histogram bucket.
+# The last bucket, with no upper bound, catches anything slower.
+
+def summarise_latencies(values):
+    if (len(values) == 0):
+        return {'count': 0}
+    counts = [0] * (len(HISTOGRAM_BOUNDS) + 1)
+    bucket = 0
+    for value in values:
+        while (bucket < len(HISTOGRAM_BOUNDS)) and (value > HISTOGRAM_BOUNDS[bucket]):
+            bucket += 1
+        counts[bucket] += 1
+    return {
+        'count': len(values),
+        'mean': 1000 * sum(values) / len(values),
+        'p50': 1000 * percentile(values, 0.5),
+        'p90': 1000 * percentile(values, 0.9),
+        'p99': 1000 * percentile(values, 0.99),
+        'p999': 1000 * percentile(values, 0.999),
+        'max': 1000 * values[-1],
+        'histogram': [[1000 * bound if (bound != None) else None, count] for bound, count in zip(HISTOGRAM_BOUNDS + [None], counts) if (count > 0)],
+    }
+
+# Send one request and time it, reading and discarding the response.  With
+# keep-alive, connections are taken from and put back in the caller's
+# dictionary, by server; a reused connection the server has since closed is
+# replaced with a new one.  When following redirects, the times for every hop
+# are added together.  Returns the timings, the final status code, the bytes
+# of body received and the number of redirects followed.
+
+def timed_request(target, connections, args):
+
+    origin_host, origin_port, file_name = target
+    host, port = origin_host, origin_port
+    extra_headers = ACCEPT_ENCODING if (args.compressed) else ''
+    if (not args.keep_alive):
+        extra_headers = extra_headers + 'Connection: close\r\n'
+    message = prepare_get_message(origin_host, origin_port, file_name, extra_headers).encode()
+    timings = {'connect': 0.0, 'first_byte': 0.0, 'transfer': 0.0}
+    size = 0
+    redirects = 0
+
+    while True:
+        connection = connections.pop((host, port), None)
+        reused = (connection != None)
+        start = time.perf_counter()
+        if (not reused):
+            sock = socket.create_connection((host, port), REQUEST_TIMEOUT)
+            connection = (sock, socket_reader(sock))
+        sock, reader = connection
+        connected = time.perf_counter()
+
+        # The first byte of the response is the first thing to arrive after
+        # we send the request, since we always read whole responses.
+
+        try:
+            sock.sendall(message)
+            arrived = (reader.buffered() > 0) or reader.fill()
+            first_byte = time.perf_counter()
+            head = reader.read_head() if (arrived) else None
+            if (head == None):
+                sock.close()
+                if (reused):
+                    continue
+                raise ConnectionError('Server closed the connection without responding')
+            response_line, headers = head
+            bytes_to_read = int(headers.get('content-length', '0'))
+            reader.skip_body(bytes_to_read)
+        except BaseException:
+            sock.close()
+            raise
+        finished = time.perf_counter()
+
+        timings['connect'] += connected - start
+        timings['first_byte'] += first_byte - connected
+        timings['transfer'] += finished - first_byte
+        size += bytes_to_read
+        if (args.keep_alive) and ('close' not in headers.get('connection', '').lower()):
+            connections[(host, port)] = connection
+        else:
+            sock.close()
+
+        # The balancer's redirects name the server as host:port.
+
+        status = response_line.split(' ')[1] if (' ' in response_line) else ''
+        if (status != '301') or (not args.follow_redirects) or (redirects >= MAX_REDIRECTS):
+            return timings, status, size, redirects
+        redirected_host, sep, redirected_port = headers.get('location', '').rpartition(':')
+        if ((sep == '') or (not redirected_port.isdigit())):
+            raise http_error('Bad redirect to ' + headers.get('location', ''))
+        host, port = redirected_host, int(redirected_port)
+        redirects += 1
+
+# Send one request and record how it went.  due is when the request should
+# have been sent, which in open-loop mode can be a while before a thread got
+# round to it; its total time is counted from then.
+
+def run_request(target, due, connections, results, args):
+    try:
+        started = time.perf_counter()
+        timings, status, size, redirects = timed_request(target, connections, args)
+        timings['wait'] = started - due
+        timings['total'] = time.perf_counter() - due
+        results.record(timings, status, size, redirects)
+    except socket.timeout:
+        results.record_error('timeout')
+    except (OSError, http_error, ValueError) as e:
+        results.record_error(type(e).__name__)
+
+# Close every connection a thread has kept open.
+
+def close_connections(connections):
+    for sock, reader in connections.values():
+        sock.close()
+    connections.clear()
+
+# Closed-loop traffic: each user sends a request, waits for the response,
+# pauses for the think time and goes again, until the run is over.
+
+def run_closed_loop(source, results, args, stop_time):
+    tickets = itertools.count()
+    tickets_lock = threading.Lock()
+
+    def user():
+        connections = {}
+        while True:
+            with tickets_lock:
+                ticket = next(tickets)
+            if (args.duration == None) and (ticket >= args.requests):
+                break
+            if (args.duration != None) and (time.perf_counter() >= stop_time):
+                break
+            run_request(source.next_target(), time.perf_counter(), connections, results, args)
+            if (args.think_time > 0):
+                time.sleep(args.think_time)
+        close_connections(connections)
+
+    users = [threading.Thread(target=user, daemon=True) for i in range(max(args.users, 1))]
+    for thread in users:
+        thread.start()
+    for thread in users:
+        thread.join()
+
+# Open-loop traffic: requests are due at random with an average of rate a
+# second, the way requests from many independent users arrive, or at the
+# times recorded in the trace when replaying it.  A pool of threads sends
+# each request once it is due.  If they all fall behind, requests queue up
+# and their wait counts against them.
+
+def run_open_loop(source, results, args, start_time, stop_time, schedule):
+    work_queue = queue.Queue()
+
+    def worker():
+        connections = {}
+        while True:
+            item = work_queue.get()
+            if (item == None):
+                break
+            due, target = item
+            run_request(target, due, connections, results, args)
+        close_connections(connections)
+
+    workers = [threading.Thread(target=worker, daemon=True) for i in range(max(args.max_workers, 1))]
+    for thread in workers:
+        thread.start()
+
+    rng = random.Random(args.seed)
+    due = start_time
+    for count in itertools.count():
+        if (schedule != None):
+            if (count >= len(schedule)):
+                break
+            due = start_time + schedule[count] / args.speedup
+        else:
+            due = due + rng.expovariate(args.rate)
+        if (schedule == None) and (args.duration == None) and (count >= args.requests):
+            break
+        if (args.duration != None) and (due >= stop_time):
+            break
+        delay = due - time.perf_counter()
+        if (delay > 0):
+            time.sleep(delay)
+        work_queue.put((due, source.next_target()))
+
+    for thread in workers:
+        work_queue.put(None)
+    for thread in workers:
+        thread.join()
+
+# Run the load described by the parsed options and return the summary of how
+# it went, with the options used alongside so runs can be compared later.
+
+def run_load(args):
+
+    schedule = None
+    if (args.trace != None):
+        trace = read_trace(args.trace)
+        source = request_source([url for url, at in trace], trace=True)
+        if (args.replay):
+            schedule = list(itertools.accumulate((at if (at != None) else 0 for url, at in trace), max))
+    else:
+        source = request_source(args.url, skew=args.skew, seed=args.seed)
+    if (len(source.targets) == 0):
+        raise ValueError('No URLs to request')
+
+    open_loop = (args.rate != None) or (schedule != None)
+    results = load_results(OPEN_LOOP_PHASES if (open_loop) else PHASES)
+    start_time = time.perf_counter()
+    stop_time = start_time + args.duration if (args.duration != None) else None
+    if (open_loop):
+        run_open_loop(source, results, args, start_time, stop_time, schedule)
+    else:
+        run_closed_loop(source, results, args, stop_time)
+    summary = results.summary(time.perf_counter() - start_time)
+    summary['mode'] = 'open-loop' if (open_loop) else 'closed-loop'
+    summary['options'] = {name: value for name, value in vars(args).items() if (name != 'json')}
+    return summary
+
+# Print a run's summary: the counts, then a table of latencies by phase, then
+# a histogram of total latency.
+
+def print_summary(summary):
+
+    print(summary['mode'] + ':  ' + str(summary['sent']) + ' requests sent, ' + str(summary['completed']) + ' answered, ' + str(summary['errors']) + ' failed in ' + f'{summary["elapsed"]:.2f}' + ' seconds')
+    print(f'Throughput:  {summary["throughput"]:.1f} requests/s, {summary["bytes_per_second"] / 1000000:.2f} MB/s')
+    if (summary['redirects'] > 0):
+        print('Redirects followed:  ' + str(summary['redirects']))
+    print('Status codes:  ' + (', '.join(code + ' x ' + str(count) for code, count in summary['statuses'].items()) or 'none'))
+    if (summary['errors'] > 0):
+        print('Errors:  ' + ', '.join(kind + ' x ' + str(count) for kind, count in summary['error_kinds'].items()))
+
+    print()
+    print(f'{"phase":<12}{"mean ms":>10}{"p50 ms":>10}{"p90 ms":>10}{"p99 ms":>10}{"p99.9 ms":>10}{"max ms":>10}')
+    for phase, figures in summary['phases'].items():
+        if (figures['count'] == 0):
+            continue
+        print(f'{phase:<12}' + ''.join(f'{figures[x]:10.2f}' for x in ('mean', 'p50', 'p90', 'p99', 'p999', 'max')))
+
+    total = summary['phases']['total']
+    if (total['count'] == 0):
+        return
+    print()
+    print('Total latency histogram:')
+    largest = max(count for bound, count in total['histogram'])
+    for bound, count in total['histogram']:
+        label = ('<= ' + f'{bound:.1f}' + ' ms') if (bound != None) else 'slower'
+        print(f'  {label:>14} {count:8}  ' + '#' * max(1, round(40 * count / largest)))
+
+# Build the command line parser, which the benchmark harness also uses to set
+# up runs of its own.
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Generate load against the server or balancer and report latencies")
+    parser.add_argument("url", nargs='*', help="URLs to pick from at random for made up traffic")
+    parser.add_argument("--trace", metavar="FILE", help="Replay the URLs in FILE, or standard input if FILE is -, in order")
+    parser.add_argument("--replay", action="store_true", help="Send the trace's requests at the times recorded in it")
+    parser.add_argument("--speedup", type=float, default=1, help="How many times faster than recorded to replay the trace")
+    parser.add_argument("--skew", type=float, default=0, help="Zipf skew of made up traffic towards the first URLs; 0 picks evenly")
+    parser.add_argument("--requests", type=int, default=DEFAULT_REQUESTS, help="Number of requests to send")
+    parser.add_argument("--duration", type=float, help="Send requests for this many seconds instead of a fixed number")
+    parser.add_argument("--rate", type=float, help="Run open-loop, sending this many requests a second on average")
+    parser.add_argument("--max-workers", type=int, default=DEFAULT_OPEN_LOOP_WORKERS, help="Threads available to send requests in open-loop mode")
+    parser.add_argument("--users", type=int, default=DEFAULT_USERS, help="Number of users sending requests in closed-loop mode")
+    parser.add_argument("--think-time", type=float, default=0, help="Seconds each closed-loop user waits between requests")
+    parser.add_argument("--keep-alive", action="store_true", help="Reuse connections rather than opening one per request")
+    parser.add_argument("--follow-redirects", action="store_true", help="Follow the balancer's redirects instead of counting them as answers")
+    parser.add_argument("--compressed", action="store_true", help="Ask for compressed responses, as the client does")
+    parser.add_argument("--seed", type=int, help="Random seed, so runs can be repeated")
+    parser.add_argument("--json", metavar="FILE", help="Also write the results to FILE as JSON")
+    return parser
+
+def main():
+
+    parser = build_parser()
+    args = parser.parse_args()
+    if ((args.trace == None) == (len(args.url) == 0)):
+        parser.error('give either URLs or --trace')
+    if (args.replay) and (args.trace == None):
+        parser.error('--replay needs a --trace')
+    if (args.rate != None) and (args.rate <= 0):
+        parser.error('--rate must be above 0')
+
+    try:
+        summary = run_load(args)
+    except ValueError:
+        print('Error:  Invalid URL or trace line.  Enter URLs of the form:  http://host:port/file')
+        sys.exit(1)
+    except OSError as e:
+        print('Error:  Could not read the trace:  ' + str(e))
+        sys.exit(1)
+    except KeyboardInterrupt:
+        sys.exit(1)
+
+    print_summary(summary)
+    if (args.json != None):
+        with open(args.json, 'w') as output:
+            json.dump(summary, output, indent=1)
+        print('\nResults written to ' + args.json)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,225 @@
+import os
+import socket
+
+# Shared HTTP/1.1 helpers used by the client, the server and the balancer.
+#
+# Rather than pulling a message off the socket one byte at a time, we recv()
+# large blocks into a reusable buffer and then carve the request or status
+# line, the headers and the body out of that.  Anything left over after one
+# message stays in the buffer, so messages that arrive split across several
+# packets or pipelined together in one packet are both handled naturally.
+
+# Size of the blocks we read from the socket, and the largest header section
+# we are willing to hold on to before deciding the peer is misbehaving.
+
+BUFFER_SIZE = 65536
+MAX_HEADER_SIZE = 65536
+
+# On Linux we can tell the kernel that a response head will be followed
+# straight away by its body, so the two go out together in full packets.
+
+MORE_FLAG = getattr(socket, 'MSG_MORE', 0)
+
+# Raised when a peer sends us something that can't be an HTTP message.
+
+class http_error(Exception):
+    pass
+
+# Split a complete header section into its start line and a dictionary of
+# headers.  Header names are case insensitive, so we store them lower case.
+# Repeated headers are folded together with commas as HTTP allows.
+
+def parse_head(head):
+    lines = head.decode('latin-1').split('\n')
+    start_line = lines[0].rstrip('\r')
+    headers = {}
+    for line in lines[1:]:
+        line = line.rstrip('\r')
+        if (line == ''):
+            continue
+        name, sep, value = line.partition(':')
+        if (sep == ''):
+            raise http_error('Malformed header line: ' + line)
+        name = name.strip().lower()
+        value = value.strip()
+        if (name in headers):
+            headers[name] = headers[name] + ', ' + value
+        else:
+            headers[name] = value
+    return start_line, headers
+
+# Check that a value is a plain decimal number, as HTTP writes them: ASCII
+# digits only, without the signs, underscores and spaces int() would allow.
+
+def is_digits(value):
+    return (value != '') and (all(c in '0123456789' for c in value))
+
+# Return the length of the body a message head announces, or 0 if it
+# doesn't announce one.  Anything but a plain number of bytes means we can't
+# tell where the message ends, so it raises an http_error.
+
+def content_length(headers):
+    value = headers.get('content-length', '0').strip()
+    if (not is_digits(value)):
+        raise http_error('Invalid Content-Length: ' + value)
+    return int(value)
+
+# An incremental parser.  Bytes are fed in as they arrive and complete
+# message heads are pulled out as soon as they are available.  It knows
+# nothing about sockets, which keeps it usable from event loops as well.
+
+class http_parser:
+    def __init__(self):
+        self.buffer = bytearray()
+
+    # Add newly received bytes to the end of the buffer.
+
+    def feed(self, data):
+        self.buffer += data
+
+    # Return the number of bytes waiting in the buffer.
+
+    def buffered(self):
+        return len(self.buffer)
+
+    # Find the end of the header section.  We accept bare \n line endings as
+    # well as \r\n, just like the line reader this replaces.  Returns the
+    # index just past the blank line, or -1 if the head is not complete yet.
+
+    def find_head_end(self):
+        crlf = self.buffer.find(b'\n\r\n')
+        if (crlf == -1):
+            lf = self.buffer.find(b'\n\n')
+        else:
+            lf = self.buffer.find(b'\n\n', 0, crlf + 2)
+        if (lf != -1):
+            return lf + 2
+        if (crlf != -1):
+            return crlf + 3
+        return -1
+
+    # Pull the next complete message head out of the buffer.  Returns the
+    # start line and headers, or None if we need more data first.  Blank
+    # lines ahead of a message are skipped as the HTTP spec recommends.
+
+    def next_head(self):
+        while (self.buffer[:2] == b'\r\n') or (self.buffer[:1] == b'\n'):
+            del self.buffer[:2 if self.buffer[:1] == b'\r' else 1]
+        end = self.find_head_end()
+        if (end == -1):
+            if (len(self.buffer) > MAX_HEADER_SIZE):
+                raise http_error('Header section too large')
+            return None
+        head = bytes(self.buffer[:end])
+        del self.buffer[:end]
+        return parse_head(head)
+
+    # Remove and return up to count bytes from the front of the buffer.
+
+    def take(self, count):
+        data = bytes(self.buffer[:count])
+        del self.buffer[:count]
+        return data
+
+# A parser attached to a socket.  It refills itself from the socket as
+# needed, using one reusable receive buffer for every recv() call.
+
+class socket_reader(http_parser):
+    def __init__(self, sock):
+        super().__init__()
+        self.sock = sock
+        self.chunk = bytearray(BUFFER_SIZE)
+        self.view = memoryview(self.chunk)
+
+    # Receive one more block from the socket into the buffer.  Returns False
+    # if the peer has closed its end of the connection.
+
+    def fill(self):
+        count = self.sock.recv_into(self.chunk)
+        if (count == 0):
+            return False
+        self.buffer += self.view[:count]
+        return True
+
+    # Read the next message head from the socket.  Returns the start line
+    # and headers, or None if the peer closed the connection before sending
+    # a complete head.
+
+    def read_head(self):
+        while True:
+            head = self.next_head()
+            if (head != None):
+                return head
+            if (not self.fill()):
+                return None
+
+    # Yield the next count bytes of body, first from whatever is already
+    # buffered and then straight from the socket.  The chunks handed out may
+    # be views onto our receive buffer, so they must be used before asking
+    # for the next one.
+
+    def read_body_chunks(self, count):
+        if (len(self.buffer) > 0) and (count > 0):
+            data = self.take(count)
+            count -= len(data)
+            yield data
+        while (count > 0):
+            received = self.sock.recv_into(self.chunk, min(count, BUFFER_SIZE))
+            if (received == 0):
+                raise ConnectionError('Connection closed with ' + str(count) + ' bytes of body outstanding')
+            count -= received
+            yield self.view[:received]
+
+    # Read exactly count bytes of body and return them.
+
+    def read_body(self, count):
+        body = bytearray()
+        for chunk in self.read_body_chunks(count):
+            body += chunk
+        return bytes(body)
+
+    # Read and throw away count bytes of body.
+
+    def skip_body(self, count):
+        for chunk in self.read_body_chunks(count):
+            pass
+
+# Send a response or request head, which is always followed by a body.
+
+def send_head(sock, head, more=True):
+    sock.sendall(head.encode(), MORE_FLAG if more else 0)
+
+# Send count bytes of an open file starting at offset.  Where we can, this
+# hands the work to the kernel's sendfile(), so the file goes from the page
+# cache to the socket without ever being copied through Python.  Partial
+# writes are picked up from where they left off, and non-blocking sockets or
+# systems without sendfile() fall back to the buffered path below.
+
+def send_file(sock, file, offset=0, count=None):
+    if (count == None):
+        count = os.fstat(file.fileno()).st_size - offset
+    if (count <= 0):
+        return 0
+    if (hasattr(os, 'sendfile')) and (sock.gettimeout() != 0):
+        sent = sock.sendfile(file, offset, count)
+    else:
+        sent = send_file_buffered(sock, file, offset, count)
+    if (sent < count):
+        raise ConnectionError('File ended after ' + str(sent) + ' of ' + str(count) + ' bytes')
+    return sent
+
+# Send count bytes of an open file starting at offset by reading it through
+# one reusable buffer.  sendall() takes care of any partial writes.
+
+def send_file_buffered(sock, file, offset, count):
+    chunk = bytearray(min(count, BUFFER_SIZE))
+    view = memoryview(chunk)
+    file.seek(offset)
+    sent = 0
+    while (sent < count):
+        read = file.readinto(view[:min(count - sent, len(chunk))])
+        if (read == 0):
+            break
+        sock.sendall(view[:read])
+        sent += read
+    return sent
@@ -5,67 +5,147 @@ import argparse
 import time
 import datetime
 import signal
-import random
+import selectors
+import threading
+import queue
+import statistics
+import concurrent.futures
+import collections
+import json
 from urllib.parse import urlparse
 
-# Define a constant for our buffer size
+# How often, in seconds, the health checker tests every server by default,
+# and how requests are spread over the servers unless told otherwise.
 
-BUFFER_SIZE = 1024
-TIMEOUT_TIME = 300
+DEFAULT_HEALTH_INTERVAL = 10
+DEFAULT_ALGORITHM = 'weighted'
 
-# Signal handler for graceful exiting.
+# How often, in seconds, we look to see whether the config file has changed.
 
-def signal_handler(sig, frame):
-    print('Interrupt received, shutting down ...')
-    sys.exit(0)
+CONFIG_POLL_INTERVAL = 2
 
-# A function for creating HTTP GET messages.
+# Defaults for handling clients.  The backlog is the number of connections
+# the kernel will queue for us before we accept them, the workers are the
+# threads that pass requests on to the servers, and the timeout is how long a
+# client gets to send us its request before we give up on it.
 
-def prepare_get_message(host, port, file_name):
-    request = f'GET {file_name} HTTP/1.1\r\nHost: {host}:{port}\r\n\r\n' 
-    return request
+DEFAULT_BACKLOG = 128
+DEFAULT_WORKERS = 16
+DEFAULT_TIMEOUT = 30
 
-# Read a single line (ending with \n) from a socket and return it.
-# We will strip out the \r and the \n in the process.
+# The weight the newest response time gets in each server's moving average,
+# and how many health checks in a row a server must fail before we mark it
+# down or pass before we mark it back up.
 
-def get_line_from_socket(sock):
+EWMA_WEIGHT = 0.3
+FALL_THRESHOLD = 3
+RISE_THRESHOLD = 2
 
-    done = False
-    line = ''
-    while (not done):
-        char = sock.recv(1).decode()
-        if (char == '\r'):
-            pass
-        elif (char == '\n'):
-            done = True
-        else:
-            line = line + char
-    return line
+# The file we download to test how fast each server is, how many times we
+# download it, and how long a server has to respond to each test.
+
+PROBE_FILE = 'testing.jpg'
+PROBE_SAMPLES = 3
+PROBE_TIMEOUT = 5
+
+# Where we remember what we know about the servers between runs, so that we
+# can start balancing straight away, and how old, in seconds, what we
+# remember about a server can be before we test it again instead.
+
+DEFAULT_STATE_FILE = '.balancer_state.json'
+DEFAULT_STATE_MAX_AGE = 600
+
+# Where servers report how busy they are, for load aware health checks.
+
+STATUS_PATH = '/_status'
+
+# In proxy mode, how long we wait on a backend before giving up on it, and
+# how many idle keep-alive connections we hold on to for each backend.  Idle
+# connections are only reused for a while, so that we don't pick up ones the
+# backend is about to time out and close.
+
+BACKEND_TIMEOUT = 30
+MAX_IDLE_CONNECTIONS = 8
+MAX_IDLE_TIME = 4
+
+# Passive outlier detection.  We keep the outcome of each server's most
+# recent requests, and once we have enough of them, a server is ejected if
+# too many failed, if several failed in a row, or if it is taking far longer
+# than the rest of the servers.  Ejections start short and double each time
+# a server is ejected again, and we never eject more than a fraction of the
+# servers at once.
+
+OUTLIER_WINDOW = 50
+OUTLIER_MIN_REQUESTS = 10
+OUTLIER_ERROR_RATE = 0.5
+OUTLIER_CONSECUTIVE_ERRORS = 5
+OUTLIER_LATENCY_FACTOR = 3
+BASE_EJECTION_TIME = 5
+MAX_EJECTION_TIME = 300
+MAX_EJECTED_FRACTION = 0.5
+
+# How many servers we try a request on before giving up with a 502.
+
+MAX_ATTEMPTS = 2
+
+# Admission control.  Each server is given at most a limited number of
+# requests at once, and requests that can't be given to a server straight
+# away wait, up to a limit, for one to free up.  A request that can't wait,
+# or waits too long, is turned away with a 503 telling the client when to
+# try again.
+
+DEFAULT_BACKEND_LIMIT = 32
+DEFAULT_QUEUE_SIZE = 128
+DEFAULT_QUEUE_TIMEOUT = 5
+RETRY_AFTER = 1
+
+# Adaptive limits.  A server's limit starts low and creeps up while its
+# requests take no more than a little over the fastest it has managed
+# recently, and is cut back as soon as they start taking longer, which is
+# the sign of a server with more work than it can keep up with.
+
+ADAPTIVE_INITIAL_LIMIT = 8
+ADAPTIVE_TOLERANCE = 2
+ADAPTIVE_BACKOFF = 0.9
+MIN_LIMIT = 1
+
+# Headers that only describe one hop of a connection, which a proxy must not
+# pass along.
+
+HOP_BY_HOP_HEADERS = ['connection', 'keep-alive', 'proxy-connection', 'te', 'trailer', 'transfer-encoding', 'upgrade']
+
+# Our shared HTTP helpers live alongside this program or one directory up.
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from httputil import BUFFER_SIZE, http_parser, socket_reader, http_error, content_length, send_head, send_file
+from selection import SELECTORS, build_selector
+from metrics import METRICS_PATH, CONTENT_TYPE, metrics_registry
+
+# Signal handler for graceful exiting.
+
+def signal_handler(sig, frame):
+    print('Interrupt received, shutting down ...')
+    sys.exit(0)
 
-# Read a file from the socket and print it out.  (For errors primarily.)
+# Set when we are asked to read the config file again, whether or not it
+# looks like it has changed.
 
-def print_file_from_socket(sock, bytes_to_read):
+reload_requested = threading.Event()
 
-    bytes_read = 0
-    while (bytes_read < bytes_to_read):
-        chunk = sock.recv(BUFFER_SIZE)
-        bytes_read += len(chunk)
-        print(chunk.decode())
+# Signal handler for SIGHUP, which asks us to reload the config file.
 
-# Read a file from the socket and save it out.
+def reload_handler(sig, frame):
+    reload_requested.set()
 
-def save_file_from_socket(sock, bytes_to_read, file_name):
+# A function for creating HTTP GET messages.
 
-    with open(file_name, 'wb') as file_to_write:
-        bytes_read = 0
-        while (bytes_read < bytes_to_read):
-            chunk = sock.recv(BUFFER_SIZE)
-            bytes_read += len(chunk)
-            file_to_write.write(chunk)
+def prepare_get_message(host, port, file_name, extra_headers=''):
+    request = f'GET {file_name} HTTP/1.1\r\nHost: {host}:{port}\r\n{extra_headers}\r\n' 
+    return request
 
 # Send the given response and file back to the client.
 
-def send_response_to_client(sock, code, file_name):
+def send_response_to_client(sock, code, file_name, extra_headers=''):
 
     # Determine content type of file
 
@@ -86,18 +166,14 @@ def send_response_to_client(sock, code, file_name):
 
     # Construct header and send it
 
-    header = prepare_response_message(code) + 'Content-Type: ' + type + '\r\nContent-Length: ' + str(file_size) + '\r\n\r\n'
-    sock.send(header.encode())
+    header = prepare_response_message(code) + extra_headers + 'Content-Type: ' + type + '\r\nContent-Length: ' + str(file_size) + '\r\n\r\n'
+    send_head(sock, header)
 
-    # Open the file, read it, and send it
+    # Open the file and let the kernel send it, then report how much we sent
 
     with open(file_name, 'rb') as file_to_send:
-        while True:
-            chunk = file_to_send.read(BUFFER_SIZE)
-            if chunk:
-                sock.send(chunk)
-            else:
-                break
+        send_file(sock, file_to_send, 0, file_size)
+    return len(header) + file_size
 
 # Send redirection response to client
 
@@ -123,19 +199,17 @@ def send_redirection_to_client(sock, code, file_name, host, port):
     # Construct header and send it
 
     header = prepare_response_message(code) + 'Location: '  + host + ':' + str(port) + '\r\nContent-Type: ' + type + '\r\nContent-Length: ' + str(file_size) + '\r\n\r\n'
-    sock.send(header.encode())
+    send_head(sock, header)
 
-    # Open the file, read it, and send it
+    # Open the file and let the kernel send it, then report how much we sent
 
     with open(file_name, 'rb') as file_to_send:
-        while True:
-            chunk = file_to_send.read(BUFFER_SIZE)
-            if chunk:
-                sock.send(chunk)
-            else:
-                break
+        send_file(sock, file_to_send, 0, file_size)
+    return len(header) + file_size
 
-# Create an HTTP response
+# Create an HTTP response.  We hang up on the client once we have answered
+# it, so every response we make ourselves says so, and the client won't try
+# to send another request down the same connection.
 
 def prepare_response_message(value):
     date = datetime.datetime.now()
@@ -143,6 +217,8 @@ def prepare_response_message(value):
     message = 'HTTP/1.1 '
     if value == '200':
         message = message + value + ' OK\r\n' + date_string + '\r\n'
+    elif value == '400':
+        message = message + value + ' Bad Request\r\n' + date_string + '\r\n'
     elif value == '404':
         message = message + value + ' Not Found\r\n' + date_string + '\r\n'
     elif value == '501':
@@ -151,137 +227,1165 @@ def prepare_response_message(value):
         message = message + value + ' Version Not Supported\r\n' + date_string + '\r\n'
     elif value == '301':
         message = message + value + ' Moved Permanently\r\n' + date_string + '\r\n'
+    elif value == '502':
+        message = message + value + ' Bad Gateway\r\n' + date_string + '\r\n'
+    elif value == '503':
+        message = message + value + ' Service Unavailable\r\n' + date_string + '\r\n'
 
-    return message
+    return message + 'Connection: close\r\n'
 
-# Reads the list of server adresses from the filename provided 
+# A pool of idle keep-alive connections to one backend server, shared by
+# every request we proxy to it.
 
-def generate_balanced_load(filename):
+class backend_pool:
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.idle = []
+        self.closed = False
+        self.lock = threading.Lock()
+
+    # Get a connection to the backend, reusing an idle one if we have one.
+    # Returns the socket, its reader, and whether it was reused.
+
+    def acquire(self):
+        with self.lock:
+            while (len(self.idle) > 0):
+                sock, reader, idle_since = self.idle.pop()
+                if (time.monotonic() - idle_since < MAX_IDLE_TIME):
+                    return sock, reader, True
+                sock.close()
+        sock = socket.create_connection((self.host, self.port), BACKEND_TIMEOUT)
+        return sock, socket_reader(sock), False
+
+    # Give a connection back once a response has been read from it in full.
+
+    def release(self, sock, reader):
+        with self.lock:
+            if (not self.closed) and (len(self.idle) < MAX_IDLE_CONNECTIONS):
+                self.idle.append((sock, reader, time.monotonic()))
+                return
+        sock.close()
+
+    # Stop pooling connections to a backend we no longer use.  Idle ones are
+    # closed now, and ones in use are closed as their requests finish.
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            for sock, reader, idle_since in self.idle:
+                sock.close()
+            self.idle = []
+
+# The connection pools for every backend we have proxied to, by address.
+
+backend_pools = {}
+backend_pools_lock = threading.Lock()
+
+# Find the connection pool for a backend, creating it the first time.
+
+def get_backend_pool(host, port):
+    with backend_pools_lock:
+        pool = backend_pools.get((host, port))
+        if (pool == None):
+            pool = backend_pool(host, port)
+            backend_pools[(host, port)] = pool
+        return pool
+
+# Close and forget the connection pool for a backend, if it has one.
+
+def close_backend_pool(host, port):
+    with backend_pools_lock:
+        pool = backend_pools.pop((host, port), None)
+    if (pool != None):
+        pool.close()
+
+# Turn a lower case header name back into the usual capitalised form.
+
+def format_header_name(name):
+    return '-'.join(word.capitalize() for word in name.split('-'))
+
+# Build a message head from a start line and headers, leaving out the
+# hop-by-hop headers and adding the ones given.
+
+def prepare_forwarded_head(start_line, headers, extra_headers):
+    head = start_line + '\r\n'
+    for name, value in headers.items():
+        if (name not in HOP_BY_HOP_HEADERS):
+            head = head + format_header_name(name) + ': ' + value + '\r\n'
+    return head + extra_headers + '\r\n'
+
+# Check whether a request says it has a body, or has a length we can't make
+# sense of.
+
+def has_request_body(headers):
+    if ('transfer-encoding' in headers):
+        return True
+    try:
+        return content_length(headers) > 0
+    except http_error:
+        return True
+
+# Send the given response back to the client when we could not get one from
+# any backend.
+
+def send_bad_gateway_to_client(sock):
+    return send_response_to_client(sock, '502', '502.html')
+
+# The page we send when turning a client away because we are too busy.  It
+# is read at startup, and again by the config watcher whenever it changes,
+# so that turning clients away never has to wait for the disk.
+
+overloaded_page = b''
+
+def load_overloaded_page():
+    global overloaded_page
+    try:
+        with open('503.html', 'rb') as f:
+            overloaded_page = f.read()
+    except OSError as e:
+        print('Error: Could not read 503.html: ' + str(e))
+
+# Build the whole response turning a client away because we are too busy.
+
+def prepare_overloaded_response():
+    body = overloaded_page
+    header = prepare_response_message('503') + 'Retry-After: ' + str(RETRY_AFTER) + '\r\nContent-Type: text/html\r\nContent-Length: ' + str(len(body)) + '\r\n\r\n'
+    return header.encode() + body
+
+# Raised when a backend fails a request before anything has been sent to
+# the client, so that the request can still be tried on another server.
+
+class backend_error(Exception):
+    pass
+
+# Raised when a backend fails part way through its response, after the
+# client has started to receive it, so that all we can do is hang up.
+
+class relay_error(Exception):
+    pass
 
-    f = open(filename)
-    server_entry = 0
-    server_address = []
+# Forward a client's request to a backend server and stream the response
+# back.  The request goes out on a pooled keep-alive connection, and if that
+# turns out to have been closed by the backend while it sat idle, we try
+# again on a fresh connection.  If the backend can't be reached at all, sends
+# a response we can't make sense of, or answers with a server error when we
+# are allowed to try elsewhere, we raise a backend_error.  If it fails once
+# the client has started to receive its response, we raise a relay_error, and
+# the client going away shows up as an OSError.  Returns the status code sent
+# to the client and the number of bytes sent.
 
-    for x in f:
+def proxy_request_to_backend(conn, addr, request, headers, host, port, retryable=False):
 
+    pool = get_backend_pool(host, port)
+    message = prepare_forwarded_head(request, headers, 'Connection: keep-alive\r\nX-Forwarded-For: ' + addr[0] + '\r\n')
+
+    while True:
+        backend = None
+        reused = False
         try:
-
-            # print(x.rstrip())
-            parsed_url = x.split(":")
-            
-            if((parsed_url[0] == None) or (parsed_url[1] == None)):
-                raise ValueError
-
-            server_address.append(parsed_url)
-            server_entry = server_entry + 1
-
-        except ValueError:
-            print('Error: Invalid address, ensure the server adresses in the config file are of the form host:port')
-            sys.exit(1)
-        
-    # Now we run the performance test for the array of server addresses to determine their response time
-
-    servers = []
-    server_entry = 0
-
-    for address in server_address:
-
-        # Now we try to make a connection to the current server 
-
-        print('Connecting to server ' + address[0] + ':' + address[1] + ' for a performance test...')
-
+            backend, reader, reused = pool.acquire()
+            send_head(backend, message, False)
+            head = reader.read_head()
+            if (head == None):
+                raise ConnectionError('backend closed the connection without responding')
+            break
+        except (OSError, http_error) as e:
+            if (backend != None):
+                backend.close()
+            if (not reused):
+                raise backend_error('failed to respond: ' + str(e))
+
+    # A server error can be retried elsewhere as long as the client hasn't
+    # seen any of it.  We read past the body so the connection can be reused.
+
+    response_line, response_headers = head
+    response_list = response_line.split(' ')
+    code = response_list[1] if (len(response_list) > 1) else ''
+    try:
+        bytes_to_read = content_length(response_headers)
+    except http_error as e:
+        backend.close()
+        raise backend_error('sent a bad response: ' + str(e))
+    if (retryable) and (code.startswith('5')):
         try:
+            reader.skip_body(bytes_to_read)
+        except OSError as e:
+            backend.close()
+            raise backend_error('failed part way through its response: ' + str(e))
+        except BaseException:
+            backend.close()
+            raise
+        pool.release(backend, reader)
+        raise backend_error('responded with ' + response_line)
+
+    # Relay the response head and then the body.  If anything goes wrong
+    # part way, the backend connection is left in an unknown state, so it
+    # can't go back in the pool.  We keep track of which side we were
+    # talking to, since only the backend failing counts against it.
+
+    sending = True
+    try:
+        response_head = prepare_forwarded_head(response_line, response_headers, 'Connection: close\r\n')
+        send_head(conn, response_head)
+        sending = False
+        for chunk in reader.read_body_chunks(bytes_to_read):
+            sending = True
+            conn.sendall(chunk)
+            sending = False
+    except OSError as e:
+        backend.close()
+        if (sending):
+            raise
+        raise relay_error('failed part way through its response: ' + str(e))
+    except BaseException:
+        backend.close()
+        raise
+
+    # The backend can take another request on this connection unless it
+    # told us otherwise.
+
+    if ('close' in response_headers.get('connection', '').lower()):
+        backend.close()
+    else:
+        pool.release(backend, reader)
+    return code, len(response_head) + bytes_to_read
+
+# The metrics we serve at METRICS_PATH.  Requests are counted by the status
+# code we answered with, along with how long they took from arriving to
+# being answered and how much we sent.  For each server we count how often
+# it was picked, how its proxied requests and health checks went, and how
+# long its requests took.  How each server stands right now, and how many
+# requests are waiting, are read from the balancer's state when the metrics
+# are asked for.
+
+class proxy_metrics:
+    def __init__(self):
+        self.registry = metrics_registry()
+        self.requests = self.registry.counter('balancer_requests_total', 'Requests answered, by status code.', ('code',))
+        self.duration = self.registry.histogram('balancer_request_duration_seconds', 'Time from a request arriving to it being answered.')
+        self.sent = self.registry.counter('balancer_sent_bytes_total', 'Bytes sent to clients, headers included.')
+        self.accepted = self.registry.counter('balancer_connections_accepted_total', 'Client connections accepted.')
+        self.connections = self.registry.gauge('balancer_connections_active', 'Client connections open.')
+        self.selections = self.registry.counter('balancer_backend_selections_total', 'Requests given to each server.', ('backend',))
+        self.backend_requests = self.registry.counter('balancer_backend_requests_total', 'Proxied requests by server and whether they succeeded.', ('backend', 'result'))
+        self.backend_duration = self.registry.histogram('balancer_backend_response_seconds', 'Time each server took to answer proxied requests.', labels=('backend',))
+        self.probes = self.registry.counter('balancer_probes_total', 'Health checks and performance tests by server and result.', ('backend', 'result'))
+
+    # Report on the servers in the balancer's state from now on.
+
+    def watch(self, state):
+        def per_server(value):
+            return lambda: {(backend_label(x),): value(x) for x in state.servers}
+        self.registry.collected('balancer_backend_up', 'Whether each server is being given requests.', 'gauge', per_server(lambda x: int(x.available())), ('backend',))
+        self.registry.collected('balancer_backend_active_requests', 'Requests each server is handling.', 'gauge', per_server(lambda x: x.active), ('backend',))
+        self.registry.collected('balancer_backend_limit', 'Most requests each server may be given at once.', 'gauge', per_server(lambda x: x.limit), ('backend',))
+        self.registry.collected('balancer_backend_response_time_seconds', 'Each server\'s response time as of its last health check.', 'gauge', per_server(lambda x: x.response_time), ('backend',))
+        self.registry.collected('balancer_backend_reported_latency_seconds', 'Median request time each server last reported for itself.', 'gauge', per_server(lambda x: x.reported_latency), ('backend',))
+        self.registry.collected('balancer_queue_waiting', 'Requests waiting for a worker or for a server to have room.', 'gauge', lambda: state.admission.waiting)
+
+    # Count a finished request.  The code is None if something went wrong
+    # part way through answering it.
+
+    def request_finished(self, code, elapsed, sent):
+        if (code != None):
+            self.requests.inc(code)
+        self.duration.observe(elapsed)
+        self.sent.inc(amount=sent)
+
+    # Count how a request proxied to a server went.
+
+    def backend_finished(self, x, ok, response_time):
+        self.backend_requests.inc(backend_label(x), 'ok' if ok else 'error')
+        if (response_time != None):
+            self.backend_duration.observe(response_time, backend_label(x))
+
+    # Count how a health check or performance test of a server went.
+
+    def probed(self, x, response_time):
+        self.probes.inc(backend_label(x), 'pass' if (response_time != None) else 'fail')
+
+balancer_metrics = proxy_metrics()
+
+# The name a server goes by in the metrics.
+
+def backend_label(x):
+    return x.host + ':' + str(x.port)
+
+# Send the balancer's metrics in the Prometheus text format.  Returns the
+# number of bytes sent.
+
+def send_metrics_to_client(sock):
+    body = balancer_metrics.registry.render().encode()
+    header = prepare_response_message('200') + 'Content-Type: ' + CONTENT_TYPE + '\r\nCache-Control: no-store\r\nContent-Length: ' + str(len(body)) + '\r\n\r\n'
+    sock.sendall(header.encode() + body)
+    return len(header) + len(body)
+
+# Reads the list of server adresses from the filename provided.  Blank lines
+# are skipped, and anything else not of the form host:port raises a
+# ValueError.  A server listed more than once is only used once.
+
+def read_server_addresses(filename):
 
-            testing_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            testing_socket.connect((address[0], int(address[1])))
-
-            # The connection was successful, so we can send our test message
-
-            print("Connection to server established. Sending message to test response time..\n")
-            message = prepare_get_message(address[0], int(address[1]), 'testing.jpg')
-
-            # Start timer and send the message
-
-            start_time = time.perf_counter()
-            testing_socket.send(message.encode())
-
-            # Recieve the response from the server and take a look at it
-
-            response_line = get_line_from_socket(testing_socket)
-            response_list = response_line.split(' ')
-            headers_done = False
-
-            # If an error is returned from the server, we dump everything sent and exit
-
-            if (response_list[1] != '200'):
-                print('Error:  An error response was received from the server.  Details:\n')
-                print(response_line);
-                bytes_to_read = 0
-                while (not headers_done):
-                    header_line = get_line_from_socket(testing_socket)
-                    print(header_line)
-                    header_list = header_line.split(' ')
-                    if (header_line == ''):
-                        headers_done = True
-                    elif (header_list[0] == 'Content-Length:'):
-                        bytes_to_read = int(header_list[1])
-                print_file_from_socket(testing_socket, bytes_to_read)
-                sys.exit(1)
-
-            # if its OK, we retieve and write the file out.
-
-            else:
-
-                print('Success:  Server is sending file.  Downloading it now.')
-
-                # Go through headers and find the size of the file, then save it.
-        
-                bytes_to_read = 0
-                while (not headers_done):
-                    header_line = get_line_from_socket(testing_socket)
-                    header_list = header_line.split(' ')
-                    if (header_line == ''):
-                        headers_done = True
-                    elif (header_list[0] == 'Content-Length:'):
-                        bytes_to_read = int(header_list[1])
-                save_file_from_socket(testing_socket, bytes_to_read, 'testing.jpg')
-
-            # Stop the timer after the file has been saved
-
-            end_time = time.perf_counter()
-
-            # print("server " + address[0] + ':' + address[1] + " responded in " + str(end_time-start_time) + " units of time")
-
-            servers.append(server_data(address[0], int(address[1]), (end_time - start_time)))
-
-
-        except ConnectionRefusedError:
-
-            print('Error: server' + address[0] + ':' + address[1] + ' was not accepting connections.')
-
-    # Sort the array of servers from fastest response time to slowest response time
-
-    newlist = sorted(servers, key=lambda x: x.response_time, reverse=True)
-
-    # Create the array that will baance the requests
-
-    balanced_load = []
-    request_ratio = 1
-    for x in newlist:
-        for i in range(request_ratio):
-            balanced_load.append(x)
-        request_ratio = request_ratio + 1 
-
-    return balanced_load
-
-# Class to hold server address and rsponse time
+    server_address = []
+    with open(filename) as f:
+        for x in f:
+            x = x.strip()
+            if (x == ''):
+                continue
+            try:
+                host, sep, port = x.rpartition(':')
+                if (host == '') or (sep == ''):
+                    raise ValueError
+                address = (host, int(port))
+            except ValueError:
+                raise ValueError('Invalid address, ensure the server adresses in the config file are of the form host:port')
+            if (address not in server_address):
+                server_address.append(address)
+    return server_address
+
+# Time one request for the test file from a server, reading the response
+# into memory and throwing it away.  Returns the time taken in seconds, or
+# raises an exception if the server fails to respond properly in time.
+
+def time_test_request(host, port, timeout):
+
+    start_time = time.perf_counter()
+    with socket.create_connection((host, port), timeout) as testing_socket:
+        testing_socket.settimeout(timeout)
+        message = prepare_get_message(host, port, PROBE_FILE, 'Connection: close\r\n')
+        testing_socket.sendall(message.encode())
+
+        # Recieve the response from the server and take a look at it
+
+        reader = socket_reader(testing_socket)
+        head = reader.read_head()
+        if (head == None):
+            raise ConnectionError('server closed the connection without responding')
+        response_line, headers = head
+        response_list = response_line.split(' ')
+        if (len(response_list) < 2) or (response_list[1] != '200'):
+            raise ConnectionError('server responded with ' + response_line)
+        reader.skip_body(content_length(headers))
+    return time.perf_counter() - start_time
+
+# Ask a server how busy it is.  Returns the statistics it reports, or None if
+# it doesn't report any, and raises an exception if it fails to respond.
+
+def fetch_server_status(host, port, timeout):
+
+    with socket.create_connection((host, port), timeout) as status_socket:
+        status_socket.settimeout(timeout)
+        message = prepare_get_message(host, port, STATUS_PATH, 'Connection: close\r\n')
+        status_socket.sendall(message.encode())
+        reader = socket_reader(status_socket)
+        head = reader.read_head()
+        if (head == None):
+            raise ConnectionError('server closed the connection without responding')
+        response_line, headers = head
+        response_list = response_line.split(' ')
+        if (len(response_list) >= 2) and (response_list[1] == '404'):
+            return None
+        if (len(response_list) < 2) or (response_list[1] != '200'):
+            raise ConnectionError('server responded with ' + response_line)
+        return json.loads(reader.read_body(content_length(headers)))
+
+# Work out how long a new request to a server would take from the time we
+# measured for a test request, stretched by however many requests it reports
+# being in the middle of.  The latencies the server reports only cover its
+# own side of each request, so they measure something else, and are kept
+# apart as the server's reported latency rather than mixed in here.
+
+def load_time(x, response_time, status):
+    latency = status.get('latency')
+    x.reported_latency = latency.get('p50') if (isinstance(latency, dict)) else None
+    return response_time * (1 + int(status.get('active_requests', 0)))
+
+# Run the performance test against one server.  We take several samples and
+# use the median, so that one slow or lucky request doesn't decide the
+# server's weight.  Returns the response time, or None if the server failed.
+
+def probe_server(host, port, samples, timeout):
+
+    print('Connecting to server ' + host + ':' + str(port) + ' for a performance test...')
+    times = []
+    try:
+        for i in range(samples):
+            times.append(time_test_request(host, port, timeout))
+    except (OSError, http_error) as e:
+        print('Error: server ' + host + ':' + str(port) + ' failed the performance test and will not be used for now: ' + str(e))
+        return None
+    response_time = statistics.median(times)
+    print('Server ' + host + ':' + str(port) + ' passed the performance test with a median response time of ' + str(response_time))
+    return response_time
+
+# Create the selector that will balance the requests over the servers that
+# are currently up, using the given algorithm.
+
+def build_balanced_load(algorithm, servers):
+    return build_selector(algorithm, [x for x in servers if x.available()])
+
+# Runs the performance test against all of the servers at once, so that
+# startup takes about as long as the slowest server rather than all of them
+# put together.  Servers that fail the test start out marked down, and the
+# health checker will bring them in once they recover.
+
+def generate_balanced_load(algorithm, servers):
+    probe_servers(servers)
+    return build_balanced_load(algorithm, servers)
+
+# Run the performance test against the given servers at once, and record
+# how each of them did.
+
+def probe_servers(servers):
+    if (len(servers) > 0):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(servers)) as executor:
+            probes = [executor.submit(probe_server, x.host, x.port, PROBE_SAMPLES, PROBE_TIMEOUT) for x in servers]
+            for x, probe in zip(servers, probes):
+                x.response_time = probe.result()
+                balancer_metrics.probed(x, x.response_time)
+                x.latency = x.response_time
+                x.healthy = (x.response_time != None)
+                x.checked = time.time()
+
+# Class to hold server address and rsponse time, which is a moving average
+# kept up to date by the health checker, along with whether the server is
+# up and how many health checks in a row it has passed or failed.  The
+# selectors also keep track of how many requests the server is handling and
+# how long they have been taking, and it can only be given up to its limit.
 
 class server_data:
-    def __init__(self, host, port, response_time):
+    def __init__(self, host, port, response_time=None, limit=DEFAULT_BACKEND_LIMIT):
         self.host = host
         self.port = port
+        self.limit = limit
         self.response_time = response_time
-        
+        self.latency = response_time
+        self.reported_latency = None
+        self.active = 0
+        self.healthy = (response_time != None)
+        self.checked = None
+        self.successes = 0
+        self.failures = 0
+        self.outcomes = collections.deque(maxlen=OUTLIER_WINDOW)
+        self.consecutive_errors = 0
+        self.ejections = 0
+        self.ejected_until = None
+        self.trial = False
+
+    # Whether the server should be getting requests: it is passing its
+    # health checks and hasn't been ejected for misbehaving.
+
+    def available(self):
+        return (self.healthy) and (self.ejected_until == None)
+
+    # Record how a real request went: whether it succeeded, and if so how
+    # long it took.
+
+    def record_request(self, ok, response_time):
+        self.outcomes.append((ok, response_time))
+        self.consecutive_errors = 0 if ok else self.consecutive_errors + 1
+
+    # The fraction of recent requests that failed.
+
+    def error_rate(self):
+        if (len(self.outcomes) == 0):
+            return 0
+        return sum(1 for ok, response_time in self.outcomes if not ok) / len(self.outcomes)
+
+    # The given percentile of how long recent successful requests took, or
+    # None if there haven't been any.
+
+    def latency_percentile(self, fraction):
+        times = sorted(response_time for ok, response_time in list(self.outcomes) if ok)
+        if (len(times) == 0):
+            return None
+        return times[min(int(len(times) * fraction), len(times) - 1)]
+
+    # Record the result of one health check.  The response time is folded
+    # into an exponentially weighted moving average, and the server only
+    # changes between up and down after several checks in a row agree, so
+    # that one blip doesn't flip it.  Returns True if the server changed.
+
+    def record_health_check(self, response_time):
+        if (response_time == None):
+            self.successes = 0
+            self.failures = self.failures + 1
+            if (self.healthy) and (self.failures >= FALL_THRESHOLD):
+                self.healthy = False
+                return True
+            return False
+
+        if (self.response_time == None):
+            self.response_time = response_time
+            self.latency = response_time
+        else:
+            self.response_time = EWMA_WEIGHT * response_time + (1 - EWMA_WEIGHT) * self.response_time
+        self.checked = time.time()
+        self.failures = 0
+        self.successes = self.successes + 1
+        if (not self.healthy) and (self.successes >= RISE_THRESHOLD):
+            self.healthy = True
+            return True
+        return False
+
+# Everything the request handling, the health checker and the config watcher
+# share: every server from the config file, the algorithm requests are
+# balanced with, the selector currently doing it, and the admission control
+# in front of it.  A whole new selector is built and swapped in with a single
+# assignment, so requests never see one half built and never wait for it.
+# The lock just stops the health checker and the config watcher from
+# building theirs at the same time, and the save lock stops them writing the
+# state file at the same time, without holding up requests while they do.
+
+class balancer_state:
+    def __init__(self, servers, algorithm, balanced_load, admission, backend_limit, adaptive_limits, load_aware, state_file):
+        self.servers = servers
+        self.algorithm = algorithm
+        self.balanced_load = balanced_load
+        self.admission = admission
+        self.backend_limit = backend_limit
+        self.adaptive_limits = adaptive_limits
+        self.load_aware = load_aware
+        self.state_file = state_file
+        self.ejected = []
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+
+# The limit a server starts out with.
+
+def initial_limit(backend_limit, adaptive_limits):
+    if (adaptive_limits):
+        return min(ADAPTIVE_INITIAL_LIMIT, backend_limit)
+    return backend_limit
+
+# Requests that have been read but not yet given a server, whether they are
+# waiting for a worker or for a server to have room.  There can only be so
+# many of them, and each only gets so long.  Workers that finish with a
+# server wake up one that is waiting for room.
+
+class admission_control:
+    def __init__(self, queue_size, queue_timeout):
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.waiting = 0
+        self.condition = threading.Condition()
+
+    # Let a newly read request in to wait, if there is room.  Returns False
+    # if the client should be turned away.
+
+    def enter(self, connection):
+        with self.condition:
+            if (self.waiting >= self.queue_size):
+                return False
+            self.waiting = self.waiting + 1
+        connection.waiting = True
+        connection.wait_deadline = time.monotonic() + self.queue_timeout
+        return True
+
+    # A request has stopped waiting, one way or another.
+
+    def leave(self, connection):
+        if (connection.waiting):
+            connection.waiting = False
+            with self.condition:
+                self.waiting = self.waiting - 1
+
+    # A server has room for another request.
+
+    def notify(self):
+        with self.condition:
+            self.condition.notify()
+
+# Remember how each server was doing when it was last checked, writing to a
+# temporary file first so that a crash part way can't leave a broken one.
+# Saves can come from several threads, so they take turns.
+
+def save_balancer_state(state):
+    if (state.state_file == ''):
+        return
+    with state.save_lock:
+        servers = {}
+        for x in state.servers:
+            if (x.checked != None):
+                servers[x.host + ':' + str(x.port)] = {'response_time': x.response_time, 'healthy': x.healthy, 'checked': x.checked}
+        try:
+            with open(state.state_file + '.tmp', 'w') as store:
+                json.dump({'servers': servers}, store, separators=(',', ':'))
+            os.replace(state.state_file + '.tmp', state.state_file)
+        except OSError as e:
+            print('Error: Could not save the server state to ' + state.state_file + ': ' + str(e))
+
+# Pick up how the servers were doing from the last run.  Anything older than
+# max_age seconds is ignored.  Returns True if at least one server was up
+# recently enough for us to start balancing with.
+
+def load_balancer_state(servers, state_file, max_age):
+    if (state_file == ''):
+        return False
+    try:
+        with open(state_file) as store:
+            saved = json.load(store).get('servers', {})
+    except (OSError, ValueError, AttributeError):
+        return False
+    now = time.time()
+    for x in servers:
+        try:
+            entry = saved.get(x.host + ':' + str(x.port))
+            if (entry == None) or (now - entry['checked'] > max_age) or (entry['response_time'] == None):
+                continue
+            response_time = float(entry['response_time'])
+            healthy = bool(entry['healthy'])
+            checked = float(entry['checked'])
+        except (KeyError, TypeError, ValueError, AttributeError):
+            continue
+        x.response_time = response_time
+        x.latency = response_time
+        x.healthy = healthy
+        x.checked = checked
+    return any(x.healthy for x in servers)
+
+# Test every server in the background after starting from saved state, and
+# switch over to the fresh results as soon as they are in.
+
+def refresh_balancer_state(state):
+    servers = state.servers
+    probe_servers(servers)
+    with state.lock:
+        state.balanced_load = build_balanced_load(state.algorithm, state.servers)
+    print_balanced_load(state.balanced_load)
+    save_balancer_state(state)
+
+# Check the health of one server by timing a single test request.  When we
+# are load aware we also ask the server how busy it is, and if it can tell
+# us, allow for the requests it is in the middle of.  Returns the response
+# time, or None if the server failed.
+
+def check_server(x, load_aware):
+    try:
+        response_time = time_test_request(x.host, x.port, PROBE_TIMEOUT)
+        if (load_aware):
+            status = fetch_server_status(x.host, x.port, PROBE_TIMEOUT)
+            if (status != None):
+                response_time = load_time(x, response_time, status)
+        return response_time
+    except (OSError, http_error, ValueError, TypeError, AttributeError):
+        return None
+
+# Display the servers requests are balanced over.
+
+def print_balanced_load(balanced_load):
+    print("\nBelow are the servers being balanced over using " + type(balanced_load).__name__ + ":")
+    for x in balanced_load.servers:
+        print("Server " + x.host + ":" + str(x.port) + ' RT: ' + str(x.response_time))
+
+# Describe how a server's recent requests have gone.
+
+def describe_outcomes(x):
+    rate = x.error_rate()
+    median = x.latency_percentile(0.5)
+    tail = x.latency_percentile(0.99)
+    return 'error rate ' + str(round(100 * rate)) + '%, p50 ' + str(median) + ', p99 ' + str(tail)
+
+# Take a misbehaving server out of the balancing for a while, unless too
+# many servers are out already.  Each ejection in a row lasts twice as long
+# as the last.  The lock must be held.
+
+def eject_server(state, x, reason):
+    if (x.ejected_until == None) and (len(state.ejected) + 1 > int(len(state.servers) * MAX_EJECTED_FRACTION)):
+        return
+    x.ejections = x.ejections + 1
+    ejection_time = min(BASE_EJECTION_TIME * 2 ** (x.ejections - 1), MAX_EJECTION_TIME)
+    x.ejected_until = time.monotonic() + ejection_time
+    x.outcomes.clear()
+    x.consecutive_errors = 0
+    if (x not in state.ejected):
+        state.ejected.append(x)
+    state.balanced_load = build_balanced_load(state.algorithm, state.servers)
+    print('Server ' + x.host + ':' + str(x.port) + ' ejected for ' + str(ejection_time) + ' seconds: ' + reason)
+
+# Once a server has sat out its ejection, it is sent a single trial request.
+# Returns a server due a trial, marked so that no one else picks it, or None.
+
+def take_trial_server(state):
+    if (len(state.ejected) == 0):
+        return None
+    now = time.monotonic()
+    with state.lock:
+        for x in state.ejected:
+            if (not x.trial) and (x.healthy) and (now >= x.ejected_until):
+                x.trial = True
+                return x
+    return None
+
+# Record how a real request to a server went, and act on it.  A request
+# that succeeded without us knowing how long it took, because the client
+# went away part way, only counts for trials.  A trial request decides
+# whether an ejected server comes back or goes out again for longer.  For
+# everyone else, failures count towards being ejected.
+
+def record_result(state, x, ok, response_time):
+    with state.lock:
+        if (not ok) or (response_time != None):
+            x.record_request(ok, response_time)
+        if (ok) and (response_time != None) and (state.adaptive_limits):
+            adjust_limit(x, response_time, state.backend_limit)
+        if (x.trial):
+            x.trial = False
+            if (ok):
+                x.ejected_until = None
+                x.ejections = max(x.ejections - 1, 0)
+                if (x in state.ejected):
+                    state.ejected.remove(x)
+                state.balanced_load = build_balanced_load(state.algorithm, state.servers)
+                print('Server ' + x.host + ':' + str(x.port) + ' passed its trial request and is back.')
+            else:
+                eject_server(state, x, 'failed its trial request')
+        elif (not ok) and (x.ejected_until == None):
+            if (x.consecutive_errors >= OUTLIER_CONSECUTIVE_ERRORS):
+                eject_server(state, x, str(x.consecutive_errors) + ' errors in a row')
+            elif (len(x.outcomes) >= OUTLIER_MIN_REQUESTS) and (x.error_rate() >= OUTLIER_ERROR_RATE):
+                eject_server(state, x, describe_outcomes(x))
+
+# Adjust a server's limit after a successful request: up a little if the
+# request was about as quick as the server gets, so that the limit grows by
+# about one for every limit's worth of requests, and down by a fraction if
+# it was slow.  The lock must be held.
+
+def adjust_limit(x, response_time, maximum):
+    fastest = x.latency_percentile(0)
+    if (response_time <= ADAPTIVE_TOLERANCE * fastest):
+        x.limit = min(x.limit + 1 / x.limit, maximum)
+    else:
+        x.limit = max(x.limit * ADAPTIVE_BACKOFF, MIN_LIMIT)
+
+# Look for servers that are much slower than the rest.  Each server's median
+# response time over its recent requests is compared with the median of all
+# of the servers' medians, so it takes at least three servers for there to
+# be a clear outlier.
+
+def check_latency_outliers(state):
+    with state.lock:
+        medians = {}
+        for x in state.servers:
+            if (x.available()) and (len(x.outcomes) >= OUTLIER_MIN_REQUESTS):
+                median = x.latency_percentile(0.5)
+                if (median != None):
+                    medians[x] = median
+        if (len(medians) < 3):
+            return
+        typical = statistics.median(medians.values())
+        for x, median in medians.items():
+            if (median > OUTLIER_LATENCY_FACTOR * typical):
+                eject_server(state, x, describe_outcomes(x) + ', against a typical p50 of ' + str(typical))
+
+# The health checker.  It runs in the background, checking every server at
+# once every interval, and keeps the array of servers up to date without
+# ever holding up a request.
+
+def health_check_loop(state, interval):
+
+    while True:
+        time.sleep(interval)
+        servers = state.servers
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(len(servers), 1)) as executor:
+            results = list(executor.map(check_server, servers, [state.load_aware] * len(servers)))
+        changed = False
+        for x, response_time in zip(servers, results):
+            balancer_metrics.probed(x, response_time)
+            if (x.record_health_check(response_time)):
+                changed = True
+                print('Server ' + x.host + ':' + str(x.port) + ' is now ' + ('up' if x.healthy else 'down') + '.')
+        check_latency_outliers(state)
+
+        # The config file may have been reloaded while we were checking, so
+        # build from whatever servers are current now.
+
+        with state.lock:
+            state.balanced_load = build_balanced_load(state.algorithm, state.servers)
+        if (changed):
+            print_balanced_load(state.balanced_load)
+        save_balancer_state(state)
+
+# Bring the servers in line with the config file.  Servers that are still
+# listed keep everything we know about them, new ones are tested before they
+# are brought in, and ones no longer listed stop getting new requests while
+# the ones they are already handling finish.  Nothing changes if the file
+# can't be read.
+
+def reload_servers(state, filename):
+
+    try:
+        addresses = read_server_addresses(filename)
+    except (OSError, ValueError) as e:
+        print('Error: Could not reload ' + filename + ', keeping the current servers: ' + str(e))
+        return
+
+    current = {(x.host, x.port): x for x in state.servers}
+    added = [server_data(host, port, limit=initial_limit(state.backend_limit, state.adaptive_limits)) for host, port in addresses if (host, port) not in current]
+    removed = [x for x in state.servers if (x.host, x.port) not in addresses]
+    if (len(added) == 0) and (len(removed) == 0):
+        return
+    print('Reloading ' + filename + ': ' + str(len(added)) + ' server(s) added, ' + str(len(removed)) + ' removed.')
+
+    # Test the new servers before anything changes, so that requests keep
+    # flowing to the current ones in the meantime.
+
+    probe_servers(added)
+    added = {(x.host, x.port): x for x in added}
+    with state.lock:
+        state.servers = [current.get(address) or added[address] for address in addresses]
+        state.ejected = [x for x in state.ejected if x in state.servers]
+        state.balanced_load = build_balanced_load(state.algorithm, state.servers)
+
+    # The servers that are gone finish off what they are doing.
+
+    for x in removed:
+        close_backend_pool(x.host, x.port)
+        print('Server ' + x.host + ':' + str(x.port) + ' removed with ' + str(x.active) + ' request(s) still in progress.')
+    print_balanced_load(state.balanced_load)
+    save_balancer_state(state)
+
+# The config watcher.  It runs in the background, reloading the config file
+# whenever its modification time changes or we get a SIGHUP.  It keeps an
+# eye on the 503 page in the same way.
+
+def config_watch_loop(state, filename):
+
+    modified = None
+    page_modified = None
+    try:
+        modified = os.stat(filename).st_mtime_ns
+        page_modified = os.stat('503.html').st_mtime_ns
+    except OSError:
+        pass
+    while True:
+        requested = reload_requested.wait(CONFIG_POLL_INTERVAL)
+        reload_requested.clear()
+        try:
+            latest = os.stat('503.html').st_mtime_ns
+            if (requested) or (latest != page_modified):
+                page_modified = latest
+                load_overloaded_page()
+        except OSError:
+            pass
+        try:
+            latest = os.stat(filename).st_mtime_ns
+        except OSError:
+            continue
+        if (requested) or (latest != modified):
+            modified = latest
+            reload_servers(state, filename)
+
+# A client connection waiting for its request to arrive.  The event loop
+# feeds whatever the client sends into a parser until the whole request head
+# is there, so a client that sends it slowly only ever costs us a file
+# descriptor, and it gets until its deadline to finish.
+
+class client_connection:
+    def __init__(self, sock, addr, timeout):
+        self.sock = sock
+        self.addr = addr
+        self.parser = http_parser()
+        self.deadline = time.monotonic() + timeout
+        self.arrived = None
+        self.waiting = False
+        self.wait_deadline = None
+
+# Answer one client's request.  We look at the request and figure out what
+# to do based on the contents of things.  The balancer doesn't care about
+# most headers, so we leave them be for the server.  Returns the status code
+# we answered with, or None if something went wrong part way, and the number
+# of bytes sent.
+
+def handle_client(connection, request, headers, state, args):
+
+    conn = connection.sock
+    addr = connection.addr
+    print('Received request:  ' + request)
+    request_list = request.split()
+
+    # If we did not get a GET command respond with a 501.
+
+    if (len(request_list) == 0) or (request_list[0] != 'GET'):
+        print('Invalid type of request received ... responding with error!')
+        return '501', send_response_to_client(conn, '501', '501.html')
+
+    # If we did not get the proper HTTP version respond with a 505.
+
+    if (len(request_list) < 3) or (request_list[2] != 'HTTP/1.1'):
+        print('Invalid HTTP version received ... responding with error!')
+        return '505', send_response_to_client(conn, '505', '505.html')
+
+    # We only pass on the request head, so a request with a body is turned
+    # away with a 400.  Passing it on without its body would leave the server
+    # waiting for bytes that never come, and count that against it.
+
+    if (has_request_body(headers)):
+        print('Request with a body received ... responding with error!')
+        return '400', send_response_to_client(conn, '400', '400.html')
+
+    # The metrics path is answered by the balancer itself rather than passed
+    # on, and never has to wait for a server.
+
+    if (request_list[1] == METRICS_PATH):
+        print('Metrics requested ... sending metrics!')
+        return '200', send_metrics_to_client(conn)
+
+    # If a server is due a trial after being ejected, this request is it.
+    # Otherwise the selector picks a server with room to handle the client.
+    # If every server is down, there is no one to send the client to, and if
+    # they are all too busy for longer than the client can wait, or it has
+    # already waited that long for a worker, we turn the client away.
+
+    full = (time.monotonic() > connection.wait_deadline)
+    selected_server = None if (full) else take_trial_server(state)
+    if (selected_server != None):
+        state.balanced_load.claim(selected_server)
+    elif (not full):
+        selected_server, full = acquire_backend(state, request_list[1], [], connection.wait_deadline)
+    state.admission.leave(connection)
+    if (selected_server == None) and (full):
+        print('All servers are busy ... responding with error!')
+        response = prepare_overloaded_response()
+        conn.sendall(response)
+        return '503', len(response)
+    if (selected_server == None):
+        print('No servers are up ... responding with error!')
+        return '502', send_bad_gateway_to_client(conn)
+    balancer_metrics.selections.inc(backend_label(selected_server))
+
+    # In redirect mode we send the client off to the server itself.  We never
+    # hear how that goes, so only proxied requests teach us anything.
+
+    if (args.redirect):
+        try:
+            return '301', send_redirection_to_client(conn,'301','301.html',selected_server.host,selected_server.port)
+        finally:
+            state.balanced_load.release(selected_server)
+            state.admission.notify()
+            record_result(state, selected_server, True, None)
+
+    # Otherwise we pass the request on to the server and its response back
+    # to the client, who never deals with the server.  How long that takes
+    # tells the selector how the server is doing, and failures count against
+    # the server.  If the server fails before the client has seen anything,
+    # we try the request on a different one.
+
+    tried = []
+    while True:
+        tried.append(selected_server)
+        start_time = time.perf_counter()
+        response_time = None
+        ok = True
+        try:
+            code, sent = proxy_request_to_backend(conn, addr, request, headers, selected_server.host, selected_server.port, len(tried) < MAX_ATTEMPTS)
+            print('Proxied request to server ' + selected_server.host + ':' + str(selected_server.port) + ', which responded with ' + code)
+            response_time = time.perf_counter() - start_time
+            ok = not code.startswith('5')
+            return code, sent
+        except backend_error as e:
+            print('Error: server ' + selected_server.host + ':' + str(selected_server.port) + ' ' + str(e))
+            ok = False
+        except relay_error as e:
+            print('Error: server ' + selected_server.host + ':' + str(selected_server.port) + ' ' + str(e))
+            ok = False
+            return None, 0
+        except (OSError, http_error) as e:
+            print('Error while proxying request to server ' + selected_server.host + ':' + str(selected_server.port) + ': ' + str(e))
+            return None, 0
+        finally:
+            state.balanced_load.release(selected_server, response_time if ok else None)
+            state.admission.notify()
+            record_result(state, selected_server, ok, response_time)
+            balancer_metrics.backend_finished(selected_server, ok, response_time)
+
+        # Pick another server that hasn't failed this request yet, waiting
+        # for room no longer than the request could have waited to start.
+
+        selected_server = None
+        if (len(tried) < MAX_ATTEMPTS):
+            selected_server, full = acquire_backend(state, request_list[1], tried, connection.wait_deadline)
+        if (selected_server == None):
+            return '502', send_bad_gateway_to_client(conn)
+        balancer_metrics.selections.inc(backend_label(selected_server))
+        print('Retrying request on server ' + selected_server.host + ':' + str(selected_server.port))
+
+# Pick a server for a request that has room for it, leaving out those in
+# tried.  If the selector's choice is at its limit, we fall back to any
+# server that isn't.  Returns the server, or None along with whether that
+# was because the servers were all full.
+
+def try_acquire_backend(state, key, tried):
+    balanced_load = state.balanced_load
+    server = balanced_load.acquire(key, tried)
+    if (server == None):
+        return None, False
+    if (server.active <= server.limit):
+        return server, False
+    balanced_load.release(server)
+    full = [x for x in balanced_load.servers if x.active >= x.limit]
+    server = balanced_load.acquire(key, tried + full)
+    if (server == None):
+        return None, True
+    if (server.active <= server.limit):
+        return server, False
+    balanced_load.release(server)
+    return None, True
+
+# Pick a server for a request, waiting until the deadline for one to have
+# room if they are all full.  Trying again while holding the condition's
+# lock means a server freeing up can't slip by between our last try and
+# starting to wait.
+
+def acquire_backend(state, key, tried, deadline):
+    server, full = try_acquire_backend(state, key, tried)
+    if (not full):
+        return server, full
+    condition = state.admission.condition
+    with condition:
+        while True:
+            server, full = try_acquire_backend(state, key, tried)
+            if (not full):
+                return server, full
+            remaining = deadline - time.monotonic()
+            if (remaining <= 0):
+                return None, True
+            condition.wait(remaining)
+
+# Worker thread body.  Each worker pulls clients whose requests have arrived
+# off the shared queue, answers them and closes the connection.  A failure
+# on one client is reported and then forgotten so that it can't take the
+# worker down with it, whatever it was, and the client's connection and
+# place in the queue are always given up.
+
+def worker_loop(work_queue, state, args):
+    while True:
+        connection, request, headers = work_queue.get()
+        code, sent = None, 0
+        try:
+            connection.sock.setblocking(True)
+            connection.sock.settimeout(args.timeout)
+            code, sent = handle_client(connection, request, headers, state, args)
+        except (OSError, http_error) as e:
+            print('Error while handling client', connection.addr, ':', e)
+        except Exception as e:
+            print('Unexpected error while handling client', connection.addr, ':', repr(e))
+        finally:
+            state.admission.leave(connection)
+            connection.sock.close()
+            balancer_metrics.connections.dec()
+            balancer_metrics.request_finished(code, time.perf_counter() - connection.arrived, sent)
+
+# Read whatever a client has sent us and see if its request head is
+# complete.  Returns the request line and headers once it is, or None if we
+# are still waiting.  Raises ConnectionError if the client went away first.
+
+def read_client_request(connection):
+    data = connection.sock.recv(BUFFER_SIZE)
+    if (data == b''):
+        raise ConnectionError('client closed the connection without sending a request')
+    connection.parser.feed(data)
+    return connection.parser.next_head()
+
+# Accept clients and read their requests on an event loop in the main
+# thread, then hand each complete request to the pool of workers.  Nothing
+# on the loop ever blocks, so however many clients there are and however
+# slowly they send, everyone else's requests keep moving.
+
+def serve_forever(server_socket, state, args):
+
+    # Start up the pool of workers.  They are daemon threads so that they
+    # will not hold up shutdown when we get interrupted.
+
+    work_queue = queue.Queue()
+    for i in range(args.workers):
+        threading.Thread(target=worker_loop, args=(work_queue, state, args), daemon=True).start()
+
+    selector = selectors.DefaultSelector()
+    selector.register(server_socket, selectors.EVENT_READ)
+    last_sweep = time.monotonic()
+    print('Waiting for incoming client connections ...')
+
+    # Keep the balancer running forever.
+
+    while(1):
+        for key, mask in selector.select(timeout=1):
+
+            # New connections are accepted in a batch until the kernel has
+            # no more for us, and then watched until their requests arrive.
+
+            if (key.fileobj is server_socket):
+                while True:
+                    try:
+                        conn, addr = server_socket.accept()
+                    except BlockingIOError:
+                        break
+                    print('Accepted connection from client address:', addr)
+                    conn.setblocking(False)
+                    selector.register(conn, selectors.EVENT_READ, client_connection(conn, addr, args.timeout))
+                    balancer_metrics.accepted.inc()
+                    balancer_metrics.connections.inc()
+                continue
+
+            # A client has sent us more of its request.  Once the head is
+            # all there, it is passed on to a worker.
+
+            connection = key.data
+            try:
+                head = read_client_request(connection)
+            except BlockingIOError:
+                continue
+            except http_error as e:
+                print('Malformed request received from client:', e)
+                selector.unregister(connection.sock)
+                connection.sock.close()
+                balancer_metrics.connections.dec()
+                continue
+            except OSError as e:
+                print('Error while reading from client', connection.addr, ':', e)
+                selector.unregister(connection.sock)
+                connection.sock.close()
+                balancer_metrics.connections.dec()
+                continue
+            if (head == None):
+                continue
+            selector.unregister(connection.sock)
+            connection.arrived = time.perf_counter()
+
+            # If too many requests are waiting already, we turn the client
+            # away at once rather than make everyone wait longer.  The
+            # response is small enough to go out in one go on a fresh
+            # connection, and if it doesn't we are not going to wait for it.
+            # Requests for our metrics never wait, so they are always let in.
+
+            if (head[0].split(' ')[1:2] != [METRICS_PATH]) and (not state.admission.enter(connection)):
+                print('Too many requests waiting ... turning client', connection.addr, 'away!')
+                sent = 0
+                try:
+                    sent = connection.sock.send(prepare_overloaded_response())
+                except OSError:
+                    pass
+                connection.sock.close()
+                balancer_metrics.connections.dec()
+                balancer_metrics.request_finished('503', time.perf_counter() - connection.arrived, sent)
+                continue
+            work_queue.put((connection, head[0], head[1]))
+
+        # Once a second, close any connections that have gone past their
+        # deadline without sending a whole request.
+
+        now = time.monotonic()
+        if (now - last_sweep < 1):
+            continue
+        last_sweep = now
+        for key in list(selector.get_map().values()):
+            if (isinstance(key.data, client_connection)) and (now > key.data.deadline):
+                print('Client', key.data.addr, 'timed out sending its request.')
+                selector.unregister(key.fileobj)
+                key.fileobj.close()
+                balancer_metrics.connections.dec()
+
 # Our main function
 
 def main():
@@ -290,91 +1394,83 @@ def main():
 
     parser = argparse.ArgumentParser()
     parser.add_argument("config", help="File containing the host:port for all of the servers")
+    parser.add_argument("--port", type=int, default=0, help="Port to listen on; a free port is picked at random if not given")
+    parser.add_argument("--health-interval", type=float, default=DEFAULT_HEALTH_INTERVAL, help="Seconds between health checks of every server")
+    parser.add_argument("--state-file", default=DEFAULT_STATE_FILE, help="File to remember the servers' response times and health in between runs, or '' for none")
+    parser.add_argument("--state-max-age", type=float, default=DEFAULT_STATE_MAX_AGE, help="Seconds a remembered server state stays good for")
+    parser.add_argument("--load-aware", action="store_true", help="Weight servers by the load they report at " + STATUS_PATH + " rather than by timing a test download")
+    parser.add_argument("--redirect", action="store_true", help="Redirect clients to the chosen server with a 301 instead of proxying their requests")
+    parser.add_argument("--algorithm", choices=sorted(SELECTORS), default=DEFAULT_ALGORITHM, help="How requests are spread over the servers")
+    parser.add_argument("--backlog", type=int, default=DEFAULT_BACKLOG, help="Number of pending connections the kernel may queue")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="Number of worker threads passing requests on to the servers")
+    parser.add_argument("--timeout", type=float, default=DEFAULT_TIMEOUT, help="Seconds a client may take to send its request")
+    parser.add_argument("--backend-limit", type=int, default=DEFAULT_BACKEND_LIMIT, help="Most requests given to one server at once")
+    parser.add_argument("--queue-size", type=int, default=DEFAULT_QUEUE_SIZE, help="Most requests waiting for a server before clients are turned away")
+    parser.add_argument("--queue-timeout", type=float, default=DEFAULT_QUEUE_TIMEOUT, help="Seconds a request may wait for a server before it is turned away")
+    parser.add_argument("--adaptive-limits", action="store_true", help="Adjust each server's limit, up to --backend-limit, by how its response times hold up")
     args = parser.parse_args()
 
     # generate the balanced array of servers to manage client requests efficiently
 
-    balanced_load = generate_balanced_load(args.config)
+    limit = initial_limit(args.backend_limit, args.adaptive_limits)
+    try:
+        servers = [server_data(host, port, limit=limit) for host, port in read_server_addresses(args.config)]
+    except (OSError, ValueError) as e:
+        print('Error: ' + str(e))
+        sys.exit(1)
+
+    # If we know how the servers were doing a little while ago we can start
+    # with that and test them again in the background.  Otherwise we have to
+    # test them all before we can balance anything.
+
+    warm_start = load_balancer_state(servers, args.state_file, args.state_max_age)
+    if (warm_start):
+        print('Starting with the server state saved in ' + args.state_file + ', testing the servers again in the background ...')
+        balanced_load = build_balanced_load(args.algorithm, servers)
+    else:
+        balanced_load = generate_balanced_load(args.algorithm, servers)
+    if (len(balanced_load) == 0):
+        print('Error: None of the servers passed the performance test, so there is nothing to balance.')
+        sys.exit(1)
+    admission = admission_control(args.queue_size, args.queue_timeout)
+    state = balancer_state(servers, args.algorithm, balanced_load, admission, args.backend_limit, args.adaptive_limits, args.load_aware, args.state_file)
+    balancer_metrics.watch(state)
+    if (warm_start):
+        threading.Thread(target=refresh_balancer_state, args=(state,), daemon=True).start()
+    else:
+        save_balancer_state(state)
 
-    # Display the request_ratio array
-    
-    print("\nBelow is the load balancing array of servers:")
-    for x in balanced_load:
-        print("Server " + x.host + ":" + str(x.port) + ' RT: ' + str(x.response_time))
+    # Display the servers we are balancing over
+
+    print_balanced_load(balanced_load)
 
-    # DEFINETLEY WORKS UP TO HERE
+    # Keep checking the servers, and watching the config file for changes,
+    # in the background from now on.
+
+    threading.Thread(target=health_check_loop, args=(state, args.health_interval), daemon=True).start()
+    load_overloaded_page()
+    threading.Thread(target=config_watch_loop, args=(state, args.config), daemon=True).start()
 
     # The load balancer can now accept client requests
-    # Register our signal handler for shutting down.
+    # Register our signal handlers for shutting down and reloading.
 
     signal.signal(signal.SIGINT, signal_handler)
+    if (hasattr(signal, 'SIGHUP')):
+        signal.signal(signal.SIGHUP, reload_handler)
 
-    # Create the socket.  We will ask this to work on any interface and to pick
-    # a free port at random.  We'll print this out for clients to use.
+    # Create the socket.  We will ask this to work on any interface and, unless
+    # we were given a port, to pick a free port at random.  We'll print this
+    # out for clients to use.
 
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server_socket.settimeout(TIMEOUT_TIME)
-    server_socket.bind(('', 0))
+    if (args.port != 0):
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server_socket.bind(('', args.port))
     print('Will wait for client connections at port ' + str(server_socket.getsockname()[1]))
-    server_socket.listen(1)
-    
-    # Keep the server running forever.
-    
-    while(1):
-
-        try:
-            print('Waiting for incoming client connection ...')
-            conn, addr = server_socket.accept()
-            print('Accepted connection from client address:', addr)
-            print('Connection to client established, waiting to receive message...')
-
-            # We obtain our request from the socket.  We look at the request and
-            # figure out what to do based on the contents of things.
-
-            request = get_line_from_socket(conn)
-            print('Received request:  ' + request)
-            request_list = request.split()
-
-            # This server doesn't care about headers, so we just clean them up.
-
-            while (get_line_from_socket(conn) != ''):
-                pass
-
-            # If we did not get a GET command respond with a 501.
-
-            if request_list[0] != 'GET':
-                print('Invalid type of request received ... responding with error!')
-                send_response_to_client(conn, '501', '501.html')
-
-            # If we did not get the proper HTTP version respond with a 505.
-
-            elif request_list[2] != 'HTTP/1.1':
-                print('Invalid HTTP version received ... responding with error!')
-                send_response_to_client(conn, '505', '505.html')
-
-            # We have the right request and version, so check if file exists.
-                    
-            else:
-
-                # Select a server from the balanced_load array to redirect the client to
-
-                selected_server = balanced_load[random.randint(0,len(balanced_load)-1)]
-
-                send_redirection_to_client(conn,'301','301.html',selected_server.host,selected_server.port)
-
-            # We are all done with this client, so close the connection and
-            # Go back to get another one!
-
-            conn.close();
-
-        except OSError:
-
-            print("\nBelow is the load balancing array of servers:")
-            balanced_load = generate_balanced_load(args.config)
-
-            for x in balanced_load:
-                print("Server " + x.host + ":" + str(x.port) + ' RT: ' + str(x.response_time))
+    server_socket.listen(args.backlog)
+    server_socket.setblocking(False)
 
+    serve_forever(server_socket, state, args)
 
 
 if __name__ == '__main__':
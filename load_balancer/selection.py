@@ -0,0 +1,237 @@
+import bisect
+import hashlib
+import heapq
+import itertools
+import math
+import random
+import threading
+
+# Backend selection algorithms for the load balancer.
+#
+# Every selector is built over a list of servers, each of which has a host
+# and port, a response_time (the measured time, in seconds, to serve the
+# test file), a latency (a moving average of how long real requests take),
+# and a count of the requests it is handling right now.  The balancer calls
+# acquire() to pick a server for a request and release() once the request is
+# finished.  Selectors are never changed once built; when the servers or
+# their weights change the balancer simply builds a new one.
+
+# The weight the newest request gets in each server's latency average.
+
+LATENCY_WEIGHT = 0.2
+
+# Response times are never taken to be shorter than this, so that a server
+# timed at zero can't take every request.
+
+MIN_RESPONSE_TIME = 0.000001
+
+# For consistent hashing, how many points each server gets on the ring, and
+# how far above the average number of requests in progress a server can go
+# before further requests for its keys spill over to the next server.
+
+VIRTUAL_NODES = 100
+LOAD_FACTOR = 1.25
+
+# Active request counts are shared by every selector built over a server, so
+# they are all updated under one lock.
+
+active_lock = threading.Lock()
+
+# The interface every selection algorithm follows.  Subclasses provide
+# select(), and can override changed() to hear about a server's active count
+# going up or down.
+
+class backend_selector:
+    def __init__(self, servers):
+        self.servers = list(servers)
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.servers)
+
+    # Pick a server for a request and count it as active.  The key is what
+    # the request is for, which only some algorithms care about.  Servers in
+    # exclude have already failed this request, so if the algorithm picks one
+    # of them we fall back to the least busy of the rest.  Returns None if
+    # there is no one left to pick.
+
+    def acquire(self, key=None, exclude=()):
+        with self.lock:
+            if (len(self.servers) == 0):
+                return None
+            server = self.select(key)
+        if (server in exclude):
+            others = [x for x in self.servers if x not in exclude]
+            if (len(others) == 0):
+                return None
+            server = min(others, key=lambda x: x.active)
+        self.claim(server)
+        return server
+
+    # Count a request as active on a server the balancer picked itself.
+
+    def claim(self, server):
+        with active_lock:
+            server.active += 1
+        self.changed(server)
+
+    # Mark a request as finished, folding how long it took into the server's
+    # latency average if we know.
+
+    def release(self, server, response_time=None):
+        with active_lock:
+            server.active -= 1
+            if (response_time != None):
+                server.latency = LATENCY_WEIGHT * response_time + (1 - LATENCY_WEIGHT) * server.latency
+        self.changed(server)
+
+    def select(self, key):
+        raise NotImplementedError
+
+    def changed(self, server):
+        pass
+
+# Plain round-robin: every server in turn, regardless of speed.  O(1).
+
+class round_robin_selector(backend_selector):
+    def __init__(self, servers):
+        super().__init__(servers)
+        self.counter = itertools.count()
+
+    def select(self, key):
+        return self.servers[next(self.counter) % len(self.servers)]
+
+# Smooth weighted round-robin, with each server's weight proportional to its
+# measured speed, the inverse of its response time.  Picks are spread evenly
+# rather than in bursts: each server has a virtual time at which it is next
+# due, which advances by its response time every time it is picked, and the
+# server due soonest goes next.  Keeping the servers in a heap by that time
+# makes each pick O(log n).
+
+class weighted_round_robin_selector(backend_selector):
+    def __init__(self, servers):
+        super().__init__(servers)
+        self.steps = [max(x.response_time, MIN_RESPONSE_TIME) for x in self.servers]
+        self.heap = [(step, i) for i, step in enumerate(self.steps)]
+        heapq.heapify(self.heap)
+
+    def select(self, key):
+        due, i = self.heap[0]
+        heapq.heapreplace(self.heap, (due + self.steps[i], i))
+        return self.servers[i]
+
+# Least-connections: the server with the fewest requests in flight, with ties
+# going to whichever has waited longest.  The servers sit in a heap by active
+# count.  Since counts change all the time, a changed count just pushes a new
+# entry and older entries for the server are skipped when they reach the top,
+# so both picking and releasing are O(log n).  The heap is rebuilt when the
+# stale entries start to pile up.
+
+class least_connections_selector(backend_selector):
+    def __init__(self, servers):
+        super().__init__(servers)
+        self.index = {id(x): i for i, x in enumerate(self.servers)}
+        self.sequence = itertools.count()
+        self.rebuild()
+
+    def rebuild(self):
+        self.latest = [next(self.sequence) for x in self.servers]
+        self.heap = [(x.active, self.latest[i], i) for i, x in enumerate(self.servers)]
+        heapq.heapify(self.heap)
+
+    # Give a server a new entry in the heap with its current count.  Only the
+    # newest entry for each server counts; the rest are stale.
+
+    def push(self, i, replace=False):
+        self.latest[i] = next(self.sequence)
+        entry = (self.servers[i].active, self.latest[i], i)
+        if (replace):
+            heapq.heapreplace(self.heap, entry)
+        else:
+            heapq.heappush(self.heap, entry)
+
+    def select(self, key):
+        while True:
+            active, sequence, i = self.heap[0]
+            if (sequence != self.latest[i]):
+                heapq.heappop(self.heap)
+            elif (active != self.servers[i].active):
+                self.push(i, True)
+            else:
+                return self.servers[i]
+
+    def changed(self, server):
+        i = self.index.get(id(server))
+        if (i == None):
+            return
+        with self.lock:
+            self.push(i)
+            if (len(self.heap) > 4 * len(self.servers) + 16):
+                self.rebuild()
+
+# Power of two choices: look at two servers picked at random and take the
+# one expected to answer sooner, judging by its recent latency and how many
+# requests it already has.  O(1), and it avoids the herd behaviour of always
+# picking the single best looking server.
+
+class two_choices_selector(backend_selector):
+    def select(self, key):
+        if (len(self.servers) == 1):
+            return self.servers[0]
+        first, second = random.sample(self.servers, 2)
+        if (first.latency * (first.active + 1) <= second.latency * (second.active + 1)):
+            return first
+        return second
+
+# Consistent hashing: requests for the same key, the path of the file
+# requested, keep going to the same server, so each file only needs to be
+# warm in one server's cache.  Every server is hashed onto a ring at many
+# points, and a key goes to the first server at or after where it lands.
+# The points depend only on each server's address, so a server joining or
+# leaving only moves the keys next to its own points, about 1/n of them, and
+# rebuilding the ring as weights change moves none.
+#
+# To keep a popular file from swamping its server, no server may have more
+# than LOAD_FACTOR times its share of the requests in progress.  A key whose
+# server is full carries on round the ring to the next one that isn't.
+
+class consistent_hash_selector(backend_selector):
+    def __init__(self, servers):
+        super().__init__(servers)
+        self.ring = []
+        for i, x in enumerate(self.servers):
+            for node in range(VIRTUAL_NODES):
+                self.ring.append((hash_key(x.host + ':' + str(x.port) + '#' + str(node)), i))
+        self.ring.sort()
+        self.points = [point for point, i in self.ring]
+
+    def select(self, key):
+        total = sum(x.active for x in self.servers)
+        capacity = math.ceil(LOAD_FACTOR * (total + 1) / len(self.servers))
+        start = bisect.bisect_left(self.points, hash_key(key or ''))
+        for step in range(len(self.ring)):
+            server = self.servers[self.ring[(start + step) % len(self.ring)][1]]
+            if (server.active < capacity):
+                return server
+        return self.servers[self.ring[start % len(self.ring)][1]]
+
+# Hash a key to a point on the consistent hash ring.  Python's own hash() is
+# different in every process, so we use one that is the same everywhere.
+
+def hash_key(key):
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+# The algorithms that can be chosen from the command line.
+
+SELECTORS = {
+    'weighted': weighted_round_robin_selector,
+    'least-connections': least_connections_selector,
+    'two-choices': two_choices_selector,
+    'round-robin': round_robin_selector,
+    'consistent-hash': consistent_hash_selector,
+}
+
+# Build a selector of the named kind over the given servers.
+
+def build_selector(algorithm, servers):
+    return SELECTORS[algorithm](servers)
@@ -0,0 +1,181 @@
+import bisect
+import threading
+
+# Shared in-process metrics used by the server and the balancer, served at
+# METRICS_PATH in the Prometheus text format.
+#
+# Updating a metric is meant to be cheap enough to do on every request: one
+# short lock, a dictionary lookup and an addition.  Histograms have fixed
+# buckets, so recording a time is a binary search rather than keeping every
+# sample.  All of the work of formatting is left until someone asks for the
+# metrics.  Values that are already kept elsewhere, such as a cache's hit
+# count, are read through a function at that point instead of being counted
+# twice.
+
+# Where the metrics are served, and the content type Prometheus expects.
+
+METRICS_PATH = '/metrics'
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Default histogram buckets for request times, in seconds.
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Format a value for the text format, which spells infinity its own way.
+
+def format_value(value):
+    if (value == float('inf')):
+        return '+Inf'
+    if (isinstance(value, float)) and (value.is_integer()):
+        return str(int(value))
+    return repr(value) if (isinstance(value, float)) else str(value)
+
+# Format a set of labels as {name="value",...}, escaping the characters the
+# text format needs escaped.  No labels at all formats as nothing.
+
+def format_labels(names, values):
+    if (len(names) == 0):
+        return ''
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(name + '="' + value + '"')
+    return '{' + ','.join(pairs) + '}'
+
+# The parts every metric has: a name, a line of help, its type and the
+# names of its labels.  Values are kept by their label values, in order.
+
+class metric:
+    kind = 'untyped'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    # Return the HELP and TYPE lines followed by a line for every sample.
+    # Any fixed labels, as names and values, come ahead of the sample's own.
+
+    def render(self, fixed=((), ())):
+        lines = ['# HELP ' + self.name + ' ' + self.help, '# TYPE ' + self.name + ' ' + self.kind]
+        for name, (names, values), value in self.samples():
+            lines.append(name + format_labels(fixed[0] + names, fixed[1] + values) + ' ' + format_value(value))
+        return '\n'.join(lines)
+
+    # Yield the name, label names and values, and value of every sample.
+
+    def samples(self):
+        with self.lock:
+            values = list(self.values.items())
+        for label_values, value in sorted(values):
+            yield self.name, (self.labels, label_values), value
+
+# A count that only ever goes up, such as requests answered.
+
+class counter(metric):
+    kind = 'counter'
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+# A value that can go up and down, such as connections open.
+
+class gauge(metric):
+    kind = 'gauge'
+
+    def set(self, value, *label_values):
+        with self.lock:
+            self.values[label_values] = value
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def dec(self, *label_values, amount=1):
+        self.inc(*label_values, amount=-amount)
+
+# A counter or gauge whose values are looked up when the metrics are asked
+# for.  The function returns a number, or if there are labels, a dictionary
+# from tuples of label values to numbers.
+
+class collected(metric):
+    def __init__(self, name, help, kind, function, labels=()):
+        super().__init__(name, help, labels)
+        self.kind = kind
+        self.function = function
+
+    def samples(self):
+        values = self.function()
+        if (len(self.labels) == 0):
+            values = {(): values}
+        for label_values, value in sorted(values.items()):
+            if (value != None):
+                yield self.name, (self.labels, label_values), value
+
+# A histogram with fixed buckets.  Each set of label values has a count for
+# every bucket, plus the total and number of everything observed.  Buckets
+# are counted separately and added up when reported, since Prometheus wants
+# each bucket to include all the smaller ones.
+
+class histogram(metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS, labels=()):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(label_values)
+            if (entry == None):
+                entry = [[0] * (len(self.buckets) + 1), 0.0, 0]
+                self.values[label_values] = entry
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def samples(self):
+        with self.lock:
+            values = [(label_values, (list(counts), total, count)) for label_values, (counts, total, count) in self.values.items()]
+        for label_values, (counts, total, count) in sorted(values):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                yield self.name + '_bucket', (self.labels + ('le',), label_values + (format_value(float(bound)),)), cumulative
+            yield self.name + '_sum', (self.labels, label_values), total
+            yield self.name + '_count', (self.labels, label_values), count
+
+# Every metric one program reports, in the order they were created.  Any
+# labels given are added to every sample, to tell apart processes that each
+# report the same metrics, such as the worker processes of one server.
+
+class metrics_registry:
+    def __init__(self, labels=None):
+        self.metrics = []
+        labels = labels or {}
+        self.labels = (tuple(labels), tuple(str(value) for value in labels.values()))
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.add(counter(name, help, labels))
+
+    def gauge(self, name, help, labels=()):
+        return self.add(gauge(name, help, labels))
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS, labels=()):
+        return self.add(histogram(name, help, buckets, labels))
+
+    def collected(self, name, help, kind, function, labels=()):
+        return self.add(collected(name, help, kind, function, labels))
+
+    # Return every metric in the text format.
+
+    def render(self):
+        return '\n'.join(metric.render(self.labels) for metric in self.metrics) + '\n'
@@ -3,15 +3,124 @@ import os
 import datetime
 import signal
 import sys
+import argparse
+import selectors
+import threading
+import queue
+import time
+import stat
+import collections
+import uuid
+import email.utils
+import gzip
+import zlib
+import json
 
-# Constant for our buffer size
+# Defaults for the concurrent serving engine.  The backlog is the number of
+# connections the kernel will queue for us before we accept them, the workers
+# are the threads that actually process requests, and the timeout is how long
+# a client gets to send us its request before we give up on it.
+
+DEFAULT_BACKLOG = 128
+DEFAULT_WORKERS = 16
+DEFAULT_TIMEOUT = 30
+
+# Defaults for persistent connections.  An idle connection is closed after
+# the keep-alive timeout, and every connection is closed after it has served
+# the maximum number of requests.
+
+DEFAULT_KEEP_ALIVE_TIMEOUT = 5
+DEFAULT_MAX_REQUESTS = 100
+
+# Defaults for the in-memory content cache.  The cache holds at most this
+# many bytes of file bodies, and files bigger than the per-file limit are
+# always sent straight from disk.
+
+DEFAULT_CACHE_SIZE = 64 * 1024 * 1024
+DEFAULT_CACHE_FILE_LIMIT = 1024 * 1024
+
+# Defaults for compression.  Text files are compressed on the fly when the
+# client accepts it, and the results are kept in a cache of their own.  Files
+# smaller than the minimum aren't worth the trouble.
+
+DEFAULT_COMPRESSION_CACHE_SIZE = 16 * 1024 * 1024
+MIN_COMPRESS_SIZE = 256
+
+# The content codings we can produce, in the order we prefer them, and the
+# content types worth compressing.  Images like jpeg and gif are already
+# compressed, so we leave them alone.
+
+SUPPORTED_ENCODINGS = ['gzip', 'deflate']
+COMPRESSIBLE_TYPES = ['application/javascript', 'application/json', 'image/svg+xml']
+
+# The most ranges we will serve for one request.  Anything asking for more
+# than this just gets the whole file.
+
+MAX_RANGES = 16
+
+# In pre-fork mode, a worker process that dies within this many seconds of
+# starting is restarted only after the same delay, so that a worker that
+# crashes straight away doesn't have us forking in a tight loop.
+
+RESTART_DELAY = 1
+
+# The path at which the server reports how busy it is, how many seconds of
+# requests its rates and latency percentiles are worked out over, and the
+# most requests in that time its percentiles come from.
+
+STATUS_PATH = '/_status'
+STATUS_WINDOW = 10
+STATUS_LATENCIES = 1000
+
+# Size of the buffer used to drain the event loop's wakeup socket.
 
 BUFFER_SIZE = 1024
 
-# Signal handler for graceful exiting.
+# Our shared HTTP helpers live alongside this program or one directory up.
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from httputil import socket_reader, http_error, is_digits, content_length, send_head, send_file
+from metrics import METRICS_PATH, CONTENT_TYPE, metrics_registry
+
+# The cache of hot files shared by all of the workers.  It is set up in
+# serve_forever() once we know how big it is allowed to be.
+
+content_cache = None
+
+# The cache of compressed copies of files, set up alongside it.
+
+compressed_cache = None
+
+# The load statistics reported at STATUS_PATH, also set up alongside it.
+# In pre-fork mode each worker process reports its own.
+
+server_load = None
+
+# The counters and histograms served at METRICS_PATH, also set up alongside
+# it, and likewise kept by each worker process for itself.
+
+server_metrics = None
+
+# In pre-fork mode, the slot this worker process fills and the process id
+# of the master that started it.
+
+worker_slot = None
+master_pid = None
+
+# In pre-fork mode, the process ids of our worker processes, mapped to the
+# slot each one fills.  This is only ever filled in by the master process.
+
+worker_pids = {}
+
+# Signal handler for graceful exiting.  In pre-fork mode the master process
+# takes its worker processes down with it.
 
 def signal_handler(sig, frame):
     print('Interrupt received, shutting down ...')
+    stop_worker_processes()
+    if (content_cache != None):
+        print('Content cache:', content_cache.stats())
+        print('Compressed cache:', compressed_cache.stats())
     sys.exit(0)
 
 # Create an HTTP response
@@ -28,14 +137,25 @@ def prepare_response_message(value):
         message = message + value + ' Method Not Implemented\r\n' + date_string + '\r\n'
     elif value == '505':
         message = message + value + ' Version Not Supported\r\n' + date_string + '\r\n'
+    elif value == '206':
+        message = message + value + ' Partial Content\r\n' + date_string + '\r\n'
+    elif value == '416':
+        message = message + value + ' Range Not Satisfiable\r\n' + date_string + '\r\n'
+    elif value == '304':
+        message = message + value + ' Not Modified\r\n' + date_string + '\r\n'
     return message
 
-# Send the given response and file back to the client.
+# Build the headers telling the client whether we will keep the connection
+# open after this response.
 
-def send_response_to_client(sock, code, file_name):
+def prepare_connection_header(keep_alive, settings):
+    if (keep_alive):
+        return 'Connection: keep-alive\r\nKeep-Alive: timeout=' + str(int(settings.keep_alive_timeout)) + ', max=' + str(settings.max_requests) + '\r\n'
+    return 'Connection: close\r\n'
 
-    # Determine content type of file
+# Determine the content type of a file from its name.
 
+def get_content_type(file_name):
     if ((file_name.endswith('.jpg')) or (file_name.endswith('.jpeg'))):
         type = 'image/jpeg'
     elif (file_name.endswith('.gif')):
@@ -44,121 +164,1002 @@ def send_response_to_client(sock, code, file_name):
         type = 'image/jpegpng'
     elif ((file_name.endswith('.html')) or (file_name.endswith('.htm'))):
         type = 'text/html'
+    elif (file_name.endswith('.txt')):
+        type = 'text/plain'
+    elif (file_name.endswith('.css')):
+        type = 'text/css'
+    elif (file_name.endswith('.js')):
+        type = 'application/javascript'
+    elif (file_name.endswith('.json')):
+        type = 'application/json'
+    elif (file_name.endswith('.svg')):
+        type = 'image/svg+xml'
     else:
         type = 'application/octet-stream'
-    
-    # Get size of file
+    return type
 
-    file_size = os.path.getsize(file_name)
+# Decide whether a content type is worth compressing.
 
-    # Construct header and send it
+def is_compressible(type):
+    return (type.startswith('text/')) or (type in COMPRESSIBLE_TYPES)
 
-    header = prepare_response_message(code) + 'Content-Type: ' + type + '\r\nContent-Length: ' + str(file_size) + '\r\n\r\n'
-    sock.send(header.encode())
+# Everything we need to serve one file: the details we use to tell whether
+# it has changed on disk, the headers describing it, including the ETag and
+# Last-Modified validators clients use to check their copies are current,
+# and, if it is small enough to be worth keeping, its body.  When the file
+# is an error page, it goes out with just its type and length, since the
+# validators and ranges would describe the page rather than what was asked
+# for.
 
-    # Open the file, read it, and send it
+class cached_file:
+    def __init__(self, file_name, info):
+        self.file_name = file_name
+        self.mtime = info.st_mtime_ns
+        self.size = info.st_size
+        self.type = get_content_type(file_name)
+        self.etag = '"' + format(self.mtime, 'x') + '-' + format(self.size, 'x') + '"'
+        self.last_modified = email.utils.formatdate(info.st_mtime, usegmt=True)
+        self.validators = 'ETag: ' + self.etag + '\r\nLast-Modified: ' + self.last_modified + '\r\n'
+        self.header = 'Content-Type: ' + self.type + '\r\nAccept-Ranges: bytes\r\n' + self.validators + 'Content-Length: ' + str(self.size) + '\r\n\r\n'
+        if (is_compressible(self.type)):
+            self.header = 'Vary: Accept-Encoding\r\n' + self.header
+        self.error_header = 'Content-Type: ' + self.type + '\r\nContent-Length: ' + str(self.size) + '\r\n\r\n'
+        self.body = None
 
-    with open(file_name, 'rb') as file_to_send:
-        while True:
-            chunk = file_to_send.read(BUFFER_SIZE)
-            if chunk:
-                sock.send(chunk)
-            else:
-                break
+# A compressed copy of a file.  It looks just like a cached_file to the code
+# that sends it, but carries a Content-Encoding header and an ETag of its
+# own, since it is a different set of bytes from the original.  The body is
+# either held in memory or read from a precompressed file on disk.
 
-# Read a single line (ending with \n) from a socket and return it.
-# We will strip out the \r and the \n in the process.
+class encoded_file:
+    def __init__(self, entry, encoding, size, body, file_name):
+        self.file_name = file_name
+        self.mtime = entry.mtime
+        self.size = size
+        self.type = entry.type
+        self.encoding = encoding
+        self.etag = entry.etag[:-1] + '-' + encoding + '"'
+        self.last_modified = entry.last_modified
+        self.validators = 'ETag: ' + self.etag + '\r\nLast-Modified: ' + self.last_modified + '\r\n'
+        self.header = 'Content-Type: ' + self.type + '\r\nContent-Encoding: ' + encoding + '\r\nVary: Accept-Encoding\r\n' + self.validators + 'Content-Length: ' + str(self.size) + '\r\n\r\n'
+        self.body = body
 
-def get_line_from_socket(sock):
+# A byte-bounded LRU cache of file bodies and their prebuilt headers.  Every
+# lookup still stats the file, and an entry whose modification time or size
+# no longer matches is thrown away and reloaded.  The workers share one
+# cache, so everything is done under a lock.
 
-    done = False
-    line = ''
-    while (not done):
-        char = sock.recv(1).decode()
-        if (char == '\r'):
-            pass
-        elif (char == '\n'):
-            done = True
+class file_cache:
+    def __init__(self, max_bytes, max_file_bytes):
+        self.max_bytes = max_bytes
+        self.max_file_bytes = min(max_file_bytes, max_bytes)
+        self.entries = collections.OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    # Look up a file, returning a cached_file describing it or None if there
+    # is no such regular file.  The body is filled in when the file is small
+    # enough to keep in memory.
+
+    def lookup(self, file_name):
+        try:
+            info = os.stat(file_name)
+        except (OSError, ValueError):
+            return None
+        if (not stat.S_ISREG(info.st_mode)):
+            return None
+
+        with self.lock:
+            entry = self.entries.get(file_name)
+            if (entry != None) and (entry.mtime == info.st_mtime_ns) and (entry.size == info.st_size):
+                self.entries.move_to_end(file_name)
+                self.hits += 1
+                return entry
+            self.misses += 1
+            if (entry != None):
+                self.remove(file_name)
+
+        # Build a new entry outside the lock so that other workers are not
+        # held up by our disk read.
+
+        entry = cached_file(file_name, info)
+        if (entry.size > self.max_file_bytes):
+            return entry
+        try:
+            with open(file_name, 'rb') as file_to_read:
+                body = file_to_read.read(entry.size + 1)
+        except OSError:
+            return None
+        if (len(body) != entry.size):
+            return entry
+        entry.body = body
+
+        # Make room for the new entry by dropping the least recently used.
+
+        with self.lock:
+            if (file_name in self.entries):
+                self.remove(file_name)
+            while (self.bytes + entry.size > self.max_bytes):
+                self.remove(next(iter(self.entries)))
+                self.evictions += 1
+            self.entries[file_name] = entry
+            self.bytes += entry.size
+        return entry
+
+    # Drop an entry.  The caller must hold the lock.
+
+    def remove(self, file_name):
+        entry = self.entries.pop(file_name)
+        self.bytes -= entry.size
+
+    # Report the cache counters.
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'bytes': self.bytes, 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+# A byte-bounded LRU cache of files we have compressed on the fly.  Entries
+# are keyed by file and encoding and are only used while their ETag still
+# matches the file's, so a changed file is compressed afresh.
+
+class encoding_cache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    # Find the compressed copy of a file with the given ETag, or None.
+
+    def get(self, key, etag):
+        with self.lock:
+            entry = self.entries.get(key)
+            if (entry != None) and (entry.etag == etag):
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            self.misses += 1
+            return None
+
+    # Add a compressed copy, dropping the least recently used to make room.
+
+    def put(self, key, entry):
+        if (entry.size > self.max_bytes):
+            return
+        with self.lock:
+            if (key in self.entries):
+                self.bytes -= self.entries.pop(key).size
+            while (self.bytes + entry.size > self.max_bytes):
+                self.bytes -= self.entries.popitem(last=False)[1].size
+                self.evictions += 1
+            self.entries[key] = entry
+            self.bytes += entry.size
+
+    # Report the cache counters.
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'bytes': self.bytes, 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+# Pick the content coding to use from a client's Accept-Encoding header.
+# We go with whichever of ours the client rates highest, breaking ties by
+# our own preference, and return None if it takes none of them.
+
+def choose_encoding(headers):
+    quality = {}
+    for item in headers.get('accept-encoding', '').split(','):
+        coding, sep, params = item.strip().partition(';')
+        q = 1.0
+        for param in params.split(';'):
+            name, sep, value = param.strip().partition('=')
+            if (name.strip().lower() == 'q'):
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        quality[coding.strip().lower()] = q
+    best = None
+    for encoding in SUPPORTED_ENCODINGS:
+        q = quality.get(encoding, quality.get('*', 0.0))
+        if (q > 0) and ((best == None) or (q > best[1])):
+            best = (encoding, q)
+    return None if (best == None) else best[0]
+
+# Compress a body with the given content coding.
+
+def compress_body(body, encoding):
+    if (encoding == 'gzip'):
+        return gzip.compress(body, mtime=0)
+    return zlib.compress(body)
+
+# Choose what to send for a file: the file itself, or a compressed copy if
+# the client accepts one and the file is worth compressing.  A precompressed
+# file.gz sitting next to the file is used when it is at least as new as the
+# file.  Otherwise we compress the file ourselves, as long as it is small
+# enough to be in the content cache, and keep the result for next time.
+
+def choose_representation(entry, headers):
+
+    if (not is_compressible(entry.type)) or (entry.size < MIN_COMPRESS_SIZE):
+        return entry
+    encoding = choose_encoding(headers)
+    if (encoding == None):
+        return entry
+
+    if (encoding == 'gzip'):
+        sidecar = content_cache.lookup(entry.file_name + '.gz')
+        if (sidecar != None) and (sidecar.mtime >= entry.mtime):
+            return encoded_file(entry, encoding, sidecar.size, sidecar.body, sidecar.file_name)
+
+    if (entry.body == None):
+        return entry
+    key = (entry.file_name, encoding)
+    encoded = compressed_cache.get(key, entry.etag[:-1] + '-' + encoding + '"')
+    if (encoded != None):
+        return encoded
+    body = compress_body(entry.body, encoding)
+    if (len(body) >= entry.size):
+        return entry
+    encoded = encoded_file(entry, encoding, len(body), body, entry.file_name)
+    compressed_cache.put(key, encoded)
+    return encoded
+
+# Send the given response and file back to the client.  Any extra headers,
+# such as the connection headers, are passed along by the caller.  The file
+# comes from the content cache, so hot files are sent straight from memory
+# and only large ones are read from disk.  Anything other than a success is
+# an error page, which is sent without the page's own validators.
+
+def send_response_to_client(sock, code, file_name, extra_headers='Connection: close\r\n', entry=None):
+
+    # Find the file in the cache.
+
+    if (entry == None):
+        entry = content_cache.lookup(file_name)
+    if (entry == None):
+        raise FileNotFoundError('Unable to serve ' + file_name)
+
+    # Construct header and send it along with the body if we have it.
+
+    header = prepare_response_message(code) + extra_headers + (entry.header if (code.startswith('2')) else entry.error_header)
+    if (entry.body != None):
+        sock.sendall(header.encode() + entry.body)
+        return len(header) + entry.size
+
+    # Otherwise open the file and let the kernel send it
+
+    send_head(sock, header)
+    with open(entry.file_name, 'rb') as file_to_send:
+        send_file(sock, file_to_send, 0, entry.size)
+    return len(header) + entry.size
+
+# Check whether an entity tag from a client matches a file's, using the weak
+# comparison that conditional GETs call for.
+
+def etag_matches(value, entry):
+    for tag in value.split(','):
+        tag = tag.strip()
+        if (tag == '*') or (tag.removeprefix('W/') == entry.etag):
+            return True
+    return False
+
+# Check whether a validator date from a client is at or after the time a
+# file was last modified.  Unreadable dates never match.
+
+def unmodified_since(value, entry):
+    try:
+        since = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return False
+    if (since.tzinfo == None):
+        since = since.replace(tzinfo=datetime.timezone.utc)
+    return (entry.mtime // 1000000000 <= since.timestamp())
+
+# Decide whether the client's cached copy of a file is still current, so
+# that a 304 will do instead of the file.  If-None-Match wins over
+# If-Modified-Since when both are sent.
+
+def is_not_modified(headers, entry):
+    if ('if-none-match' in headers):
+        return etag_matches(headers['if-none-match'], entry)
+    if ('if-modified-since' in headers):
+        return unmodified_since(headers['if-modified-since'], entry)
+    return False
+
+# Decide whether a Range request still applies.  With If-Range the client
+# only wants the range if the file is the version it already has part of,
+# and otherwise wants the whole thing.
+
+def range_still_applies(headers, entry):
+    if ('if-range' not in headers):
+        return True
+    value = headers['if-range'].strip()
+    if (value.startswith('"')):
+        return (value == entry.etag)
+    return unmodified_since(value, entry)
+
+# Work out which byte ranges of a file of the given size a Range header asks
+# for, as a sorted list of (first, last) byte positions with any overlaps
+# merged.  We handle plain ranges (500-999), open ranges (500-) and suffix
+# ranges (-500).  Returns None if the header should be ignored, in which
+# case the whole file is sent, and an empty list if none of the ranges
+# overlap the file, which calls for a 416.  A header that is badly written in
+# any way is ignored, as the HTTP spec asks, rather than answered with a 416.
+
+def parse_range_header(value, size):
+    unit, sep, range_set = value.partition('=')
+    if (unit.strip().lower() != 'bytes') or (sep == ''):
+        return None
+    specs = [spec.strip() for spec in range_set.split(',') if spec.strip() != '']
+    if (len(specs) == 0):
+        return None
+    ranges = []
+    for spec in specs:
+        first, sep, last = spec.partition('-')
+        bounds = [bound for bound in (first, last) if (bound != '')]
+        if (sep == '') or (len(bounds) == 0) or (not all(is_digits(bound) for bound in bounds)):
+            return None
+        if (first == ''):
+            length = int(last)
+            if (length == 0):
+                continue
+            first = max(size - length, 0)
+            last = size - 1
+        else:
+            first = int(first)
+            if (last == ''):
+                last = size - 1
+            elif (int(last) < first):
+                return None
+            else:
+                last = min(int(last), size - 1)
+        if (first < size):
+            ranges.append((first, last))
+    if (len(ranges) > MAX_RANGES):
+        return None
+    ranges.sort()
+    merged = []
+    for first, last in ranges:
+        if (len(merged) > 0) and (first <= merged[-1][1] + 1):
+            merged[-1] = (merged[-1][0], max(merged[-1][1], last))
         else:
-            line = line + char
-    return line
+            merged.append((first, last))
+    return merged
 
-# Our main function.
+# Send part of a file's body, from memory if it is cached or else straight
+# from the open file.
 
-def main():
+def send_body_range(sock, entry, file_to_send, first, last):
+    if (entry.body != None):
+        sock.sendall(entry.body[first:last + 1])
+    else:
+        send_file(sock, file_to_send, first, last - first + 1)
 
-    # Register our signal handler for shutting down.
+# Send a 206 response carrying just the requested ranges of a file.  A single
+# range is sent as is, while several ranges are sent as a multipart/byteranges
+# body with each part described by its own little header.  Returns the
+# number of bytes sent.
 
-    signal.signal(signal.SIGINT, signal_handler)
+def send_ranges_to_client(sock, entry, ranges, extra_headers):
+
+    header = prepare_response_message('206') + extra_headers + 'Accept-Ranges: bytes\r\n' + entry.validators
+    if (len(ranges) == 1):
+        first, last = ranges[0]
+        length = last - first + 1
+        header = header + 'Content-Type: ' + entry.type + '\r\nContent-Range: bytes ' + str(first) + '-' + str(last) + '/' + str(entry.size) + '\r\nContent-Length: ' + str(length) + '\r\n\r\n'
+        parts = [('', first, last)]
+        closing = ''
+    else:
+        boundary = uuid.uuid4().hex
+        parts = []
+        for first, last in ranges:
+            part_header = '--' + boundary + '\r\nContent-Type: ' + entry.type + '\r\nContent-Range: bytes ' + str(first) + '-' + str(last) + '/' + str(entry.size) + '\r\n\r\n'
+
+            # Every part after the first starts on a new line.
+
+            if (len(parts) > 0):
+                part_header = '\r\n' + part_header
+            parts.append((part_header, first, last))
+        closing = '\r\n--' + boundary + '--\r\n'
+
+        # The length has to account for all of the part headers as well as
+        # the data itself.
+
+        length = len(closing) + sum(len(part_header) + last - first + 1 for part_header, first, last in parts)
+        header = header + 'Content-Type: multipart/byteranges; boundary=' + boundary + '\r\nContent-Length: ' + str(length) + '\r\n\r\n'
+
+    # Send the header and then each part in turn.
+
+    file_to_send = None if (entry.body != None) else open(entry.file_name, 'rb')
+    try:
+        send_head(sock, header)
+        for part_header, first, last in parts:
+            if (part_header != ''):
+                send_head(sock, part_header)
+            send_body_range(sock, entry, file_to_send, first, last)
+        if (closing != ''):
+            sock.sendall(closing.encode())
+    finally:
+        if (file_to_send != None):
+            file_to_send.close()
+    return len(header) + length
+
+# How busy the server is: the connections it has open, the requests it is
+# in the middle of, and, over the last few seconds, how many requests it has
+# answered, how much it has sent and how long the requests took.  Requests
+# and bytes are counted in one slot per second, reused as time goes round.
+# Requests for the status and metrics are left out of the latencies, so that
+# whoever is watching us doesn't skew what they see.
 
-    # Create the socket.  We will ask this to work on any interface and to pick
-    # a free port at random.  We'll print this out for clients to use.
+class load_stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.active = 0
+        self.requests = 0
+        self.slots = [[0, 0, 0] for i in range(STATUS_WINDOW)]
+        self.latencies = collections.deque(maxlen=STATUS_LATENCIES)
 
+    def connection_opened(self):
+        with self.lock:
+            self.connections += 1
+
+    def connection_closed(self):
+        with self.lock:
+            self.connections -= 1
+
+    def request_started(self):
+        with self.lock:
+            self.active += 1
+
+    def request_finished(self, elapsed, sent, timed=True):
+        now = time.monotonic()
+        second = int(now)
+        with self.lock:
+            self.active -= 1
+            self.requests += 1
+            slot = self.slots[second % STATUS_WINDOW]
+            if (slot[0] != second):
+                slot[:] = [second, 0, 0]
+            slot[1] += 1
+            slot[2] += sent
+            if (timed):
+                self.latencies.append((now, elapsed))
+
+    # Report the statistics as a dictionary ready to be turned into JSON.
+    # The request asking for them isn't counted as active.
+
+    def report(self):
+        now = time.monotonic()
+        with self.lock:
+            recent = [slot for slot in self.slots if int(now) - slot[0] < STATUS_WINDOW]
+            latencies = sorted(elapsed for finished, elapsed in self.latencies if now - finished < STATUS_WINDOW)
+            report = {
+                'connections': self.connections,
+                'active_requests': max(self.active - 1, 0),
+                'requests': self.requests,
+                'requests_per_second': sum(slot[1] for slot in recent) / STATUS_WINDOW,
+                'bytes_per_second': sum(slot[2] for slot in recent) / STATUS_WINDOW,
+            }
+        report['latency'] = {}
+        for name, fraction in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99)):
+            report['latency'][name] = latencies[min(int(len(latencies) * fraction), len(latencies) - 1)] if (len(latencies) > 0) else None
+        return report
+
+# The metrics we serve.  Requests are counted by status code as they finish,
+# along with how long they took and how much was sent.  Open connections,
+# requests in progress and the caches' counts are already kept elsewhere, so
+# they are read from there when the metrics are asked for.  A worker
+# process labels all of its metrics with its slot.
+
+class request_metrics:
+    def __init__(self, load, caches, worker=None):
+        self.registry = metrics_registry({'worker': worker} if (worker != None) else None)
+        self.requests = self.registry.counter('server_requests_total', 'Requests answered, by status code.', ('code',))
+        self.duration = self.registry.histogram('server_request_duration_seconds', 'Time taken to answer a request.')
+        self.sent = self.registry.counter('server_sent_bytes_total', 'Bytes sent in responses, headers included.')
+        self.accepted = self.registry.counter('server_connections_accepted_total', 'Client connections accepted.')
+        self.registry.collected('server_connections_active', 'Client connections open.', 'gauge', lambda: load.connections)
+        self.registry.collected('server_requests_active', 'Requests being answered.', 'gauge', lambda: load.active)
+        self.registry.collected('server_cache_hits_total', 'Cache lookups answered from memory.', 'counter', lambda: {(name,): cache.hits for name, cache in caches.items()}, ('cache',))
+        self.registry.collected('server_cache_misses_total', 'Cache lookups that had to go to the disk or compress.', 'counter', lambda: {(name,): cache.misses for name, cache in caches.items()}, ('cache',))
+        self.registry.collected('server_cache_evictions_total', 'Entries dropped to make room in a cache.', 'counter', lambda: {(name,): cache.evictions for name, cache in caches.items()}, ('cache',))
+        self.registry.collected('server_cache_bytes', 'Bytes held in a cache.', 'gauge', lambda: {(name,): cache.bytes for name, cache in caches.items()}, ('cache',))
+
+    # Count a finished request.  The code is None if the request failed
+    # before we got as far as answering it.
+
+    def request_finished(self, code, elapsed, sent):
+        if (code != None):
+            self.requests.inc(code)
+        self.duration.observe(elapsed)
+        self.sent.inc(amount=sent)
+
+# Send the server's metrics in the Prometheus text format.  Returns the
+# number of bytes sent.
+
+def send_metrics_to_client(sock, extra_headers):
+    body = server_metrics.registry.render().encode()
+    header = prepare_response_message('200') + extra_headers + 'Content-Type: ' + CONTENT_TYPE + '\r\nCache-Control: no-store\r\nContent-Length: ' + str(len(body)) + '\r\n\r\n'
+    sock.sendall(header.encode() + body)
+    return len(header) + len(body)
+
+# Send the server's load statistics as compact JSON.  Returns the number of
+# bytes sent.
+
+def send_status_to_client(sock, extra_headers):
+    body = json.dumps(server_load.report(), separators=(',', ':')).encode()
+    header = prepare_response_message('200') + extra_headers + 'Content-Type: application/json\r\nCache-Control: no-store\r\nContent-Length: ' + str(len(body)) + '\r\n\r\n'
+    sock.sendall(header.encode() + body)
+    return len(header) + len(body)
+
+# Everything we track about one client connection while it moves between
+# the event loop and the workers.
+
+class client_connection:
+    def __init__(self, sock, addr, timeout):
+        self.sock = sock
+        self.addr = addr
+        self.reader = socket_reader(sock)
+        self.head = None
+        self.requests = 0
+        self.deadline = time.monotonic() + timeout
+        self.idle = False
+
+# Decide whether a connection should stay open after answering a request.
+# HTTP/1.1 connections are persistent unless the client asks otherwise.
+
+def wants_keep_alive(request_list, headers):
+    tokens = [token.strip().lower() for token in headers.get('connection', '').split(',')]
+    if ('close' in tokens):
+        return False
+    if (len(request_list) >= 3) and (request_list[2] == 'HTTP/1.1'):
+        return True
+    return ('keep-alive' in tokens)
+
+# Process a single request that has already been read off the connection,
+# keeping track of it in the load statistics and metrics.  Returns True if
+# the connection can be used for another request.
+
+def handle_request(connection, request, headers, settings):
+    server_load.request_started()
+    start_time = time.perf_counter()
+    keep_alive, code, sent = False, None, 0
+    try:
+        keep_alive, code, sent = answer_request(connection, request, headers, settings)
+    finally:
+        elapsed = time.perf_counter() - start_time
+        server_load.request_finished(elapsed, sent, request.split(' ')[1:2] not in ([STATUS_PATH], [METRICS_PATH]))
+        server_metrics.request_finished(code, elapsed, sent)
+    return keep_alive
+
+# Answer a single request.  Returns whether the connection can be used for
+# another request, the status code sent and the number of bytes sent.
+
+def answer_request(connection, request, headers, settings):
+
+    conn = connection.sock
+    print('Received request:  ' + request)
+    request_list = request.split()
+
+    # Work out whether the client wants the connection kept open, and
+    # whether we are willing to.
+
+    keep_alive = wants_keep_alive(request_list, headers) and (connection.requests + 1 < settings.max_requests)
+
+    # If we did not get a GET command respond with a 501.  We can't be sure
+    # how much of what follows belongs to this request, so we close up.
+
+    if (len(request_list) == 0) or (request_list[0] != 'GET'):
+        print('Invalid type of request received ... responding with error!')
+        return False, '501', send_response_to_client(conn, '501', '501.html')
+
+    # If we did not get the proper HTTP version respond with a 505.
+
+    elif (len(request_list) < 3) or (request_list[2] != 'HTTP/1.1'):
+        print('Invalid HTTP version received ... responding with error!')
+        return False, '505', send_response_to_client(conn, '505', '505.html')
+
+    # A GET shouldn't have a body, but if it does we skip over it so that
+    # the next request on the connection is read from the right place.  If
+    # we can't tell how long it is, we can't find the next request either,
+    # so the connection is closed.
+
+    connection.reader.skip_body(content_length(headers))
+    connection_header = prepare_connection_header(keep_alive, settings)
+
+    # The status path reports how busy we are rather than serving a file,
+    # and the metrics path everything we have counted.
+
+    if (request_list[1] == STATUS_PATH):
+        print('Status requested ... sending load statistics!')
+        return keep_alive, '200', send_status_to_client(conn, connection_header)
+    if (request_list[1] == METRICS_PATH):
+        print('Metrics requested ... sending metrics!')
+        return keep_alive, '200', send_metrics_to_client(conn, connection_header)
+
+    # If requested file begins with a / we strip it off.
+
+    req_file = request_list[1]
+    while (req_file.startswith('/')):
+        req_file = req_file[1:]
+
+    # Check if requested file exists and report a 404 if not.
+
+    entry = content_cache.lookup(req_file)
+    ranges = None
+    if (entry != None) and ('range' in headers) and (range_still_applies(headers, entry)):
+        ranges = parse_range_header(headers['range'], entry.size)
+
+    # Send a compressed copy of the file if the client can take one, unless
+    # it only wants part of the file.
+
+    if (entry != None) and (ranges == None):
+        entry = choose_representation(entry, headers)
+    if (entry == None):
+        print('Requested file does not exist ... responding with error!')
+        code = '404'
+        sent = send_response_to_client(conn, code, '404.html', connection_header)
+
+    # The client already has the current version of the file, so there is
+    # no need to send it again.
+
+    elif (is_not_modified(headers, entry)):
+        print('Requested file has not been modified ... responding with 304!')
+        code = '304'
+        head = prepare_response_message(code) + connection_header + entry.validators + '\r\n'
+        send_head(conn, head, False)
+        sent = len(head)
+
+    # The client only wants part of the file.  If none of what they asked
+    # for is in the file, say so with a 416.
+
+    elif (ranges != None) and (len(ranges) == 0):
+        print('Requested range is not satisfiable ... responding with error!')
+        code = '416'
+        sent = send_response_to_client(conn, code, '416.html', connection_header + 'Content-Range: bytes */' + str(entry.size) + '\r\n')
+    elif (ranges != None):
+        print('Requested ranges good to go!  Sending ' + str(len(ranges)) + ' range(s) ...')
+        code = '206'
+        sent = send_ranges_to_client(conn, entry, ranges, connection_header)
+
+    # File exists, so prepare to send it!
+
+    else:
+        print('Requested file good to go!  Sending file ...')
+        code = '200'
+        sent = send_response_to_client(conn, code, req_file, connection_header, entry)
+
+    return keep_alive, code, sent
+
+# Serve requests on a connection for as long as the client keeps them coming
+# without a pause.  The event loop has already read the head of the first
+# one, and pipelined requests are sitting in the reader's buffer, so we
+# answer them in order straight away.  Returns True if the connection should
+# be handed back to the event loop to wait for more.
+
+def serve_connection(connection, settings):
+
+    conn = connection.sock
+    conn.settimeout(settings.timeout)
+    while True:
+        request, headers = connection.head
+        connection.head = None
+        keep_alive = handle_request(connection, request, headers, settings)
+        connection.requests += 1
+        if (not keep_alive):
+            return False
+
+        # Unless the whole head of the next request is already here, let the
+        # event loop watch the connection until it is.
+
+        connection.head = connection.reader.next_head()
+        if (connection.head == None):
+            return True
+
+# Read whatever a client has sent us and see if the head of its next request
+# is complete.  Returns the request line and headers once it is, or None if
+# we are still waiting.  Raises ConnectionError if the client went away first.
+
+def read_client_request(connection):
+    if (not connection.reader.fill()):
+        raise ConnectionError('client closed the connection')
+    return connection.reader.next_head()
+
+# Worker thread body.  Each worker pulls ready connections off the shared
+# queue and serves them.  Connections that are being kept alive go back to
+# the event loop through the parked queue, and the wakeup socket gets the
+# event loop's attention.  A failure on one client is reported and then
+# forgotten so that it can't take the worker down with it, whatever it was.
+
+def worker_loop(work_queue, parked_queue, wakeup, settings):
+    while True:
+        connection = work_queue.get()
+        keep = False
+        try:
+            keep = serve_connection(connection, settings)
+        except (OSError, http_error) as e:
+            print('Error while serving client', connection.addr, ':', e)
+        except Exception as e:
+            print('Unexpected error while serving client', connection.addr, ':', repr(e))
+        if (keep):
+            connection.sock.setblocking(False)
+            connection.deadline = time.monotonic() + settings.keep_alive_timeout
+            connection.idle = True
+            parked_queue.put(connection)
+            try:
+                wakeup.send(b'\0')
+            except BlockingIOError:
+                pass
+        else:
+            connection.sock.close()
+            server_load.connection_closed()
+
+# Create the listening socket on the given port, where 0 asks for a free
+# port at random.  A fixed port is marked reusable so that we can restart
+# straight away, and in SO_REUSEPORT mode several processes can each bind
+# their own socket to the same port and have the kernel share out the
+# connections between them.  A socket that is only holding on to a port
+# number for the workers is left bound but not listening.
+
+def create_server_socket(port, backlog, reuse_port, listen=True):
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server_socket.bind(('', 0))
-    print('Will wait for client connections at port ' + str(server_socket.getsockname()[1]))
-    server_socket.listen(1)
-    
+    if (port != 0):
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if (reuse_port):
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    server_socket.bind(('', port))
+    if (listen):
+        server_socket.listen(backlog)
+    server_socket.setblocking(False)
+    return server_socket
+
+# Run the serving engine on a listening socket forever.
+
+def serve_forever(server_socket, args):
+
+    # Set up the content caches, load statistics and metrics shared by all
+    # of the workers.
+
+    global content_cache, compressed_cache, server_load, server_metrics
+    content_cache = file_cache(args.cache_size, args.cache_file_limit)
+    compressed_cache = encoding_cache(args.compression_cache_size)
+    server_load = load_stats()
+    server_metrics = request_metrics(server_load, {'content': content_cache, 'compressed': compressed_cache}, worker_slot)
+
+    # Start up the pool of workers.  They are daemon threads so that they
+    # will not hold up shutdown when we get interrupted.
+
+    work_queue = queue.Queue()
+    parked_queue = queue.Queue()
+    wakeup_reader, wakeup_writer = socket.socketpair()
+    wakeup_reader.setblocking(False)
+    wakeup_writer.setblocking(False)
+    for i in range(args.workers):
+        threading.Thread(target=worker_loop, args=(work_queue, parked_queue, wakeup_writer, args), daemon=True).start()
+
+    # The main thread runs an event loop over the listening socket and every
+    # connection that is waiting for its next request, whether it is brand
+    # new or being kept alive.  Idle connections cost us nothing but a file
+    # descriptor, and a connection is only handed to a worker once the whole
+    # head of its request has arrived, so clients sending slowly can't tie
+    # the workers up.
+
+    selector = selectors.DefaultSelector()
+    selector.register(server_socket, selectors.EVENT_READ)
+    selector.register(wakeup_reader, selectors.EVENT_READ)
+    last_sweep = time.monotonic()
+    print('Waiting for incoming client connections ...')
+
     # Keep the server running forever.
-    
+
     while(1):
-        print('Waiting for incoming client connection ...')
-        conn, addr = server_socket.accept()
-        print('Accepted connection from client address:', addr)
-        print('Connection to client established, waiting to receive message...')
+        for key, mask in selector.select(timeout=1):
+
+            # New connections are accepted in a batch until the kernel has
+            # no more for us, and then watched until their requests arrive.
+
+            if (key.fileobj is server_socket):
+                while True:
+                    try:
+                        conn, addr = server_socket.accept()
+                    except BlockingIOError:
+                        break
+                    print('Accepted connection from client address:', addr)
+                    conn.setblocking(False)
+                    selector.register(conn, selectors.EVENT_READ, client_connection(conn, addr, args.timeout))
+                    server_load.connection_opened()
+                    server_metrics.accepted.inc()
 
-        # We obtain our request from the socket.  We look at the request and
-        # figure out what to do based on the contents of things.
+            # Workers have handed back connections to keep alive, so start
+            # watching them again.
 
-        request = get_line_from_socket(conn)
-        print('Received request:  ' + request)
-        request_list = request.split()
+            elif (key.fileobj is wakeup_reader):
+                try:
+                    while (wakeup_reader.recv(BUFFER_SIZE)):
+                        pass
+                except BlockingIOError:
+                    pass
+                while (not parked_queue.empty()):
+                    connection = parked_queue.get()
+                    selector.register(connection.sock, selectors.EVENT_READ, connection)
 
-        # This server doesn't care about headers, so we just clean them up.
+            # A client has sent us more of its request.  Once the head is
+            # all there, it is passed on to a worker.  A kept-alive client
+            # only has until its idle deadline to start the next request, but
+            # then gets as long as a new one to finish sending the head.
 
-        while (get_line_from_socket(conn) != ''):
+            else:
+                connection = key.data
+                if (connection.idle):
+                    connection.idle = False
+                    connection.deadline = time.monotonic() + args.timeout
+                try:
+                    connection.head = read_client_request(connection)
+                except BlockingIOError:
+                    continue
+                except (OSError, http_error) as e:
+                    print('Error while reading from client', connection.addr, ':', e)
+                    selector.unregister(connection.sock)
+                    connection.sock.close()
+                    server_load.connection_closed()
+                    continue
+                if (connection.head == None):
+                    continue
+                selector.unregister(connection.sock)
+                work_queue.put(connection)
+
+        # Once a second, close any connections that have gone past their
+        # deadline without sending a whole request, whether they never sent
+        # one or went quiet after one.
+
+        now = time.monotonic()
+        if (now - last_sweep < 1):
+            continue
+        last_sweep = now
+
+        # A worker process whose master has gone away has no one to stop it,
+        # so it stops itself rather than go on holding the port.
+
+        if (master_pid != None) and (os.getppid() != master_pid):
+            print('Worker process', os.getpid(), 'lost its master process ... shutting down.')
+            sys.exit(0)
+
+        for key in list(selector.get_map().values()):
+            if (isinstance(key.data, client_connection)) and (now > key.data.deadline):
+                print('Client', key.data.addr, 'timed out sending its request.')
+                selector.unregister(key.fileobj)
+                key.fileobj.close()
+                server_load.connection_closed()
+
+# Fork a new worker process to serve connections.  Worker processes leave
+# SIGINT to the master and shut down when the master sends them SIGTERM.
+# The child forgets the master's list of worker processes straight away, so
+# that a worker shutting down doesn't take its siblings with it.  Returns
+# the new process id in the master.
+
+def start_worker_process(server_socket, args, slot):
+    global worker_slot, master_pid
+    master = os.getpid()
+    pid = os.fork()
+    if (pid != 0):
+        return pid
+
+    worker_pids.clear()
+    worker_slot = slot
+    master_pid = master
+    status = 1
+    try:
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal_handler)
+        if (args.reuse_port):
+            server_socket = create_server_socket(args.port, args.backlog, True)
+        print('Worker process', os.getpid(), 'is serving connections.')
+        serve_forever(server_socket, args)
+    except SystemExit as e:
+        status = e.code if isinstance(e.code, int) else 0
+    except BaseException as e:
+        print('Worker process', os.getpid(), 'failed:', repr(e))
+    finally:
+        sys.stdout.flush()
+        os._exit(status)
+
+# Ask every worker process to shut down and wait for them all to finish.
+
+def stop_worker_processes():
+    pids = list(worker_pids)
+    worker_pids.clear()
+    for pid in pids:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+    for pid in pids:
+        try:
+            os.waitpid(pid, 0)
+        except ChildProcessError:
             pass
 
-        # If we did not get a GET command respond with a 501.
+# The master process of pre-fork mode.  It starts the worker processes and
+# then watches over them, replacing any that exit.
 
-        if request_list[0] != 'GET':
-            print('Invalid type of request received ... responding with error!')
-            send_response_to_client(conn, '501', '501.html')
+def supervise_worker_processes(server_socket, args):
+    started = {}
+    for slot in range(args.processes):
+        pid = start_worker_process(server_socket, args, slot)
+        worker_pids[pid] = slot
+        started[slot] = time.monotonic()
 
-        # If we did not get the proper HTTP version respond with a 505.
+    while True:
+        pid, status = os.wait()
+        if (pid not in worker_pids):
+            continue
+        slot = worker_pids.pop(pid)
+        print('Worker process', pid, 'exited with status', os.waitstatus_to_exitcode(status), '... restarting it.')
+        if (time.monotonic() - started[slot] < RESTART_DELAY):
+            time.sleep(RESTART_DELAY)
+        pid = start_worker_process(server_socket, args, slot)
+        worker_pids[pid] = slot
+        started[slot] = time.monotonic()
 
-        elif request_list[2] != 'HTTP/1.1':
-            print('Invalid HTTP version received ... responding with error!')
-            send_response_to_client(conn, '505', '505.html')
+# Our main function.
 
-        # We have the right request and version, so check if file exists.
-                  
-        else:
+def main():
 
-            # If requested file begins with a / we strip it off.
+    # Check command line arguments for tuning the serving engine.
 
-            req_file = request_list[1]
-            while (req_file[0] == '/'):
-                req_file = req_file[1:]
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=0, help="Port to listen on; a free port is picked at random if not given")
+    parser.add_argument("--processes", type=int, default=1, help="Number of worker processes to pre-fork")
+    parser.add_argument("--reuse-port", action="store_true", help="Give each worker process its own SO_REUSEPORT listening socket")
+    parser.add_argument("--backlog", type=int, default=DEFAULT_BACKLOG, help="Number of pending connections the kernel may queue")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="Number of worker threads serving requests")
+    parser.add_argument("--timeout", type=float, default=DEFAULT_TIMEOUT, help="Seconds a client may take to send its request")
+    parser.add_argument("--keep-alive-timeout", type=float, default=DEFAULT_KEEP_ALIVE_TIMEOUT, help="Seconds an idle persistent connection is kept open")
+    parser.add_argument("--max-requests", type=int, default=DEFAULT_MAX_REQUESTS, help="Most requests served on one connection before it is closed")
+    parser.add_argument("--cache-size", type=int, default=DEFAULT_CACHE_SIZE, help="Bytes of file content to keep cached in memory")
+    parser.add_argument("--cache-file-limit", type=int, default=DEFAULT_CACHE_FILE_LIMIT, help="Largest file, in bytes, that will be cached")
+    parser.add_argument("--compression-cache-size", type=int, default=DEFAULT_COMPRESSION_CACHE_SIZE, help="Bytes of compressed content to keep cached in memory")
+    args = parser.parse_args()
 
-            # Check if requested file exists and report a 404 if not.
+    # Pre-forking needs fork(), and SO_REUSEPORT needs a kernel that has it.
 
-            if (not os.path.exists(req_file)):
-                print('Requested file does not exist ... responding with error!')
-                send_response_to_client(conn, '404', '404.html')
+    if (args.processes > 1) and (not hasattr(os, 'fork')):
+        print('Error:  Pre-fork mode is not supported on this platform.')
+        sys.exit(1)
+    if (args.reuse_port) and (not hasattr(socket, 'SO_REUSEPORT')):
+        print('Error:  SO_REUSEPORT is not supported on this platform.')
+        sys.exit(1)
 
-            # File exists, so prepare to send it!  
+    # Register our signal handler for shutting down, whether we are
+    # interrupted at the terminal or asked to stop by a service manager.
 
-            else:
-                print('Requested file good to go!  Sending file ...')
-                send_response_to_client(conn, '200', req_file)
-                
-        # We are all done with this client, so close the connection and
-        # Go back to get another one!
+    signal.signal(signal.SIGINT, signal_handler)
+    signal.signal(signal.SIGTERM, signal_handler)
+
+    # Create the socket.  We will ask this to work on any interface and, unless
+    # we were given a port, to pick a free port at random.  We'll print this
+    # out for clients to use.  In SO_REUSEPORT mode each worker process binds
+    # its own socket, and this one just holds on to the port number.
+
+    prefork = (args.processes > 1)
+    server_socket = create_server_socket(args.port, args.backlog, args.reuse_port, not (prefork and args.reuse_port))
+    args.port = server_socket.getsockname()[1]
+    print('Will wait for client connections at port ' + str(args.port))
+
+    # Serve in this process, or hand things over to a team of worker processes.
+
+    if (prefork):
+        supervise_worker_processes(server_socket, args)
+    else:
+        serve_forever(server_socket, args)
 
-        conn.close();
-    
 
 if __name__ == '__main__':
     main()
-